@@ -1,10 +1,15 @@
 import logging
+import numpy as np
+
+from csv_utils import CsvBlockFormatter, acc_csv_formats, acc_csv_formatter, literal_format
+from sequence_utils import packet_duplicate, packet_late, packet_resumed
 
 acc_header_len = 5
 acc_data_frame_len = 12
-last_packet_received = -1
-recording_timestamp = -1
+acc_data_frames = 19
 sample_interval_millis = 1000.0 / 100.0
+# mg per LSB of the accelerometer set to 2g and mdps per LSB of the gyroscope set to 250dps, per axis of a frame
+acc_axis_sensitivity = np.array([0.061, 0.061, 0.061, 8.75, 8.75, 8.75])
 
 
 def convert_sample_to_line(sample_time, data, verbose=False):
@@ -32,38 +37,115 @@ def write_sample_to_file(data_line, file=None):
         file.write(data_line + '\n')
 
 
-def write_sample_to_mqtt(data_line, mqtt_client=None, mqtt_topic=None):
+def convert_block_to_text(sample_time, data):
     """
-    Write a sample's data to the recording's file
-    :param data_line: the line of data to publish
-    :param mqtt_client: the mqtt client to send the data
-    :param mqtt_topic: the mqtt topic to send the data
+    Convert a block of accelerometer samples to data lines, same as convert_sample_to_line for every sample
+    :param sample_time: the timestamp of the first sample of the block
+    :param data: the (samples x 6) converted accelerometer data
+    :return: the data lines of the block, each terminated by a newline
+    """
+    rows = np.empty((len(data), 7))
+    rows[:, 0] = sample_time + np.arange(len(data)) * sample_interval_millis
+    rows[:, 1:] = data
+    return acc_csv_formatter.render(rows)
+
+
+def write_block_to_file(data_text, file=None):
+    """
+    Write the data lines of a block of samples to the recording's file in a single write
+    :param data_text: the data lines to store, each terminated by a newline
+    :param file: the file where data are stored
     """
-    if mqtt_client is not None:
-        mqtt_client.publish(f"{mqtt_topic}", data_line)
+    if file is not None and len(data_text) > 0:
+        file.write(data_text)
 
 
-def process_accelerometer_data(data, file=None, mqtt_client=None, mqtt_topic=None):
+def write_packet_to_mqtt(sample_time, frames, data_text, mqtt_publisher=None):
+    """
+    Hand a packet's data to the mqtt publisher
+    :param sample_time: the timestamp of the first sample of the packet
+    :param frames: the raw values of the packet's samples
+    :param data_text: the data lines of the packet's samples
+    :param mqtt_publisher: the mqtt publisher to send the data
+    """
+    if mqtt_publisher is not None:
+        if mqtt_publisher.is_text:
+            mqtt_publisher.add_text(data_text)
+        else:
+            mqtt_publisher.add_samples(-1, sample_time, frames)
+
+
+def process_accelerometer_data(session, data, file=None, mqtt_publisher=None, binary_file=None, store=None):
     """
     Processes the accelerometer data received by the ECG Vest
+    :param session: the recording session of the ECG device
     :param data: the accelerometer data received
     :param file: the file where data are stored
+    :param mqtt_publisher: the mqtt publisher to send the data
+    :param binary_file: the binary recording where data are stored
+    :param store: the in-memory store of the recent accelerometer values
+    :return: the number of samples decoded
     """
-    global recording_timestamp
     packet_sequence_number = data[0]
-    update_sample_time(packet_sequence_number, file)
-    for frame in range(19):
-        acc_data_sample = []
-        for j in [0, 1, 2]:
-            index = acc_header_len + frame * acc_data_frame_len + j * 2
-            acc_data_sample.append(lsm6dsrx_from_fs2g_to_g(data[index + 1], data[index]))
-        for j in [3, 4, 5]:
-            index = acc_header_len + frame * acc_data_frame_len + j * 2
-            acc_data_sample.append(lsm6dsrx_from_fs250dps_to_dps(data[index + 1], data[index]))
-        data_line = convert_sample_to_line(recording_timestamp, acc_data_sample)
-        write_sample_to_file(data_line, file=file)
-        write_sample_to_mqtt(data_line, mqtt_client=mqtt_client, mqtt_topic=f"{mqtt_topic}/acc")
-        recording_timestamp += sample_interval_millis
+    status, missing_samples = update_sample_time(session, packet_sequence_number, file, binary_file)
+    if status in (packet_duplicate, packet_late):
+        return 0
+    text_output = file is not None or (mqtt_publisher is not None and mqtt_publisher.is_text)
+    if missing_samples > 0 and session.gap_fill is not None and text_output:
+        gap_text = convert_gap_to_text(session.acc_recording_timestamp - missing_samples * sample_interval_millis,
+                                       missing_samples, session.gap_fill)
+        write_block_to_file(gap_text, file=file)
+        if mqtt_publisher is not None and mqtt_publisher.is_text:
+            mqtt_publisher.add_text(gap_text)
+    packet_timestamp = session.acc_recording_timestamp
+    raw = decode_accelerometer_frames(data)
+    # binary
+    if binary_file is not None:
+        binary_file.write_samples(raw, session.ecg_recording_start)
+    # in-memory store, in G and dps on the time of the ecg stream, which the packets before the first ecg packet lack
+    if store is not None and session.ecg_recording_start >= 0:
+        store.add('acc', session.ecg_recording_start + packet_timestamp - session.acc_recording_offset +
+                  np.arange(acc_data_frames) * sample_interval_millis, raw * acc_axis_sensitivity / 1000)
+    if not text_output:
+        write_packet_to_mqtt(packet_timestamp, raw, None, mqtt_publisher)
+        session.acc_recording_timestamp += acc_data_frames * sample_interval_millis
+        return acc_data_frames
+    data_text = convert_block_to_text(packet_timestamp, scale_accelerometer_frames(raw))
+    write_block_to_file(data_text, file=file)
+    write_packet_to_mqtt(packet_timestamp, raw, data_text, mqtt_publisher)
+    session.acc_recording_timestamp += acc_data_frames * sample_interval_millis
+    return acc_data_frames
+
+
+def decode_accelerometer_frames(data):
+    """
+    Decodes the frames of an accelerometer packet. Each frame holds the 3 accelerometer and the 3 gyroscope axes as
+    little endian signed 16bit values.
+    :param data: the accelerometer data received
+    :return: the raw values as a (frames x 6) int16 array
+    """
+    return np.frombuffer(data, dtype='<i2', count=acc_data_frames * acc_data_frame_len // 2,
+                         offset=acc_header_len).reshape(acc_data_frames, -1)
+
+
+def scale_accelerometer_frames(raw):
+    """
+    Converts raw accelerometer frames to G values for the accelerometer and dps values for the gyroscope
+    :param raw: the (frames x 6) raw values
+    :return: the (frames x 6) converted values rounded to 2 decimals
+    """
+    return np.round(raw * acc_axis_sensitivity / 1000, 2)
+
+
+def signed_value(msb, lsb):
+    """
+    Combines the bytes received to a signed 16bit value
+    :param msb: the msb of the value received
+    :param lsb: the lsb of the value received
+    :return: the signed value
+    """
+    value = msb * 256 + lsb
+    return value - 65536 if value >= 32768 else value
 
 
 def lsm6dsrx_from_fs2g_to_g(msb, lsb):
@@ -73,7 +155,7 @@ def lsm6dsrx_from_fs2g_to_g(msb, lsb):
     :param lsb: the lsb of the value received
     :return: the converted acceleration value is Gs
     """
-    return round(((msb * 256 + lsb) * 0.061) / 1000, 2)
+    return round((signed_value(msb, lsb) * 0.061) / 1000, 2)
 
 
 def lsm6dsrx_from_fs250dps_to_dps(msb, lsb):
@@ -83,43 +165,54 @@ def lsm6dsrx_from_fs250dps_to_dps(msb, lsb):
     :param lsb: the lsb of the value received
     :return: the converted gyroscope value in dps
     """
-    return round(((msb * 256 + lsb) * 8.75) / 1000, 2)
+    return round((signed_value(msb, lsb) * 8.75) / 1000, 2)
 
 
-def update_sample_time(sequence_no, file=None):
+def update_sample_time(session, sequence_no, file=None, binary_file=None):
     """
     Updates the timestamp for beginning of the current packet based on its sequence number
+    :param session: the recording session of the ECG device
     :param sequence_no: the sequence number of the currently processed packet
     :param file: the file where data are stored
-    """
-    global recording_timestamp, last_packet_received
-    if recording_timestamp == -1:
-        recording_timestamp = 0
-
-    missing_count = 0
-
-    was_last_packet_received = last_packet_received
-
-    if ((sequence_no != 0 or last_packet_received != 254)
-            and (sequence_no != (last_packet_received + 1))):
-        if sequence_no > last_packet_received:
-            while last_packet_received < (sequence_no - 1):
-                last_packet_received = last_packet_received + 1
-                missing_count = missing_count + 1
-        else:
-            while last_packet_received < 255:
-                last_packet_received = last_packet_received + 1
-                missing_count = missing_count + 1
-            last_packet_received = -1
-            while last_packet_received < sequence_no - 1:
-                last_packet_received = last_packet_received + 1
-                missing_count = missing_count + 1
-    if missing_count > 0 and file is not None:
-        logging.warn(
-            f'# [ecg] missed {missing_count} packets - last was {was_last_packet_received} but received {sequence_no}')
-        write_missing_to_file(sequence_no, was_last_packet_received, missing_count, file)
-    recording_timestamp = recording_timestamp + missing_count * sample_interval_millis
-    last_packet_received = sequence_no
+    :param binary_file: the binary recording where data are stored
+    :return: the classification of the packet and the number of samples missed before it
+    """
+    if session.acc_recording_timestamp == -1:
+        session.acc_recording_timestamp = 0.0
+
+    last_packet_received = session.acc_sequence.last
+    status, missing_count = session.acc_sequence.update(sequence_no)
+    if status in (packet_duplicate, packet_late):
+        logging.warning(f'# [acc] dropped {status} packet {sequence_no} - last was {last_packet_received}')
+        return status, 0
+    if status == packet_resumed:
+        logging.warning(f'# [acc] resumed with packet {sequence_no} after missing {missing_count} packets')
+    if missing_count == 0:
+        return status, 0
+    missing_samples = missing_count * acc_data_frames
+    logging.warning(
+        f'# [acc] missed {missing_count} packets - last was {last_packet_received} but received {sequence_no}')
+    if session.gap_fill is None:
+        write_missing_to_file(sequence_no, last_packet_received, missing_count, file)
+    if file is not None and hasattr(file, 'write_gap'):
+        # segmented recordings keep the gaps in the index of each segment
+        file.write_gap(sequence_no, last_packet_received, missing_count, missing_samples)
+    if binary_file is not None:
+        binary_file.write_gap(sequence_no, last_packet_received, missing_count, missing_samples)
+    session.acc_recording_timestamp = session.acc_recording_timestamp + missing_samples * sample_interval_millis
+    return status, missing_samples
+
+
+def convert_gap_to_text(sample_time, sample_count, fill):
+    """
+    Generates placeholder data lines for missed samples, keeping the time grid of the recording uniform
+    :param sample_time: the timestamp of the first missed sample
+    :param sample_count: the number of missed samples
+    :param fill: the value written in place of the axes of the placeholder lines, e.g. nan
+    :return: the placeholder data lines, each terminated by a newline
+    """
+    formatter = CsvBlockFormatter(acc_csv_formats[:1] + (literal_format(fill),) * 6)
+    return formatter.render(sample_time + np.arange(sample_count)[:, None] * sample_interval_millis)
 
 
 def write_missing_to_file(current, last, missed, file=None):
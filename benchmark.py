@@ -0,0 +1,156 @@
+#!/usr/bin/python
+import getopt
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import acc_utils
+import ecg_utils
+from binary_utils import open_ecg_binary_file, open_acc_binary_file
+from influx_utils import InfluxLineWriter
+from mqtt_utils import MqttBatchPublisher
+from session_utils import RecordingSession
+from sim_utils import SimulatedVest, ecg_packet_samples
+
+help_line = 'benchmark.py -p <packets> -l <loss> -j <json_output>'
+logger = logging.getLogger('benchmark')
+
+
+class NullMqttClient:
+    """
+    Stand-in for the mqtt client that only counts the published messages
+    """
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload):
+        self.published += 1
+
+
+class NullInfluxWriteApi:
+    """
+    Stand-in for the influxdb write api that only counts the written requests
+    """
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, bucket, record):
+        self.written += 1
+
+
+def run_path(name, packets, new_process):
+    """
+    Runs a decode or sink path over a list of packets and measures its throughput, then its allocations
+    :param name: the name of the path
+    :param packets: the packets to process
+    :param new_process: creates the function processing a single packet, called for each pass so the allocation pass
+    does not replay the packets on the session of the timed pass
+    :return: the measurements of the path
+    """
+    process = new_process()
+    start = time.perf_counter()
+    for data in packets:
+        process(bytearray(data))
+    elapsed = time.perf_counter() - start
+    process = new_process()
+    tracemalloc.start()
+    for data in packets[:min(len(packets), 200)]:
+        process(bytearray(data))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {'path': name, 'packets': len(packets), 'packets_per_second': len(packets) / elapsed,
+              'micros_per_packet': elapsed * 1000000 / len(packets), 'peak_alloc_bytes': peak}
+    logger.info(f"{name:<20} {result['packets_per_second']:>10.0f} packets/s"
+                f" {result['micros_per_packet']:>9.1f} us/packet {peak:>10} bytes peak")
+    return result
+
+
+def run_benchmarks(packet_count=5000, loss=0.0):
+    """
+    Runs all the decode and sink paths over simulated packets
+    :param packet_count: the number of packets generated per stream
+    :param loss: the probability of a packet being lost
+    :return: the measurements of all paths
+    """
+    vest = SimulatedVest(loss=loss, seed=1)
+    ecg_packets = [bytes(data) for data in vest.ecg_packets(packet_count)]
+    acc_packets = [bytes(data) for data in vest.acc_packets(packet_count)]
+    results = []
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as null_file:
+        def new_ecg_process(**sinks):
+            session = RecordingSession()
+            return lambda data: ecg_utils.process_ecg_data(session, data, **sinks)
+
+        def new_acc_process(**sinks):
+            session = RecordingSession()
+            return lambda data: acc_utils.process_accelerometer_data(session, data, **sinks)
+
+        def new_sequence_process():
+            session = RecordingSession()
+            return lambda data: ecg_utils.update_sample_time(session, data[0], ecg_packet_samples)
+
+        def ecg_path(name, **sinks):
+            results.append(run_path(name, ecg_packets, lambda: new_ecg_process(**sinks)))
+
+        def acc_path(name, **sinks):
+            results.append(run_path(name, acc_packets, lambda: new_acc_process(**sinks)))
+
+        results.append(run_path('ecg unpack', ecg_packets, lambda: lambda data: ecg_utils.unpack_lead_values(
+            memoryview(data)[ecg_utils.ecg_header_len:])))
+        results.append(run_path('ecg sequence', ecg_packets, new_sequence_process))
+        ecg_path('ecg decode')
+        ecg_path('ecg csv file', file=null_file)
+        with open_ecg_binary_file(os.path.join(directory, 'ecg'), None) as binary_file:
+            ecg_path('ecg binary file', binary_file=binary_file)
+        ecg_path('ecg mqtt csv', mqtt_publisher=MqttBatchPublisher(NullMqttClient(), 'ecg',
+                                                                   ecg_utils.sample_interval_millis))
+        ecg_path('ecg mqtt binary', mqtt_publisher=MqttBatchPublisher(NullMqttClient(), 'ecg',
+                                                                      ecg_utils.sample_interval_millis, 'binary'))
+        ecg_path('ecg influxdb', influxdb_writer=InfluxLineWriter(NullInfluxWriteApi(), 'ecg'))
+        acc_path('acc decode')
+        acc_path('acc csv file', file=null_file)
+        with open_acc_binary_file(os.path.join(directory, 'acc'), None) as binary_file:
+            acc_path('acc binary file', binary_file=binary_file)
+        acc_path('acc mqtt csv', mqtt_publisher=MqttBatchPublisher(NullMqttClient(), 'acc',
+                                                                   acc_utils.sample_interval_millis))
+    return results
+
+
+def main(argv):
+    packet_count = 5000
+    loss = 0.0
+    json_output = None
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    try:
+        opts, args = getopt.getopt(argv, "hp:l:j:", ["packets=", "loss=", "json="])
+    except getopt.GetoptError:
+        logging.error(help_line)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            logging.info(help_line)
+            sys.exit()
+        elif opt in ('-p', '--packets'):
+            packet_count = int(arg)
+        elif opt in ('-l', '--loss'):
+            loss = float(arg)
+        elif opt in ('-j', '--json'):
+            json_output = arg
+    # silence the missed packets warnings while measuring
+    logging.getLogger().setLevel(logging.ERROR)
+    logger.setLevel(logging.INFO)
+    results = run_benchmarks(packet_count, loss)
+    if json_output is not None:
+        with open(json_output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,309 @@
+import getopt
+import logging
+import struct
+import sys
+import time
+
+import numpy as np
+
+import acc_utils
+import ecg_utils
+from calibration_utils import Calibration, default_calibration
+from qrs_utils import QrsDetector
+
+binary_magic = b'ECGB'
+binary_version = 3
+binary_header_len = 1280
+# version 1 and 2 recordings have a shorter header without the calibration
+binary_header_len_v2 = 256
+# magic, version, kind, dtype, channel count, sample rate, start epoch, sample count, gap offset, gap count,
+# device address, channel layout
+binary_header_format = '<4sH8s4sHdqQQQ32s160s'
+# firmware revision, calibration name, derivation, gain and offset of the calibration the recording was made with
+binary_calibration_format = '<32s32s96d12d12d'
+binary_calibration_offset = binary_header_len_v2
+# sample index, last sequence number, current sequence number, missed packets, missed samples
+binary_gap_dtype = np.dtype([('index', '<u8'), ('last', '<i2'), ('current', '<u2'), ('missed', '<u4'),
+                             ('samples', '<u4')])
+# version 1 recordings do not store the missed samples
+binary_gap_dtype_v1 = np.dtype([('index', '<u8'), ('last', '<i2'), ('current', '<u2'), ('missed', '<u4')])
+
+help_line = 'binary_utils.py --gapfill <value> <recording> [<recording> ...]'
+
+ecg_binary_extension = 'ecgb'
+acc_binary_extension = 'accb'
+ecg_binary_channels = ('LA', 'RA', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6', 'BAT')
+acc_binary_channels = ('AX', 'AY', 'AZ', 'GX', 'GY', 'GZ')
+
+
+class BinaryRecordingWriter:
+    """
+    Writes samples to a binary recording: a fixed header, the packed samples and a gap table appended when closed
+    """
+
+    def __init__(self, path, kind, address, sample_rate, channels, dtype, calibration=None, firmware=None):
+        """
+        :param path: the path of the recording file
+        :param kind: the kind of data stored (ecg or acc)
+        :param address: the address of the ECG device
+        :param sample_rate: the sample rate of the data in Hz
+        :param channels: the names of the stored channels
+        :param dtype: the numpy type of the stored values
+        :param calibration: the calibration of the ecg channels of the device, None for the default one
+        :param firmware: the firmware revision of the device, None if not known
+        """
+        self.path = path
+        self.kind = kind
+        self.address = address or ''
+        self.sample_rate = sample_rate
+        self.channels = tuple(channels)
+        self.dtype = np.dtype(dtype)
+        self.calibration = calibration or default_calibration
+        self.firmware = firmware or ''
+        self.start_epoch = -1
+        self.sample_count = 0
+        self.gaps = []
+        self.file = open(path, 'wb')
+        self.file.write(self.pack_header())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def pack_header(self, gap_offset=0):
+        """
+        Packs the header of the recording
+        :param gap_offset: the offset of the gap table in the file
+        :return: the header bytes
+        """
+        header = struct.pack(binary_header_format, binary_magic, binary_version, self.kind.encode(),
+                             self.dtype.str.encode(), len(self.channels), self.sample_rate, self.start_epoch,
+                             self.sample_count, gap_offset, len(self.gaps), self.address.encode(),
+                             ','.join(self.channels).encode())
+        calibration = struct.pack(binary_calibration_format, self.firmware.encode(), self.calibration.name.encode(),
+                                  *self.calibration.derivation.ravel(), *self.calibration.gain,
+                                  *self.calibration.offset)
+        return (header.ljust(binary_calibration_offset, b'\0') + calibration).ljust(binary_header_len, b'\0')
+
+    def write_samples(self, samples, start_epoch=-1):
+        """
+        Appends a block of samples to the recording
+        :param samples: the (samples x channels) block to append
+        :param start_epoch: the start of the recording in milliseconds, current time is used if not known
+        """
+        if self.start_epoch == -1:
+            self.start_epoch = start_epoch if start_epoch >= 0 else int(time.time() * 1000)
+            position = self.file.tell()
+            self.file.seek(0)
+            self.file.write(self.pack_header())
+            self.file.seek(position)
+        self.file.write(np.ascontiguousarray(samples, dtype=self.dtype).data)
+        self.sample_count += len(samples)
+
+    def write_gap(self, current, last, missed, samples):
+        """
+        Records missing packets before the next sample
+        :param current: the current packet sequence number
+        :param last: the last received packet sequence number
+        :param missed: the missed packets
+        :param samples: the samples carried by the missed packets
+        """
+        self.gaps.append((self.sample_count, last, current, missed, samples))
+
+    def close(self):
+        """
+        Appends the gap table and finalizes the header of the recording
+        """
+        if self.file.closed:
+            return
+        gap_offset = self.file.tell()
+        self.file.write(np.array(self.gaps, dtype=binary_gap_dtype).data)
+        self.file.seek(0)
+        self.file.write(self.pack_header(gap_offset))
+        self.file.close()
+
+
+class BinaryRecording:
+    """
+    Read only view of a binary recording, the samples are memory mapped and not parsed
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the path of the recording file
+        """
+        with open(path, 'rb') as file:
+            header = file.read(binary_header_len)
+        (magic, version, kind, dtype, channel_count, sample_rate, start_epoch, sample_count, gap_offset, gap_count,
+         address, channels) = struct.unpack_from(binary_header_format, header)
+        if magic != binary_magic:
+            raise ValueError(f'{path} is not a binary recording')
+        self.path = path
+        self.version = version
+        if version >= 3:
+            self.header_len = binary_header_len
+            values = struct.unpack_from(binary_calibration_format, header, binary_calibration_offset)
+            self.firmware = values[0].rstrip(b'\0').decode() or None
+            self.calibration = Calibration(values[1].rstrip(b'\0').decode(), np.reshape(values[2:98], (12, 8)),
+                                           values[98:110], values[110:122])
+        else:
+            # older recordings were made with the default calibration
+            self.header_len = binary_header_len_v2
+            self.firmware = None
+            self.calibration = default_calibration
+        self.kind = kind.rstrip(b'\0').decode()
+        self.dtype = np.dtype(dtype.rstrip(b'\0').decode())
+        self.sample_rate = sample_rate
+        self.start_epoch = start_epoch
+        self.address = address.rstrip(b'\0').decode()
+        self.channels = tuple(channels.rstrip(b'\0').decode().split(','))
+        if gap_offset == 0:
+            # recording was not closed, use all the complete samples available
+            size = np.memmap(path, dtype=np.uint8, mode='r').shape[0]
+            sample_count = (size - self.header_len) // (self.dtype.itemsize * channel_count)
+            self.gaps = np.zeros(0, dtype=binary_gap_dtype)
+        elif version == 1:
+            gaps = np.fromfile(path, dtype=binary_gap_dtype_v1, count=gap_count, offset=gap_offset)
+            self.gaps = np.zeros(gap_count, dtype=binary_gap_dtype)
+            for name in binary_gap_dtype_v1.names:
+                self.gaps[name] = gaps[name]
+            # version 1 recordings advanced the timeline by one sample per missed packet
+            self.gaps['samples'] = gaps['missed']
+        else:
+            self.gaps = np.fromfile(path, dtype=binary_gap_dtype, count=gap_count, offset=gap_offset)
+        if sample_count == 0:
+            self.samples = np.zeros((0, channel_count), dtype=self.dtype)
+        else:
+            self.samples = np.memmap(path, dtype=self.dtype, mode='r', offset=self.header_len,
+                                     shape=(sample_count, channel_count))
+
+    def __len__(self):
+        return len(self.samples)
+
+
+def open_ecg_binary_file(filename, address, calibration=None, firmware=None):
+    """
+    Creates the binary recording for the ecg data of a device
+    :param filename: the name of the recording without extension
+    :param address: the address of the ECG device
+    :param calibration: the calibration of the ecg channels of the device, None for the default one
+    :param firmware: the firmware revision of the device, None if not known
+    :return: the binary recording writer
+    """
+    return BinaryRecordingWriter(f'{filename}.{ecg_binary_extension}', 'ecg', address,
+                                 1000.0 / ecg_utils.sample_interval_millis, ecg_binary_channels, '<u2', calibration,
+                                 firmware)
+
+
+def open_acc_binary_file(filename, address):
+    """
+    Creates the binary recording for the accelerometer data of a device
+    :param filename: the name of the recording without extension
+    :param address: the address of the ECG device
+    :return: the binary recording writer
+    """
+    return BinaryRecordingWriter(f'{filename}.{acc_binary_extension}', 'acc', address,
+                                 1000.0 / acc_utils.sample_interval_millis, acc_binary_channels, '<i2')
+
+
+def detect_qrs(recording, block_samples=20):
+    """
+    Runs the QRS detection of the live recording over the ecg samples of a binary recording
+    :param recording: the binary ecg recording
+    :param block_samples: the samples processed at a time, the samples of a packet to match the live recording
+    :return: per sample arrays of the qrs flag and the average qrs duration in samples
+    """
+    detector = QrsDetector(recording.sample_rate)
+    is_qrs = np.zeros(len(recording), dtype=np.int8)
+    qrs_samples = np.zeros(len(recording), dtype=np.int64)
+    bounds = [int(gap['index']) for gap in recording.gaps] + [len(recording)]
+    position = 0
+    released = []
+    for gap, bound in zip([None] + list(recording.gaps), bounds):
+        if gap is not None:
+            detector.skip(int(gap['samples']))
+        for start in range(position, bound, block_samples):
+            end = min(start + block_samples, bound)
+            signal = ecg_utils.produce_qrs_signal_from_lead_values(recording.samples[start:end])
+            released.extend(detector.process(signal, start))
+        position = bound
+    for start, block_qrs, _, _, block_qrs_samples in released + detector.release():
+        is_qrs[start:start + len(block_qrs)] = block_qrs
+        qrs_samples[start:start + len(block_qrs)] = block_qrs_samples
+    return is_qrs, qrs_samples
+
+
+def convert_to_csv(recording, file, gap_fill=None, block_samples=4096):
+    """
+    Writes a binary recording in the csv format of the text recordings, with the channels derived by the calibration
+    the recording was made with
+    :param recording: the binary recording
+    :param file: the text file to write to
+    :param gap_fill: the value of the placeholder rows written for missed samples, None to only report the gaps
+    :param block_samples: the samples rendered at a time
+    """
+    interval = 1000.0 / recording.sample_rate
+    if recording.kind == 'ecg':
+        is_qrs, qrs_samples = detect_qrs(recording)
+    bounds = [int(gap['index']) for gap in recording.gaps] + [len(recording)]
+    sample_time = 0.0
+    position = 0
+    for gap, bound in zip([None] + recording.gaps.tolist(), bounds):
+        if gap is not None:
+            _, last, current, missed, samples = gap
+            if gap_fill is not None:
+                if recording.kind == 'ecg':
+                    battery = recording.samples[min(position, len(recording) - 1), 8]
+                    file.write(ecg_utils.convert_gap_to_text(recording.start_epoch, sample_time, samples, gap_fill,
+                                                             battery, interval))
+                else:
+                    file.write(acc_utils.convert_gap_to_text(sample_time, samples, gap_fill))
+            elif recording.kind == 'ecg':
+                ecg_utils.write_missing_to_file(current, last, missed, file)
+            else:
+                acc_utils.write_missing_to_file(current, last, missed, file)
+            sample_time = sample_time + samples * interval
+        for start in range(position, bound, block_samples):
+            block = recording.samples[start:min(start + block_samples, bound)]
+            if recording.kind == 'ecg':
+                end = start + len(block)
+                text = ecg_utils.convert_block_to_text(recording.start_epoch, sample_time,
+                                                       recording.calibration.channels(block[:, :8]),
+                                                       qrs_samples[start:end], is_qrs[start:end], block[:, 8],
+                                                       interval, ecg_utils.csv_formatter(recording.calibration))
+            else:
+                # version 1 recordings stored the accelerometer values unsigned
+                text = acc_utils.convert_block_to_text(sample_time,
+                                                       acc_utils.scale_accelerometer_frames(block.astype(np.int16)))
+            file.write(text)
+            sample_time = sample_time + len(block) * interval
+        position = bound
+
+
+def main(argv):
+    gap_fill = None
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        opts, paths = getopt.getopt(argv, "h", ["gapfill="])
+    except getopt.GetoptError:
+        logging.error(help_line)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            logging.info(help_line)
+            sys.exit()
+        elif opt == '--gapfill':
+            gap_fill = arg
+    for path in paths:
+        binary_recording = BinaryRecording(path)
+        csv_path = path[:-1] if path.endswith(('.ecgb', '.accb')) else f'{path}.csv'
+        logging.info(f'converting {path} with {len(binary_recording)} samples to {csv_path}')
+        with open(csv_path, 'w') as csv_file:
+            convert_to_csv(binary_recording, csv_file, gap_fill)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
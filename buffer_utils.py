@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class LeadRingBuffer:
+    """
+    Fixed capacity buffer that carries partial samples across packets and returns whole frames of lead values
+    """
+    __slots__ = ('frame_length', 'buffer', 'start', 'end')
+
+    def __init__(self, frame_length, capacity=4096, dtype=np.uint16):
+        """
+        :param frame_length: the number of values in a single frame
+        :param capacity: the maximum number of values kept in the buffer
+        :param dtype: the type of the buffered values
+        """
+        self.frame_length = frame_length
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def extend(self, values):
+        """
+        Appends values to the buffer. Only pending values are moved when the end of the buffer is reached.
+        :param values: the values to append
+        """
+        count = len(values)
+        if self.end + count > len(self.buffer):
+            pending = self.end - self.start
+            if pending + count > len(self.buffer):
+                raise ValueError(f'buffer capacity of {len(self.buffer)} values exceeded')
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        self.buffer[self.end:self.end + count] = values
+        self.end += count
+
+    def pop_frames(self):
+        """
+        Removes all the complete frames from the buffer
+        :return: a (frames x frame_length) view of the buffer, valid until the next call to extend
+        """
+        frames = (self.end - self.start) // self.frame_length
+        first = self.start
+        self.start += frames * self.frame_length
+        if self.start == self.end:
+            self.start = self.end = 0
+        return self.buffer[first:first + frames * self.frame_length].reshape(frames, self.frame_length)
+
+    def clear(self):
+        """
+        Drops any partial frame kept in the buffer
+        """
+        self.start = self.end = 0
@@ -0,0 +1,124 @@
+import json
+import logging
+
+import numpy as np
+
+lead_names = ('LA', 'RA', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6')
+channel_names = ('I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6')
+# after july 30 and with avr "fixed": LA, RA, RA-LA, -(LA+RA)/2, LA-RA/2, RA-LA/2 and V1-V6 as received
+default_derivation = np.array([[1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                               [0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                               [-1.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                               [-0.5, -0.5, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                               [1.0, -0.5, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                               [-0.5, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                               [0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                               [0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0],
+                               [0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0],
+                               [0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0],
+                               [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0],
+                               [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0]])
+# 12bit adc over 3.6V, in volts per count
+default_gain = np.full(12, 3600.0 / 4095 / 1000)
+# the bipolar channels are centered on the adc midpoint, aVR, aVL and aVF are not
+default_offset = np.array([-1.80043956, -1.80043956, 0.0, 0.0, 0.0, 0.0, -1.80043956, -1.80043956, -1.80043956,
+                           -1.80043956, -1.80043956, -1.80043956])
+
+
+class Calibration:
+    """
+    Derivation of the 12 ECG channels from the 8 raw leads and their conversion to volts as a single affine transform,
+    applied to a whole block of samples at once
+    """
+    __slots__ = ('name', 'derivation', 'gain', 'offset', 'channel_matrix', 'voltage_matrix', 'default_channels')
+
+    def __init__(self, name='default', derivation=None, gain=None, offset=None):
+        """
+        :param name: the name of the calibration
+        :param derivation: the (12 x 8) weights of the raw leads in each channel
+        :param gain: the volts per adc count of each channel
+        :param offset: the volts added to each channel
+        """
+        self.name = name
+        self.derivation = np.array(default_derivation if derivation is None else derivation, dtype=np.float64)
+        self.gain = np.array(default_gain if gain is None else gain, dtype=np.float64)
+        self.offset = np.array(default_offset if offset is None else offset, dtype=np.float64)
+        if self.derivation.shape != (12, 8) or self.gain.shape != (12,) or self.offset.shape != (12,):
+            raise ValueError(f'calibration {name} needs a 12x8 derivation and 12 gains and offsets')
+        # precomputed so a block takes a single matrix product
+        self.channel_matrix = np.ascontiguousarray(self.derivation.T)
+        self.voltage_matrix = self.channel_matrix * self.gain
+        # the channels of the default derivation are whole or half adc counts, any other may take any value
+        self.default_channels = np.array_equal(self.derivation, default_derivation)
+
+    def channels(self, frames):
+        """
+        :param frames: the (samples x 8) lead values
+        :return: the (samples x 12) ECG channel data
+        """
+        return frames @ self.channel_matrix
+
+    def voltages(self, frames):
+        """
+        :param frames: the (samples x 8) lead values
+        :return: the (samples x 12) channel voltages
+        """
+        voltages = frames @ self.voltage_matrix
+        voltages += self.offset
+        return voltages
+
+    @classmethod
+    def from_dict(cls, name, entry):
+        """
+        :param name: the name of the calibration
+        :param entry: the derivation, gain and offset of the calibration, the defaults are used for the missing ones
+        :return: the calibration
+        """
+        return cls(name, entry.get('derivation'), entry.get('gain'), entry.get('offset'))
+
+    def to_dict(self):
+        return {'derivation': self.derivation.tolist(), 'gain': self.gain.tolist(), 'offset': self.offset.tolist()}
+
+
+default_calibration = Calibration()
+
+
+class CalibrationTable:
+    """
+    The calibrations of the vests, chosen by device address first and by firmware revision second. The json file
+    holds the calibrations by name and the names used per device and per firmware revision:
+    {"calibrations": {"<name>": {"derivation": [...], "gain": [...], "offset": [...]}},
+     "devices": {"<address>": "<name>"}, "firmware": {"<revision>": "<name>"}}
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: the path of the json file, None for the default calibration only
+        """
+        self.path = path
+        self.calibrations = {'default': default_calibration}
+        self.devices = {}
+        self.firmware = {}
+        if path is None:
+            return
+        with open(path, 'r') as file:
+            table = json.load(file)
+        for name, entry in table.get('calibrations', {}).items():
+            self.calibrations[name] = Calibration.from_dict(name, entry)
+        self.devices = {address.upper(): name for address, name in table.get('devices', {}).items()}
+        self.firmware = dict(table.get('firmware', {}))
+        for name in list(self.devices.values()) + list(self.firmware.values()):
+            if name not in self.calibrations:
+                raise ValueError(f'unknown calibration {name} in {path}')
+
+    def lookup(self, address=None, firmware=None):
+        """
+        :param address: the address of the ECG device
+        :param firmware: the firmware revision of the ECG device
+        :return: the calibration of the device
+        """
+        name = self.devices.get((address or '').upper()) or self.firmware.get(firmware) or 'default'
+        calibration = self.calibrations[name]
+        if calibration is not default_calibration:
+            logging.info(f'using calibration {name} for {address} with firmware {firmware}')
+        return calibration
@@ -0,0 +1,56 @@
+import numpy as np
+
+# timestamps and the derived channels are multiples of 0.5, their one decimal rendering is exact
+ecg_csv_formats = ('%.1f', '%.1f', '%d', '%d', '%d', '%.1f', '%.1f', '%.1f', '%d', '%d', '%d', '%d', '%d', '%d', '%d',
+                   '%d', '%d', '%d')
+# the channels of a calibration other than the default are rendered in full, in their shortest form as str()
+calibrated_ecg_csv_formats = ecg_csv_formats[:2] + ('%r',) * 12 + ecg_csv_formats[14:]
+# the converted accelerometer values are rendered in their shortest form, same as str()
+acc_csv_formats = ('%.1f', '%r', '%r', '%r', '%r', '%r', '%r')
+csv_block_cache = 64
+
+
+class CsvBlockFormatter:
+    """
+    Renders a block of samples to csv data lines with a single format operation
+    """
+    __slots__ = ('row_format', 'block_formats')
+
+    def __init__(self, formats):
+        """
+        :param formats: the printf style format of every column
+        """
+        self.row_format = ','.join(formats) + '\n'
+        self.block_formats = {}
+
+    def block_format(self, count):
+        block_format = self.block_formats.get(count)
+        if block_format is None:
+            if len(self.block_formats) >= csv_block_cache:
+                self.block_formats.clear()
+            block_format = self.block_formats[count] = self.row_format * count
+        return block_format
+
+    def render(self, rows):
+        """
+        Renders a block of samples
+        :param rows: the (samples x columns) values
+        :return: the data lines of the samples, each terminated by a newline
+        """
+        count = len(rows)
+        if count == 0:
+            return ''
+        return self.block_format(count) % tuple(np.asarray(rows, dtype=np.float64).ravel().tolist())
+
+
+def literal_format(value):
+    """
+    :param value: a value written as given in every row, e.g. the fill of the placeholder rows of missed samples
+    :return: the format rendering the value
+    """
+    return str(value).replace('%', '%%')
+
+
+ecg_csv_formatter = CsvBlockFormatter(ecg_csv_formats)
+calibrated_ecg_csv_formatter = CsvBlockFormatter(calibrated_ecg_csv_formats)
+acc_csv_formatter = CsvBlockFormatter(acc_csv_formats)
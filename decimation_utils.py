@@ -0,0 +1,337 @@
+import numpy as np
+
+from csv_utils import CsvBlockFormatter
+from ecg_utils import convert_block_to_text, csv_formatter, sample_interval_millis
+from influx_utils import InfluxLineWriter, influx_channel_names
+from mqtt_utils import MqttBatchPublisher
+
+# taps of the anti-aliasing filter per unit of the decimation factor
+decimation_taps_per_factor = 8
+# the pass band ends below the nyquist frequency of the decimated stream
+decimation_cutoff = 0.8
+envelope_statistics = ('min', 'max', 'mean')
+envelope_measurement = 'ecg_envelope'
+envelope_field_names = tuple(f'{name}_{statistic}' for statistic in envelope_statistics
+                             for name in influx_channel_names)
+# time columns and the minimum and maximum of the derived channels are multiples of 0.5, the means are not
+envelope_csv_formatter = CsvBlockFormatter(('%.1f',) * 26 + ('%.2f',) * 12)
+adc_range = (0, 4095)
+
+
+def lowpass_taps(factor, taps_per_factor=decimation_taps_per_factor, cutoff=decimation_cutoff):
+    """
+    Designs the linear phase FIR anti-aliasing filter of a decimation, with a hamming window
+    :param factor: the decimation factor
+    :param taps_per_factor: the length of the filter per unit of the factor
+    :param cutoff: the end of the pass band as a fraction of the nyquist frequency of the decimated stream
+    :return: the filter taps with unity gain at DC, an odd number of them
+    """
+    count = taps_per_factor * factor + 1
+    n = np.arange(count) - (count - 1) / 2
+    taps = np.sinc(cutoff * n / factor) * np.hamming(count)
+    return taps / taps.sum()
+
+
+class DecimatingFir:
+    """
+    Low pass filters consecutive blocks of a multichannel signal and keeps every factor-th sample, computing the
+    filter only at the samples kept. The outputs are aligned to the input, sample k of the decimated stream is centered
+    on input sample k * factor.
+    """
+    __slots__ = ('factor', 'taps', 'state', 'phase')
+
+    def __init__(self, factor, taps=None):
+        """
+        :param factor: the decimation factor
+        :param taps: the taps of the anti-aliasing filter, designed for the factor if not given
+        """
+        self.factor = factor
+        self.taps = lowpass_taps(factor) if taps is None else np.asarray(taps, dtype=np.float64)
+        self.state = None
+        self.phase = self.delay
+
+    @property
+    def delay(self):
+        return (len(self.taps) - 1) // 2
+
+    def process(self, block):
+        """
+        Filters and decimates the next block of the signal
+        :param block: the (samples x channels) block
+        :return: the (outputs x channels) decimated samples and the index in the block of the last input of each
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if self.state is None:
+            # start from a steady signal instead of a step from zero
+            self.state = np.repeat(block[:1], len(self.taps) - 1, axis=0)
+        extended = np.concatenate((self.state, block))
+        self.state = extended[len(block):]
+        positions = np.arange(self.phase, len(block), self.factor)
+        self.phase = self.phase - len(block) if len(positions) == 0 else positions[-1] + self.factor - len(block)
+        if len(positions) == 0:
+            return np.empty((0, block.shape[1])), positions
+        windows = np.lib.stride_tricks.sliding_window_view(extended, len(self.taps), axis=0)[positions]
+        return windows @ self.taps, positions
+
+    def skip(self, sample_count):
+        """
+        Restarts the filter after missed samples, keeping the outputs on the grid of the recording
+        :param sample_count: the number of samples missed
+        """
+        self.state = None
+        # the next output is centered on the next sample of the grid, once the filter has its inputs
+        self.phase = self.delay + (self.phase - self.delay - sample_count) % self.factor
+
+
+class EnvelopeAccumulator:
+    """
+    Reduces a multichannel signal to the minimum, maximum and mean of consecutive windows of factor samples. Only the
+    window in progress is kept between blocks.
+    """
+    __slots__ = ('factor', 'count', 'valid', 'minimum', 'maximum', 'total')
+
+    def __init__(self, factor):
+        """
+        :param factor: the number of samples of a window
+        """
+        self.factor = factor
+        self.count = 0
+        self.valid = True
+        self.minimum = self.maximum = self.total = None
+
+    def process(self, block):
+        """
+        Adds the next block of the signal
+        :param block: the (samples x channels) block
+        :return: the (windows x 3*channels) minimum, maximum and mean of the windows completed, and the index in the
+        block of the first sample of the first of them, negative if it started in an earlier block
+        """
+        completed = []
+        first = None
+        head = 0
+        if self.count > 0:
+            head = min(len(block), self.factor - self.count)
+            start = -self.count
+            self.add(block[:head])
+            if self.count == self.factor:
+                if self.valid:
+                    completed.append(np.concatenate((self.minimum, self.maximum, self.total / self.factor)))
+                    first = start
+                self.count = 0
+                self.valid = True
+                self.minimum = None
+        whole = (len(block) - head) // self.factor
+        if whole > 0:
+            windows = block[head:head + whole * self.factor].reshape(whole, self.factor, -1)
+            completed.extend(np.concatenate((windows.min(axis=1), windows.max(axis=1), windows.mean(axis=1)), axis=1))
+            first = head if first is None else first
+        tail = block[head + whole * self.factor:]
+        if len(tail) > 0:
+            self.add(tail)
+        if len(completed) == 0:
+            return np.empty((0, 3 * block.shape[1])), 0
+        return np.array(completed), first
+
+    def add(self, block):
+        """
+        Adds samples to the window in progress
+        :param block: the (samples x channels) samples, no more than the window has left
+        """
+        if self.minimum is None:
+            self.minimum = block.min(axis=0)
+            self.maximum = block.max(axis=0)
+            self.total = block.sum(axis=0, dtype=np.float64)
+        else:
+            self.minimum = np.minimum(self.minimum, block.min(axis=0))
+            self.maximum = np.maximum(self.maximum, block.max(axis=0))
+            self.total = self.total + block.sum(axis=0, dtype=np.float64)
+        self.count += len(block)
+
+    def skip(self, sample_count):
+        """
+        Drops the window in progress after missed samples, keeping the windows on the grid of the recording
+        :param sample_count: the number of samples missed
+        """
+        self.count = (self.count + sample_count) % self.factor
+        # a window missing samples is not reported
+        self.valid = self.count == 0
+        self.minimum = None
+
+
+class DecimationStage:
+    """
+    The decimated stream and the envelope stream of a recording at a single decimation factor, sent to the outputs
+    that chose this resolution
+    """
+
+    def __init__(self, factor):
+        """
+        :param factor: the decimation factor
+        """
+        self.factor = factor
+        self.interval = sample_interval_millis * factor
+        self.mqtt_publisher = self.envelope_publisher = self.influxdb_writer = self.envelope_writer = None
+        self.leads = DecimatingFir(factor)
+        self.channel_envelope = self.voltage_envelope = None
+        # R peaks since the last decimated sample
+        self.beats = 0
+
+    def add_block(self, start_time, sample_time, frames, qrs_samples, is_qrs, heart_rate, rr_millis, battery,
+                  calibration):
+        """
+        Adds the samples of a packet
+        :param start_time: the start of the recording
+        :param sample_time: the timestamp of the first sample of the packet
+        :param frames: the (samples x 8) lead values
+        :param qrs_samples: the current qrs duration in samples, per sample
+        :param is_qrs: the flag that shows if a sample is the spike of the QRS complex, per sample
+        :param heart_rate: the current heart rate in bpm, per sample
+        :param rr_millis: the current RR interval in milliseconds, per sample
+        :param battery: the battery of the ECG device
+        :param calibration: the calibration of the ECG device
+        """
+        if len(frames) == 0:
+            return
+        leads, positions = self.leads.process(frames)
+        beats = np.cumsum(is_qrs) + self.beats
+        self.beats = int(beats[-1])
+        if len(positions) > 0:
+            # the rounded leads keep the adc resolution and the csv layout of the full rate stream
+            leads = np.clip(np.round(leads), *adc_range)
+            output_time = sample_time + (positions - self.leads.delay) * sample_interval_millis
+            if self.mqtt_publisher is not None:
+                if self.mqtt_publisher.is_text:
+                    beat_counts = beats[positions]
+                    beat_flags = np.diff(beat_counts, prepend=0) > 0
+                    text = convert_block_to_text(start_time, output_time[0], calibration.channels(leads),
+                                                 qrs_samples[positions], beat_flags, battery, self.interval,
+                                                 csv_formatter(calibration))
+                    self.mqtt_publisher.add_text(text)
+                else:
+                    self.mqtt_publisher.add_samples(start_time, output_time[0], leads.astype(np.uint16))
+            if self.influxdb_writer is not None:
+                self.influxdb_writer.add_block(start_time, output_time[0], calibration.voltages(leads), self.interval,
+                                               heart_rate[positions], rr_millis[positions])
+            self.beats -= int(beats[positions[-1]])
+        if self.channel_envelope is not None:
+            envelope, first = self.channel_envelope.process(calibration.channels(frames))
+            if len(envelope) > 0:
+                window_time = sample_time + first * sample_interval_millis
+                self.publish_envelope(start_time, window_time, envelope)
+        if self.voltage_envelope is not None:
+            envelope, first = self.voltage_envelope.process(calibration.voltages(frames))
+            if len(envelope) > 0:
+                window_time = sample_time + first * sample_interval_millis
+                self.envelope_writer.add_block(start_time, window_time, envelope, self.interval, heart_rate[-1],
+                                               rr_millis[-1])
+
+    def publish_envelope(self, start_time, window_time, envelope):
+        """
+        Hands the envelope of completed windows to the mqtt publisher
+        :param start_time: the start of the recording
+        :param window_time: the timestamp of the first sample of the first window
+        :param envelope: the (windows x 36) minimum, maximum and mean of the 12 channels
+        """
+        if self.envelope_publisher.is_text:
+            rows = np.empty((len(envelope), envelope.shape[1] + 2))
+            rows[:, 1] = window_time + np.arange(len(envelope)) * self.interval
+            rows[:, 0] = start_time + rows[:, 1]
+            rows[:, 2:] = envelope
+            self.envelope_publisher.add_text(envelope_csv_formatter.render(rows))
+        else:
+            self.envelope_publisher.add_samples(start_time, window_time, envelope)
+
+    def skip(self, sample_count):
+        """
+        Restarts the filters and the envelopes after missed samples
+        :param sample_count: the number of samples missed
+        """
+        self.leads.skip(sample_count)
+        for envelope in (self.channel_envelope, self.voltage_envelope):
+            if envelope is not None:
+                envelope.skip(sample_count)
+        self.beats = 0
+
+    def flush(self):
+        for output in (self.mqtt_publisher, self.envelope_publisher, self.influxdb_writer, self.envelope_writer):
+            if output is not None:
+                output.flush()
+
+    def close(self):
+        """
+        Flushes the publishers and closes the influxdb writers
+        """
+        self.flush()
+        for writer in (self.influxdb_writer, self.envelope_writer):
+            if writer is not None:
+                writer.close()
+
+
+class DecimationStages:
+    """
+    The decimation stages of a recording, one per decimation factor chosen by an output
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def __len__(self):
+        return len(self.stages)
+
+    def stage(self, factor):
+        """
+        :param factor: the decimation factor
+        :return: the stage of the factor, created on first use
+        """
+        if factor not in self.stages:
+            self.stages[factor] = DecimationStage(factor)
+        return self.stages[factor]
+
+    def add_mqtt(self, factor, mqtt_client, mqtt_topic, payload_format='csv', window_millis=0):
+        """
+        Publishes the ecg samples decimated by a factor to a topic, and their envelope to its envelope subtopic
+        :param factor: the decimation factor
+        :param mqtt_client: the mqtt client to send the data
+        :param mqtt_topic: the mqtt topic of the decimated ecg samples
+        :param payload_format: the format of the messages (csv, binary, msgpack or cbor)
+        :param window_millis: the time to collect samples for before publishing, 0 publishes every packet
+        """
+        stage = self.stage(factor)
+        stage.mqtt_publisher = MqttBatchPublisher(mqtt_client, mqtt_topic, stage.interval, payload_format,
+                                                  window_millis)
+        stage.envelope_publisher = MqttBatchPublisher(mqtt_client, f'{mqtt_topic}/envelope', stage.interval,
+                                                      payload_format, window_millis)
+        stage.channel_envelope = EnvelopeAccumulator(factor)
+
+    def add_influxdb(self, factor, influxdb_api, influxdb_bucket, address=None):
+        """
+        Writes the ecg voltages decimated by a factor to influxdb, and their envelope to the envelope measurement
+        :param factor: the decimation factor
+        :param influxdb_api: the influxdb write api to append the data
+        :param influxdb_bucket: the influxdb bucket to append the data
+        :param address: the address of the ECG device, the device tag of the samples
+        """
+        stage = self.stage(factor)
+        stage.influxdb_writer = InfluxLineWriter(influxdb_api, influxdb_bucket, address=address)
+        stage.envelope_writer = InfluxLineWriter(influxdb_api, influxdb_bucket, measurement=envelope_measurement,
+                                                 field_names=envelope_field_names, address=address)
+        stage.voltage_envelope = EnvelopeAccumulator(factor)
+
+    def add_block(self, *args):
+        """
+        Adds the samples of a packet to every stage, see DecimationStage.add_block
+        """
+        for stage in self.stages.values():
+            stage.add_block(*args)
+
+    def skip(self, sample_count):
+        for stage in self.stages.values():
+            stage.skip(sample_count)
+
+    def flush(self):
+        for stage in self.stages.values():
+            stage.flush()
+
+    def close(self):
+        for stage in self.stages.values():
+            stage.close()
@@ -1,8 +1,19 @@
 import logging
 import asyncio
 import time
-from ecg_utils import process_ecg_data, process_battery_data, set_battery
-from acc_utils import process_accelerometer_data
+from contextlib import ExitStack
+from acc_utils import sample_interval_millis as acc_interval_millis
+from ecg_utils import set_battery, sample_interval_millis
+from session_utils import RecordingSession
+from binary_utils import open_ecg_binary_file, open_acc_binary_file
+from decimation_utils import DecimationStages
+from mqtt_utils import MqttBatchPublisher
+from influx_utils import InfluxLineWriter
+from journal_utils import JournalWriter, journal_extension
+from pipeline_utils import RecordingPipeline
+from ring_utils import LiveRingWriter
+from store_utils import RecordingStore, recording_stores
+from segment_utils import SegmentWriter, check_compression
 from bleak import BleakClient
 
 battery_service_uuid = '0000180f-0000-1000-8000-00805f9b34fb'
@@ -10,63 +21,292 @@ name_service_uuid = '0000180a-0000-1000-8000-00805f9b34fb'
 data_service_uuid = '87301801-d487-4fa7-960c-27955f3e4c2c'
 
 battery_c_uuid = '00002a19-0000-1000-8000-00805f9b34fb'
+firmware_revision_c_uuid = '00002a26-0000-1000-8000-00805f9b34fb'
 cardio_command_c_uuid = '87301803-d487-4fa7-960c-27955f3e4c2c'
 cardio_datastream_c_uuid = '87301805-d487-4fa7-960c-27955f3e4c2c'
 cardio_accelerometer_ch_uuid = '87301807-d487-4fa7-960c-27955f3e4c2c'
 cardio_features_c_uuid = '8730180c-d487-4fa7-960c-27955f3e4c2c'
 
+reconnect_initial_delay = 0.1
+reconnect_max_delay = 30.0
+
 
 async def connect(d, bluetooth_device=None, record_ecg=True, record_acc=False, record_time=None, mqtt_client=None,
-                  mqtt_topic=None, influxdb_api=None, influxdb_bucket=None):
+                  mqtt_topic=None, influxdb_api=None, influxdb_bucket=None, file_prefix='', file_format='csv',
+                  mqtt_format='csv', mqtt_window=0, queue_size=1000, queue_policy='drop_oldest', gap_fill=None,
+                  file_buffer_size=-1, segment_seconds=None, segment_bytes=None, compression='none',
+                  reconnect=True, journal=False, calibrations=None, mqtt_decimation=1, influxdb_decimation=1,
+                  ring_seconds=None, store_bytes=None, cache=None, client_class=BleakClient):
     """
     Connects to the ECG device and records an ECG recording
     :param d: the ECG device
     :param bluetooth_device: the bluetooth device to use
     :param record_ecg: whether to record ECG data or not
     :param record_acc: whether to record ACC data or not
-    :param record_time: the duration of the recording
+    :param record_time: the duration of the recording, None to record until cancelled
     :param mqtt_client: the mqtt client to send the data
     :param mqtt_topic: the mqtt topic to send the data
     :param influxdb_api: the influxdb write api to append the data
     :param influxdb_bucket: the influxdb bucket to append the data
+    :param file_prefix: the prefix of the recording's file names
+    :param file_format: the format of the recording's files (csv, binary or raw to only keep the journal)
+    :param mqtt_format: the format of the mqtt messages (csv, binary, msgpack or cbor)
+    :param mqtt_window: the time in milliseconds to collect samples for before publishing, 0 publishes every packet
+    :param queue_size: the maximum number of items kept in each queue of the recording pipeline
+    :param queue_policy: what to do when a network sink falls behind (drop_newest, drop_oldest or block)
+    :param gap_fill: the value of the placeholder rows written for missed samples, None to only report the gaps
+    :param file_buffer_size: the buffer size in bytes of the csv files, -1 for the default of the platform
+    :param segment_seconds: the duration of a csv file segment in seconds, None to not rotate by duration
+    :param segment_bytes: the size of a csv file segment on disk in bytes, None to not rotate by size
+    :param compression: the compression of the csv file segments (none, gzip, zstd or lz4)
+    :param reconnect: whether to reconnect when the link drops, continuing the same recording
+    :param journal: whether to append the raw notifications to a journal, which can be decoded offline
+    :param calibrations: the calibration table to choose the calibration of the device from, by address or firmware
+    :param mqtt_decimation: the decimation factor of the ecg samples sent to mqtt, along with their envelope
+    :param influxdb_decimation: the decimation factor of the ecg samples written to influxdb, along with their envelope
+    :param ring_seconds: the seconds of voltages kept in a shared memory ring for the local consumers, None for no ring
+    :param store_bytes: the budget in bytes of the recent samples kept in recording_stores, None to not keep them
+    :param cache: the device cache the device is remembered in whenever it connects
+    :param client_class: the bluetooth client implementation, BleakClient or a stand-in
+    :return: whether the device was connected
     """
     logging.info(f'record_time={record_time}')
-    client = BleakClient(d.address, device=bluetooth_device)
+    check_compression(compression)
+    segmented = segment_seconds is not None or segment_bytes is not None or compression != 'none'
+    session = RecordingSession(d.address, gap_fill)
+    decimation = DecimationStages()
+    ecg_publisher = acc_publisher = None
+    if mqtt_client is not None:
+        if mqtt_decimation > 1:
+            decimation.add_mqtt(mqtt_decimation, mqtt_client, f'{mqtt_topic}/ecg', mqtt_format, mqtt_window)
+        else:
+            ecg_publisher = MqttBatchPublisher(mqtt_client, f'{mqtt_topic}/ecg', sample_interval_millis, mqtt_format,
+                                               mqtt_window)
+        acc_publisher = MqttBatchPublisher(mqtt_client, f'{mqtt_topic}/acc', acc_interval_millis, mqtt_format,
+                                           mqtt_window)
+    store = None
+    if store_bytes is not None:
+        store = recording_stores[d.address] = RecordingStore(d.address, store_bytes)
+    influxdb_writer = None
+    if influxdb_api is not None and influxdb_bucket is not None:
+        if influxdb_decimation > 1:
+            decimation.add_influxdb(influxdb_decimation, influxdb_api, influxdb_bucket, d.address)
+        else:
+            influxdb_writer = InfluxLineWriter(influxdb_api, influxdb_bucket, address=d.address)
+    loop = asyncio.get_running_loop()
+    disconnected = asyncio.Event()
+
+    def disconnected_callback(disconnected_client):
+        loop.call_soon_threadsafe(disconnected.set)
+
+    client = client_class(d.address, device=bluetooth_device, disconnected_callback=disconnected_callback)
+    connected = False
     try:
         await client.connect()
-        filename = f'{int(round(time.time()))}'
-        with open(f'{filename}.ecg', "w") as ecg_file, open(f'{filename}.acc', "w") as acc_file:
-            battery_bytes = await client.read_gatt_char(battery_c_uuid)
-            received_battery = int.from_bytes(battery_bytes, "big")
-            set_battery(received_battery)
-
-            def battery_callback(sender, data):
-                process_battery_data(data)
-
-            def data_callback(sender, data):
-                process_ecg_data(data, file=ecg_file, mqtt_client=mqtt_client, mqtt_topic=mqtt_topic,
-                                 influxdb_api=influxdb_api, influxdb_bucket=influxdb_bucket)
-
-            def acc_callback(sender, data):
-                process_accelerometer_data(data, file=acc_file, mqtt_client=mqtt_client, mqtt_topic=mqtt_topic)
-
-            await client.start_notify(battery_c_uuid, battery_callback)
-            if record_ecg:
-                await client.write_gatt_char(cardio_command_c_uuid, data=bytes((2,)))
-            if record_acc:
-                await client.write_gatt_char(cardio_command_c_uuid, data=bytes((6,)))
-            await client.start_notify(cardio_datastream_c_uuid, data_callback)
-            await client.start_notify(cardio_accelerometer_ch_uuid, acc_callback)
+        connected = True
+        remember_device(cache, d)
+        firmware = None
+        if calibrations is not None:
+            firmware = await read_firmware_revision(client)
+            session.calibration = calibrations.lookup(d.address, firmware)
+        filename = f'{file_prefix}{int(round(time.time()))}'
+        with ExitStack() as files:
+            ecg_file = acc_file = ecg_binary_file = acc_binary_file = journal_writer = None
+            if journal or file_format == 'raw':
+                journal_writer = files.enter_context(JournalWriter(f'{filename}.{journal_extension}', d.address,
+                                                                   file_buffer_size))
+            if file_format == 'raw':
+                if segmented:
+                    logging.warning('segments and compression only apply to csv files')
+            elif file_format == 'binary':
+                if segmented:
+                    logging.warning('segments and compression only apply to csv files')
+                ecg_binary_file = files.enter_context(open_ecg_binary_file(filename, d.address, session.calibration,
+                                                                             firmware))
+                acc_binary_file = files.enter_context(open_acc_binary_file(filename, d.address))
+            elif segmented:
+                ecg_file = files.enter_context(SegmentWriter(filename, 'ecg', segment_seconds, segment_bytes,
+                                                             compression, file_buffer_size))
+                acc_file = files.enter_context(SegmentWriter(filename, 'acc', segment_seconds, segment_bytes,
+                                                             compression, file_buffer_size))
+            else:
+                ecg_file = files.enter_context(open(f'{filename}.ecg', "w", buffering=file_buffer_size))
+                acc_file = files.enter_context(open(f'{filename}.acc', "w", buffering=file_buffer_size))
+            ring = None
+            if ring_seconds is not None:
+                sample_rate = 1000.0 / sample_interval_millis
+                ring = files.enter_context(LiveRingWriter(d.address, int(ring_seconds * sample_rate),
+                                                          sample_rate=sample_rate))
+
+            pipeline = RecordingPipeline(session,
+                                         dict(file=ecg_file, mqtt_publisher=ecg_publisher,
+                                              influxdb_writer=influxdb_writer, binary_file=ecg_binary_file,
+                                              decimation=decimation if len(decimation) > 0 else None, ring=ring,
+                                              store=store),
+                                         dict(file=acc_file, mqtt_publisher=acc_publisher, binary_file=acc_binary_file,
+                                              store=store),
+                                         maxsize=queue_size, policy=queue_policy, journal=journal_writer,
+                                         decode=file_format != 'raw' or mqtt_client is not None or
+                                         influxdb_writer is not None or len(decimation) > 0 or ring is not None or
+                                         store is not None)
+            # stop the pipeline before the files are closed
+            files.callback(pipeline.close)
+            if journal_writer is not None and firmware is not None:
+                journal_writer.append('firmware', firmware.encode())
+
+            await start_streams(client, session, pipeline, record_ecg, record_acc)
             start = time.time()
-            logging.info(f'recording for {record_time} seconds, time={time.time()}')
-            await asyncio.sleep(record_time)
+            deadline = None if record_time is None else loop.time() + record_time
+            if record_time is None:
+                # the open segment is finalized when the recording task is cancelled
+                logging.info(f'recording until stopped, time={time.time()}')
+            else:
+                logging.info(f'recording for {record_time} seconds, time={time.time()}')
+            while await wait_for_disconnect(client, disconnected, deadline):
+                if not reconnect:
+                    logging.error(f'disconnected from {d.address}')
+                    break
+                logging.warning(f'disconnected from {d.address}, reconnecting')
+                client = await reconnect_client(d, bluetooth_device, client_class, disconnected_callback,
+                                                disconnected, session, pipeline, record_ecg, record_acc, deadline)
+                if client is None:
+                    break
+                remember_device(cache, d)
             logging.info(f'stopped at time={time.time() - start}')
-            if record_ecg:
-                await client.write_gatt_char(cardio_command_c_uuid, data=bytes((3,)))
-            if record_acc:
-                await client.write_gatt_char(cardio_command_c_uuid, data=bytes((7,)))
+            if client is not None and client.is_connected:
+                if record_ecg:
+                    await client.write_gatt_char(cardio_command_c_uuid, data=bytes((3,)))
+                if record_acc:
+                    await client.write_gatt_char(cardio_command_c_uuid, data=bytes((7,)))
 
     except Exception as e:
         logging.error(e)
     finally:
-        await client.disconnect()
+        if client is not None:
+            await client.disconnect()
+        if ecg_publisher is not None:
+            ecg_publisher.flush()
+        if acc_publisher is not None:
+            acc_publisher.flush()
+        if influxdb_writer is not None:
+            influxdb_writer.close()
+        decimation.close()
+        if store is not None and recording_stores.get(d.address) is store:
+            del recording_stores[d.address]
+    return connected
+
+
+def remember_device(cache, d):
+    """
+    Refreshes the last time a device was seen in the device cache, once it connected
+    :param cache: the device cache, None if there is none
+    :param d: the ECG device
+    """
+    if cache is not None:
+        cache.remember(d)
+        cache.save()
+
+
+async def read_firmware_revision(client):
+    """
+    Reads the firmware revision of a connected device
+    :param client: the connected bluetooth client
+    :return: the firmware revision, None if the device does not report it
+    """
+    try:
+        revision = await client.read_gatt_char(firmware_revision_c_uuid)
+    except Exception as e:
+        logging.warning(f'failed to read the firmware revision: {e}')
+        return None
+    revision = bytes(revision).decode(errors='replace').strip('\0 ')
+    logging.info(f'firmware revision: {revision}')
+    return revision or None
+
+
+async def start_streams(client, session, pipeline, record_ecg=True, record_acc=False):
+    """
+    Reads the battery level, issues the start commands and subscribes to the notifications of a connected device
+    :param client: the connected bluetooth client
+    :param session: the recording session of the ECG device
+    :param pipeline: the recording pipeline receiving the notifications
+    :param record_ecg: whether to record ECG data or not
+    :param record_acc: whether to record ACC data or not
+    """
+    battery_bytes = await client.read_gatt_char(battery_c_uuid)
+    received_battery = int.from_bytes(battery_bytes, "big")
+    set_battery(session, received_battery)
+    if pipeline.journal is not None:
+        pipeline.journal.append('level', battery_bytes)
+    await client.start_notify(battery_c_uuid, pipeline.battery_callback)
+    if record_ecg:
+        await client.write_gatt_char(cardio_command_c_uuid, data=bytes((2,)))
+    if record_acc:
+        await client.write_gatt_char(cardio_command_c_uuid, data=bytes((6,)))
+    await client.start_notify(cardio_datastream_c_uuid, pipeline.ecg_callback)
+    await client.start_notify(cardio_accelerometer_ch_uuid, pipeline.acc_callback)
+
+
+async def wait_for_disconnect(client, disconnected, deadline=None):
+    """
+    Waits until the device disconnects or the recording time is over
+    :param client: the connected bluetooth client
+    :param disconnected: the event set when the device disconnects
+    :param deadline: the event loop time the recording ends at, None to record until cancelled
+    :return: whether the device disconnected
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        timeout = None if deadline is None else deadline - loop.time()
+        if timeout is not None and timeout <= 0:
+            return False
+        try:
+            await asyncio.wait_for(disconnected.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        disconnected.clear()
+        # a late callback of a failed reconnect attempt
+        if not client.is_connected:
+            return True
+
+
+async def reconnect_client(d, bluetooth_device, client_class, disconnected_callback, disconnected, session, pipeline,
+                           record_ecg=True, record_acc=False, deadline=None):
+    """
+    Reconnects to a device with exponential backoff and resumes its notifications. The recording continues in the
+    same session and pipeline, the samples missed while disconnected are accounted for from the wall clock.
+    :param d: the ECG device
+    :param bluetooth_device: the bluetooth device to use
+    :param client_class: the bluetooth client implementation, BleakClient or a stand-in
+    :param disconnected_callback: the callback of the client when the device disconnects
+    :param disconnected: the event set when the device disconnects
+    :param session: the recording session of the ECG device
+    :param pipeline: the recording pipeline receiving the notifications
+    :param record_ecg: whether to record ECG data or not
+    :param record_acc: whether to record ACC data or not
+    :param deadline: the event loop time the recording ends at, None to retry until cancelled
+    :return: the connected client, None if the recording time ended first
+    """
+    loop = asyncio.get_running_loop()
+    delay = reconnect_initial_delay
+    attempt = 0
+    start = loop.time()
+    while deadline is None or loop.time() < deadline:
+        attempt += 1
+        disconnected.clear()
+        client = client_class(d.address, device=bluetooth_device, disconnected_callback=disconnected_callback)
+        try:
+            await client.connect()
+            pipeline.resume()
+            await start_streams(client, session, pipeline, record_ecg, record_acc)
+            logging.info(f'reconnected to {d.address} after {attempt} attempts in {loop.time() - start:.2f} seconds')
+            return client
+        except Exception as e:
+            logging.warning(f'reconnect attempt {attempt} to {d.address} failed: {e}')
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+        wait = delay if deadline is None else min(delay, deadline - loop.time())
+        await asyncio.sleep(max(0.0, wait))
+        delay = min(delay * 2, reconnect_max_delay)
+    return None
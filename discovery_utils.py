@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from bleak import BleakScanner
+
+
+class CachedDevice:
+    """
+    A device known from the address cache, connected to without waiting for its advertisement
+    """
+
+    def __init__(self, address, name=None):
+        self.address = address
+        self.name = name
+        self.rssi = None
+        self.metadata = {'uuids': []}
+
+
+class DeviceCache:
+    """
+    Persistent cache of the addresses of the vests seen, most recently seen first
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the path of the json file of the cache
+        """
+        self.path = path
+        self.devices = {}
+        try:
+            with open(path, 'r') as file:
+                self.devices = json.load(file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f'ignoring device cache {path}: {e}')
+
+    def remember(self, device):
+        """
+        Adds or refreshes a device in the cache
+        :param device: the device seen or connected to
+        """
+        # a device connected to by its address may not carry its name
+        name = device.name or self.devices.get(device.address, {}).get('name')
+        self.devices[device.address] = {'name': name, 'last_seen': time.time()}
+
+    def find(self, device_name=None, device_address=None, count=1):
+        """
+        Looks up the cached devices matching a name or an address
+        :param device_name: the name of the devices, used if no address is given
+        :param device_address: the address of the device
+        :param count: the maximum number of devices to return
+        :return: the matching devices, most recently seen first
+        """
+        matching = [(entry['last_seen'], address, entry['name']) for address, entry in self.devices.items()
+                    if device_matches(entry['name'], address, device_name, device_address)]
+        return [CachedDevice(address, name) for _, address, name in sorted(matching, reverse=True)[:count]]
+
+    def save(self):
+        try:
+            with open(f'{self.path}.tmp', 'w') as file:
+                json.dump(self.devices, file)
+            os.replace(f'{self.path}.tmp', self.path)
+        except OSError as e:
+            logging.error(f'failed to write device cache to {self.path}: {e}')
+
+
+def device_matches(name, address, device_name=None, device_address=None):
+    """
+    :param name: the name of a device
+    :param address: the address of a device
+    :param device_name: the name of the devices to record, used if no address is given
+    :param device_address: the address of the device to record
+    :return: whether the device is one to record
+    """
+    if device_address is not None:
+        return address is not None and address == device_address
+    return name is not None and name == device_name
+
+
+async def scan_devices(device_name=None, device_address=None, count=1, scan_time=5.0, exclude=(),
+                       scanner_class=BleakScanner, cache=None):
+    """
+    Scans for the devices to record, returning as soon as enough of them are detected
+    :param device_name: the name of the devices, used if no address is given
+    :param device_address: the address of the device
+    :param count: the number of devices to find, None to scan for the whole scan time
+    :param scan_time: the maximum time to scan for in seconds
+    :param exclude: the addresses of devices to ignore, e.g. the ones already recording
+    :param scanner_class: the bluetooth scanner implementation, BleakScanner or a stand-in
+    :param cache: the device cache to add the detected devices to
+    :return: the detected devices in the order they were detected
+    """
+    found = {}
+    done = asyncio.Event()
+
+    def detection_callback(device, advertisement_data):
+        if device.address in found or device.address in exclude:
+            return
+        # the name may only be in the advertisement data until the device is resolved
+        name = device.name or getattr(advertisement_data, 'local_name', None)
+        if device_matches(name, device.address, device_name, device_address):
+            found[device.address] = device
+            if count is not None and len(found) >= count:
+                done.set()
+
+    scanner = scanner_class(detection_callback=detection_callback)
+    start = time.monotonic()
+    await scanner.start()
+    try:
+        await asyncio.wait_for(done.wait(), scan_time)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        await scanner.stop()
+    logging.info(f'found {len(found)} devices in {time.monotonic() - start:.2f} seconds')
+    if cache is not None and len(found) > 0:
+        for device in found.values():
+            cache.remember(device)
+        cache.save()
+    return list(found.values())
+
+
+async def find_devices(device_name=None, device_address=None, count=1, scan_time=5.0, scanner_class=BleakScanner,
+                       cache=None):
+    """
+    Finds the devices to record, from the device cache first and then by scanning for the rest
+    :param device_name: the name of the devices, used if no address is given
+    :param device_address: the address of the device
+    :param count: the number of devices to find
+    :param scan_time: the maximum time to scan for in seconds
+    :param scanner_class: the bluetooth scanner implementation, BleakScanner or a stand-in
+    :param cache: the device cache, None to always scan
+    :return: the devices found
+    """
+    devices = cache.find(device_name, device_address, count) if cache is not None else []
+    if len(devices) > 0:
+        logging.info(f'using cached devices {[device.address for device in devices]}')
+    if len(devices) < count:
+        devices.extend(await scan_devices(device_name, device_address, count - len(devices), scan_time,
+                                          [device.address for device in devices], scanner_class, cache))
+    return devices
+
+
+async def scan_replacement(device, active, device_name=None, device_address=None, scan_time=5.0,
+                           scanner_class=BleakScanner, cache=None):
+    """
+    Scans for a device to record instead of a cached device that could not be connected to, e.g. a vest seen last
+    time that is not around while another one is advertising
+    :param device: the device that could not be connected to
+    :param active: the addresses of the devices recording
+    :param device_name: the name of the devices, used if no address is given
+    :param device_address: the address of the device
+    :param scan_time: the maximum time to scan for in seconds
+    :param scanner_class: the bluetooth scanner implementation, BleakScanner or a stand-in
+    :param cache: the device cache to add the detected devices to
+    :return: the device found advertising, None if the device was not cached or none was found
+    """
+    if not isinstance(device, CachedDevice):
+        return None
+    logging.warning(f'failed to connect to cached device {device.address}, scanning for one advertising')
+    devices = await scan_devices(device_name, device_address, 1, scan_time, set(active), scanner_class, cache)
+    return devices[0] if len(devices) > 0 else None
+
+
+async def rescan_devices(start_session, active, device_name=None, device_address=None, interval=30.0, scan_time=5.0,
+                         scanner_class=BleakScanner, cache=None):
+    """
+    Scans for new devices in the background while the existing sessions keep recording
+    :param start_session: called with every new device found
+    :param active: the addresses of the devices recording
+    :param device_name: the name of the devices, used if no address is given
+    :param device_address: the address of the device
+    :param interval: the time between scans in seconds
+    :param scan_time: the time to scan for in seconds
+    :param scanner_class: the bluetooth scanner implementation, BleakScanner or a stand-in
+    :param cache: the device cache to add the detected devices to
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            devices = await scan_devices(device_name, device_address, None, scan_time, set(active), scanner_class,
+                                         cache)
+        except Exception as e:
+            logging.error(f'rescan failed: {e}')
+            continue
+        for device in devices:
+            if device.address not in active:
+                logging.info(f'found new device {device.name}[{device.address}]')
+                start_session(device)
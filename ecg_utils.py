@@ -2,15 +2,13 @@ import logging
 import numpy as np
 import datetime
 
-int_values = []
-single_sample_length = 8
-sample_interval_millis = 1000.0 / 500.0
-
-received_battery = 0
+from csv_utils import CsvBlockFormatter, calibrated_ecg_csv_formatter, ecg_csv_formats, ecg_csv_formatter, \
+    literal_format
+from sequence_utils import packet_duplicate, packet_late, packet_resumed
+from session_utils import single_sample_length
 
-last_packet_received = -1
-recording_start = -1
-recording_timestamp = -1
+ecg_header_len = 5
+sample_interval_millis = 1000.0 / 500.0
 
 
 def convert_sample_to_line(start_time, sample_time, channel_data, avg_qrs=0, avg_qrs_millis=0, is_qrs=0, battery=0,
@@ -34,6 +32,40 @@ def convert_sample_to_line(start_time, sample_time, channel_data, avg_qrs=0, avg
     return line
 
 
+def csv_formatter(calibration):
+    """
+    :param calibration: the calibration the channels are derived with
+    :return: the formatter of the data lines, which renders the channels of any calibration but the default in full
+    instead of truncating them to the integral columns of the default
+    """
+    return ecg_csv_formatter if calibration.default_channels else calibrated_ecg_csv_formatter
+
+
+def convert_block_to_text(start_time, sample_time, channels, qrs_samples, is_qrs, battery=0,
+                          interval=sample_interval_millis, formatter=ecg_csv_formatter):
+    """
+    Convert a block of ecg samples to data lines, same as convert_sample_to_line for every sample
+    :param start_time: the start of the recording
+    :param sample_time: the timestamp of the first sample of the block
+    :param channels: the (samples x 12) ECG channel data
+    :param qrs_samples: the current qrs duration in samples, per sample
+    :param is_qrs: the flag that shows if a sample is the spike of the QRS complex, per sample
+    :param battery: the battery of the ECG device
+    :param interval: the interval between the samples in milliseconds
+    :param formatter: the formatter of the data lines, see csv_formatter
+    :return: the data lines of the block, each terminated by a newline
+    """
+    rows = np.empty((len(channels), 18))
+    rows[:, 1] = sample_time + np.arange(len(channels)) * interval
+    rows[:, 0] = start_time + rows[:, 1]
+    rows[:, 2:14] = channels
+    rows[:, 14] = qrs_samples
+    rows[:, 15] = np.round(qrs_samples * sample_interval_millis)
+    rows[:, 16] = is_qrs
+    rows[:, 17] = battery
+    return formatter.render(rows)
+
+
 def write_sample_to_file(data_line, file=None):
     """
     Write a sample's data to the recording's file
@@ -44,15 +76,30 @@ def write_sample_to_file(data_line, file=None):
         file.write(data_line + '\n')
 
 
-def write_sample_to_mqtt(data_line, mqtt_client=None, mqtt_topic=None):
+def write_block_to_file(data_text, file=None):
     """
-    Write a sample's data to the recording's file
-    :param data_line: the line of data to publish
-    :param mqtt_client: the mqtt client to send the data
-    :param mqtt_topic: the mqtt topic to send the data
+    Write the data lines of a block of samples to the recording's file in a single write
+    :param data_text: the data lines to store, each terminated by a newline
+    :param file: the file where data are stored
+    """
+    if file is not None and len(data_text) > 0:
+        file.write(data_text)
+
+
+def write_packet_to_mqtt(start_time, sample_time, frames, data_text, mqtt_publisher=None):
+    """
+    Hand a packet's data to the mqtt publisher
+    :param start_time: the start of the recording
+    :param sample_time: the timestamp of the first sample of the packet
+    :param frames: the raw lead values of the packet's samples
+    :param data_text: the data lines of the packet's samples
+    :param mqtt_publisher: the mqtt publisher to send the data
     """
-    if mqtt_client is not None:
-        mqtt_client.publish(f"{mqtt_topic}", data_line)
+    if mqtt_publisher is not None:
+        if mqtt_publisher.is_text:
+            mqtt_publisher.add_text(data_text)
+        else:
+            mqtt_publisher.add_samples(start_time, sample_time, frames)
 
 
 def write_missing_to_file(current, last, missed, file=None):
@@ -67,198 +114,263 @@ def write_missing_to_file(current, last, missed, file=None):
         file.write(f'# [ecg] missed {missed} packets - last was {last} but received {current}\n')
 
 
-def produce_channel_data_from_lead_values(in_data):
-    """
-    Generates the 12 ECG channel data from the values received for the 10 leads.
-    :param in_data: the 10 lead data received
-    :return: the 12 ECG channel data
-    """
-    channels = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-    #
-    # after july 30 and with avr "fixed"
-    #
-    l1 = in_data[0]
-    # - ECGCommConstants.ecgLeadsBaseLine
-    # subtracting the baseline here was a temp thing - only to facilitate proper placement in the graph when this was later included by the visualization code (Signal.java redraw())
-    l2 = in_data[1]
-    # - ECGCommConstants.ecgLeadsBaseLine
-    # subtracting the baseline here was a temp thing - only to facilitate proper placement in the graph when this was later included by the visualization code (Signal.java redraw())
-    l3 = (l2 - l1)
-    # avr = -l2 + l3 / 2
-    avr = (-(l1 + l2) / 2)  # confirmed = same as previous
-    avl = (l1 - l2 / 2)  # confirmed
-    avf = (l3 + l1 / 2)  # confirmed
-    # LA
-    channels[0] = l1
-    # RA
-    channels[1] = l2
-    # I = LA-RA
-    channels[2] = l3
-    # + ECGCommConstants.ecgLeadsBaseLine
-    # adding the baseline here was a temp thing - only to facilitate proper placement in the graph when this was later included by the visualization code (Signal.java redraw())
-    channels[3] = avr
-    # + ECGCommConstants.ecgLeadsBaseLine
-    # adding the baseline here was a temp thing - only to facilitate proper placement in the graph when this was later included by the visualization code (Signal.java redraw())
-    channels[4] = avl
-    # + ECGCommConstants.ecgLeadsBaseLine
-    # adding the baseline here was a temp thing - only to facilitate proper placement in the graph when this was later included by the visualization code (Signal.java redraw())
-    channels[5] = avf
-    # + ECGCommConstants.ecgLeadsBaseLine
-    # adding the baseline here was a temp thing - only to facilitate proper placement in the graph when this was later included by the visualization code (Signal.java redraw())
-    channels[6] = in_data[2]
-    channels[7] = in_data[3]
-    channels[8] = in_data[4]
-    channels[9] = in_data[5]
-    channels[10] = in_data[6]
-    channels[11] = in_data[7]
-
-    return channels
-
-
-def update_sample_time(sequence_no, file=None):
+def produce_qrs_signal_from_lead_values(frames):
+    """
+    Generates the signal the QRS complexes are detected on, lead I (LA-RA), for a block of samples
+    :param frames: the (samples x 8) lead values
+    :return: the lead I values
+    """
+    return frames[:, 1].astype(np.float64) - frames[:, 0]
+
+
+def unpack_lead_values(payload):
+    """
+    Unpacks the 12bit lead measurements of a packet payload. Every 3 bytes carry 2 measurements,
+    the first built from the low nibble of byte 1 and byte 0 and the second from byte 2 and the high nibble of byte 1.
+    :param payload: the packet payload following the header
+    :return: the unpacked measurements as a uint16 array
+    """
+    raw = np.frombuffer(payload, dtype=np.uint8)
+    raw = raw[:len(raw) - len(raw) % 3].reshape(-1, 3).astype(np.uint16)
+    values = np.empty((raw.shape[0], 2), dtype=np.uint16)
+    values[:, 0] = ((raw[:, 1] & 0x0F) << 8) | raw[:, 0]
+    values[:, 1] = (raw[:, 2] << 4) | (raw[:, 1] >> 4)
+    return values.reshape(-1)
+
+
+def packet_sample_count(data):
+    """
+    :param data: the ecg data received
+    :return: the number of samples carried by the packet
+    """
+    return (len(data) - ecg_header_len) // 3 * 2 // single_sample_length
+
+
+def update_sample_time(session, sequence_no, packet_samples, binary_file=None):
     """
     Updates the timestamp for beginning of the current packet based on its sequence number
+    :param session: the recording session of the ECG device
     :param sequence_no: the sequence number of the currently processed packet
-    :param file: the file where data are stored
+    :param packet_samples: the number of samples carried by a packet
+    :param binary_file: the binary recording where data are stored
+    :return: the classification of the packet and the number of samples missed before it
+    """
+    if session.ecg_recording_timestamp == -1:
+        session.start_ecg_clock(int(datetime.datetime.now().timestamp() * 1000))
+
+    last_packet_received = session.ecg_sequence.last
+    status, missing_count = session.ecg_sequence.update(sequence_no)
+    if status in (packet_duplicate, packet_late):
+        logging.warning(f'# [ecg] dropped {status} packet {sequence_no} - last was {last_packet_received}')
+        return status, 0
+    if status == packet_resumed:
+        # the stream restarted after an interruption, a sample split across it can not be completed
+        session.int_values.clear()
+        logging.warning(f'# [ecg] resumed with packet {sequence_no} after missing {missing_count} packets')
+    if missing_count == 0:
+        return status, 0
+    missing_samples = missing_count * packet_samples
+    logging.warning(
+        f'# [ecg] missed {missing_count} packets - last was {last_packet_received} but received {sequence_no}')
+    # the gap is reported to the text outputs when the packet after it is released by the QRS detector
+    if binary_file is not None:
+        binary_file.write_gap(sequence_no, last_packet_received, missing_count, missing_samples)
+    # the values of a sample split across the lost packets can not be completed
+    session.int_values.clear()
+    session.qrs.skip(missing_samples)
+    session.ecg_recording_timestamp = session.ecg_recording_timestamp + missing_samples * sample_interval_millis
+    return status, missing_samples
+
+
+def convert_gap_to_text(start_time, sample_time, sample_count, fill, battery=0, interval=sample_interval_millis):
+    """
+    Generates placeholder data lines for missed samples, keeping the time grid of the recording uniform
+    :param start_time: the start of the recording
+    :param sample_time: the timestamp of the first missed sample
+    :param sample_count: the number of missed samples
+    :param fill: the value written in place of the channel data of the placeholder lines, e.g. nan
+    :param battery: the battery of the ECG device
+    :param interval: the interval between the samples in milliseconds
+    :return: the placeholder data lines, each terminated by a newline
     """
-    global recording_start, recording_timestamp, last_packet_received
-    if recording_timestamp == -1:
-        recording_timestamp = 0
-        recording_start = int(datetime.datetime.now().timestamp() * 1000)
+    times = np.empty((sample_count, 2))
+    times[:, 1] = sample_time + np.arange(sample_count) * interval
+    times[:, 0] = start_time + times[:, 1]
+    formatter = CsvBlockFormatter(ecg_csv_formats[:2] + (literal_format(fill),) * 12 + ('0', '0', '0',
+                                                                                        literal_format(battery)))
+    return formatter.render(times)
 
-    missing_count = 0
 
-    was_last_packet_received = last_packet_received
-    if ((sequence_no != 0 or last_packet_received != 254)
-            and (sequence_no != (last_packet_received + 1))):
-        if sequence_no > last_packet_received:
-            while last_packet_received < (sequence_no - 1):
-                last_packet_received = last_packet_received + 1
-                missing_count = missing_count + 1
-        else:
-            while last_packet_received < 255:
-                last_packet_received = last_packet_received + 1
-                missing_count = missing_count + 1
-            last_packet_received = -1
-            while last_packet_received < sequence_no - 1:
-                last_packet_received = last_packet_received + 1
-                missing_count = missing_count + 1
-    if missing_count > 0 and file is not None:
-        logging.warn(
-            f'# [ecg] missed {missing_count} packets - last was {was_last_packet_received} but received {sequence_no}')
-        write_missing_to_file(sequence_no, was_last_packet_received, missing_count, file)
-    recording_timestamp = recording_timestamp + missing_count * sample_interval_millis
-    last_packet_received = sequence_no
-
-
-def process_ecg_data(data, file=None, mqtt_client=None, mqtt_topic=None, influxdb_api=None, influxdb_bucket=None):
-    """
-    Processes the ecg data received by the ECG Vest
+class HeldPacket:
+    """
+    The outputs of a decoded packet that carry its QRS columns, held back with the QRS detector until the beats of its
+    samples are confirmed
+    """
+    __slots__ = ('file', 'mqtt_publisher', 'influxdb_writer', 'decimation', 'start_time', 'packet_timestamp', 'frames',
+                 'voltages', 'battery', 'calibration', 'gap_fill', 'gap')
+
+    def __init__(self, session, file, mqtt_publisher, influxdb_writer, decimation, packet_timestamp, frames, voltages,
+                 gap):
+        """
+        :param session: the recording session of the ECG device
+        :param gap: the sequence number, the last sequence number, the missed packets and the missed samples of the gap
+        before the packet, None if there is none
+        """
+        self.file = file
+        self.mqtt_publisher = mqtt_publisher
+        self.influxdb_writer = influxdb_writer
+        self.decimation = decimation
+        self.start_time = session.ecg_recording_start
+        self.packet_timestamp = packet_timestamp
+        self.frames = frames
+        self.voltages = voltages
+        self.battery = session.battery
+        self.calibration = session.calibration
+        self.gap_fill = session.gap_fill
+        self.gap = gap
+
+
+def write_held_packet(held, is_qrs, heart_rate, rr_millis, qrs_samples):
+    """
+    Writes a packet released by the QRS detector to its outputs, after the gap before it
+    :param held: the held packet
+    :param is_qrs: the flag that shows if a sample is the R peak of a QRS complex, per sample
+    :param heart_rate: the heart rate in bpm, per sample
+    :param rr_millis: the RR interval in milliseconds, per sample
+    :param qrs_samples: the current qrs duration in samples, per sample
+    """
+    file, mqtt_publisher = held.file, held.mqtt_publisher
+    text_output = file is not None or (mqtt_publisher is not None and mqtt_publisher.is_text)
+    if held.gap is not None:
+        sequence_no, last_packet_received, missing_count, missing_samples = held.gap
+        if held.gap_fill is None:
+            write_missing_to_file(sequence_no, last_packet_received, missing_count, file)
+        if file is not None and hasattr(file, 'write_gap'):
+            # segmented recordings keep the gaps in the index of each segment
+            file.write_gap(sequence_no, last_packet_received, missing_count, missing_samples)
+        if held.gap_fill is not None and text_output:
+            gap_text = convert_gap_to_text(held.start_time,
+                                           held.packet_timestamp - missing_samples * sample_interval_millis,
+                                           missing_samples, held.gap_fill, held.battery)
+            write_block_to_file(gap_text, file=file)
+            if mqtt_publisher is not None and mqtt_publisher.is_text:
+                mqtt_publisher.add_text(gap_text)
+        if held.decimation is not None:
+            held.decimation.skip(missing_samples)
+    # decimated outputs
+    if held.decimation is not None:
+        held.decimation.add_block(held.start_time, held.packet_timestamp, held.frames, qrs_samples, is_qrs,
+                                  heart_rate, rr_millis, held.battery, held.calibration)
+    # influxdb
+    if held.influxdb_writer is not None:
+        held.influxdb_writer.add_block(held.start_time, held.packet_timestamp, held.voltages, sample_interval_millis,
+                                       heart_rate, rr_millis)
+    if not text_output:
+        write_packet_to_mqtt(held.start_time, held.packet_timestamp, held.frames, None, mqtt_publisher)
+        return
+    data_text = convert_block_to_text(held.start_time, held.packet_timestamp, held.calibration.channels(held.frames),
+                                      qrs_samples, is_qrs, held.battery, formatter=csv_formatter(held.calibration))
+    # file
+    write_block_to_file(data_text, file=file)
+    # mqtt
+    write_packet_to_mqtt(held.start_time, held.packet_timestamp, held.frames, data_text, mqtt_publisher)
+
+
+def process_ecg_data(session, data, file=None, mqtt_publisher=None, influxdb_writer=None, binary_file=None,
+                     decimation=None, ring=None, store=None):
+    """
+    Processes the ecg data received by the ECG Vest. The binary file, the ring and the store are written right away,
+    the outputs with the QRS columns once the QRS detector releases the packet, QrsDetector.delay samples later.
+    :param session: the recording session of the ECG device
     :param data: the ecg data received
     :param file: the file where data are stored
-    :param mqtt_client: the mqtt client to send the data
-    :param mqtt_topic: the mqtt topic to send the data
-    :param influxdb_api: the influxdb write api to append the data
-    :param influxdb_bucket: the influxdb bucket to append the data
-    """
-    global recording_start, recording_timestamp
-    packet_sequence_number = data.pop(0)
-    update_sample_time(packet_sequence_number, file)
-
-    header = [data.pop(0), data.pop(0), data.pop(0), data.pop(0)]
-
-    rem = len(data)
-
-    a = np.array(data)
-    hex_string = a.astype(np.uint8).data.hex()
-
-    measurements = []
-    n = 6  # chunk length
-    chunks = [hex_string[i:i + n] for i in range(0, len(hex_string), n)]
-
-    # extract measurements from chunks (3 measurements are fit in every two bytes - 12bits per measurement)
-    for item in chunks:
-        measurements.append(item[3] + item[0] + item[1])  # a1+a2+a3
-        measurements.append(item[4] + item[5] + item[2])  # b1+b2+b3
-
-    new_int_values = [int(m, base=16) for m in measurements]
-    int_values.extend(new_int_values)
-    send = 0
-    meas = []
-    while len(int_values) > single_sample_length:
-        leads = []
-        for i in range(single_sample_length):
-            leads.append(int_values.pop(0))
-        channel_data = produce_channel_data_from_lead_values(leads)
-        data_line = convert_sample_to_line(recording_start, recording_timestamp, channel_data, battery=received_battery)
-        # file
-        write_sample_to_file(data_line=data_line, file=file)
-        # mqtt
-        write_sample_to_mqtt(data_line=data_line, mqtt_client=mqtt_client, mqtt_topic=f"{mqtt_topic}/ecg")
-        # influxdb
-        if influxdb_api is not None and influxdb_bucket is not None:
-            meas.append(prepare_sample_for_influx(recording_start + recording_timestamp,
-                                                  voltage_from_channel_data(channel_data)))
-        recording_timestamp += sample_interval_millis
-    # influxdb
-    if influxdb_api is not None and influxdb_bucket is not None:
-        influxdb_api.write(bucket=influxdb_bucket, record=meas)
-
-
-def voltage_from_channel_data(channel_data):
+    :param mqtt_publisher: the mqtt publisher to send the data
+    :param influxdb_writer: the influxdb line writer to append the data
+    :param binary_file: the binary recording where data are stored
+    :param decimation: the decimation stages of the outputs at a lower resolution
+    :param ring: the shared memory ring of the voltages for the local consumers
+    :param store: the in-memory store of the recent voltages
+    :return: the number of samples decoded
+    """
+    packet_sequence_number = data[0]
+    packet_samples = packet_sample_count(data)
+    last_packet_received = session.ecg_sequence.last
+    status, missing_samples = update_sample_time(session, packet_sequence_number, packet_samples, binary_file)
+    if status in (packet_duplicate, packet_late):
+        return 0
+
+    session.int_values.extend(unpack_lead_values(memoryview(data)[ecg_header_len:]))
+    frames = session.int_values.pop_frames()
+    packet_timestamp = session.ecg_recording_timestamp
+    # binary
+    if binary_file is not None:
+        block = np.empty((len(frames), frames.shape[1] + 1), dtype=np.uint16)
+        block[:, :-1] = frames
+        block[:, -1] = session.battery
+        binary_file.write_samples(block, session.ecg_recording_start)
+    voltages = None
+    if influxdb_writer is not None or ring is not None or store is not None:
+        voltages = session.calibration.voltages(frames)
+    if ring is not None or store is not None:
+        timestamps = session.ecg_recording_start + packet_timestamp + np.arange(len(frames)) * sample_interval_millis
+        # shared memory ring
+        if ring is not None:
+            ring.write(timestamps, voltages)
+        # in-memory store
+        if store is not None:
+            store.add('ecg', timestamps, voltages)
+    held = None
+    if file is not None or mqtt_publisher is not None or influxdb_writer is not None or decimation is not None:
+        gap = None
+        if missing_samples > 0:
+            gap = (packet_sequence_number, last_packet_received, missing_samples // packet_samples, missing_samples)
+        # the frames are a view of the lead buffer, valid until the next packet
+        held = HeldPacket(session, file, mqtt_publisher, influxdb_writer, decimation, packet_timestamp,
+                          np.array(frames), voltages, gap)
+    for released in session.qrs.process(produce_qrs_signal_from_lead_values(frames), held):
+        if released[0] is not None:
+            write_held_packet(*released)
+    session.ecg_recording_timestamp += len(frames) * sample_interval_millis
+    return len(frames)
+
+
+def held_ecg_packets(session):
     """
-    Converts channel data to voltage based on adc configuration
-    :param channel_data: the adc raw data
-    :return:  the converted voltage data per channel
+    :param session: the recording session of the ECG device
+    :return: the number of decoded packets not yet written to their outputs
     """
-    return {
-        'I': ((channel_data[0] * 3600.0) / 4095 - 1800.43956) / 1000,
-        'II': ((channel_data[1] * 3600.0) / 4095 - 1800.43956) / 1000,
-        'III': ((channel_data[2] * 3600.0) / 4095) / 1000,
-        'aVR': ((channel_data[3] * 3600.0) / 4095) / 1000,
-        'aVL': ((channel_data[4] * 3600.0) / 4095) / 1000,
-        'aVF': ((channel_data[5] * 3600.0) / 4095) / 1000,
-        'V1': ((channel_data[6] * 3600.0) / 4095 - 1800.43956) / 1000,
-        'V2': ((channel_data[7] * 3600.0) / 4095 - 1800.43956) / 1000,
-        'V3': ((channel_data[8] * 3600.0) / 4095 - 1800.43956) / 1000,
-        'V4': ((channel_data[9] * 3600.0) / 4095 - 1800.43956) / 1000,
-        'V5': ((channel_data[10] * 3600.0) / 4095 - 1800.43956) / 1000,
-        'V6': ((channel_data[11] * 3600.0) / 4095 - 1800.43956) / 1000,
-        'HR': 65.0,
-        'RR': 73.0,
-        'STATE': 0.0
-    }
+    return sum(1 for held in session.qrs.held if held[1] is not None)
 
 
-def prepare_sample_for_influx(recording_time, voltage_data):
+def flush_ecg_data(session):
     """
-    prepares the sample to be written in the influxdb, and generates mV values from channel data
-    :param recording_time:
-    :param voltage_data:
-    :return:
+    Writes the packets held back by the QRS detector to their outputs, once the recording ends
+    :param session: the recording session of the ECG device
     """
-    return {"measurement": "ecg", "time": int(recording_time * 1000000), "fields": voltage_data}
+    for released in session.qrs.release():
+        if released[0] is not None:
+            write_held_packet(*released)
 
 
-def set_battery(battery):
+def set_battery(session, battery):
     """
     Set the value of the ECG device battery
+    :param session: the recording session of the ECG device
     :param battery: the value to set for the ECG device battery
     """
-    global received_battery
-    received_battery = battery
-    logging.info(f'Battery: {received_battery}')
+    session.battery = battery
+    logging.info(f'Battery: {session.battery}')
 
 
-def process_battery_data(data):
+def process_battery_data(session, data):
     """
     Processes the battery data received by the ECG Vest
+    :param session: the recording session of the ECG device
     :param data: the battery data received
     """
-    global received_battery
     # todo: check this error
     try:
-        received_battery = int.from_bytes(data[0], "big")
-        logging.info(f'Battery: {received_battery}')
+        session.battery = int.from_bytes(data[0], "big")
+        logging.info(f'Battery: {session.battery}')
     except:
         pass
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+import asyncio
+import getopt
+import logging
+import os
+import sys
+
+import paho.mqtt.client as mqtt
+from bleak import BleakScanner
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import ASYNCHRONOUS, SYNCHRONOUS
+
+from calibration_utils import CalibrationTable
+from discovery_utils import CachedDevice, DeviceCache, find_devices, rescan_devices
+from gateway_utils import Gateway
+from sim_utils import SimulatedVest, SimulatedBleakScanner, simulated_devices
+from spool_utils import SpoolingMqttClient, SpoolingInfluxWriteApi, spool_drain_rate, spool_memory_bytes, \
+    spool_mqtt_inflight
+
+help_line = 'gateway.py -b <adapter,adapter> -n <name> -d <device,device> -c <count> -f <format> -s <scantime> -r <recordtime> -m <mqtt_url> -t <mqtt_topic> --mqttformat <format> --mqttwindow <millis> -i <influxdb> --maxperadapter <count> --simulate <count> --gapfill <value> --segment <seconds> --segmentsize <bytes> --compress <type> --devicecache <path> --rescan <seconds> --journal --calibration <path> --mqttdecimate <factor> --influxdecimate <factor> --spool <dir> --spoolmemory <bytes> --spoolrate <records> --ring <seconds> --store <bytes>'
+
+
+async def main(argv):
+    adapters = ['hci0']
+    device_name = 'ECG2.0-n'
+    device_addresses = []
+    device_count = None
+    file_format = 'csv'
+    scan_time = 5.0
+    record_time = None
+    mqtt_address = None
+    mqtt_format = 'csv'
+    mqtt_window = 0
+    influxdb_address = None
+    influxdb_database = None
+    topic = None
+    max_per_adapter = 5
+    simulate = 0
+    gap_fill = None
+    segment_seconds = None
+    segment_bytes = None
+    compression = 'none'
+    device_cache = None
+    rescan_interval = None
+    journal = False
+    calibrations = None
+    mqtt_decimation = 1
+    influxdb_decimation = 1
+    spool_directory = None
+    spool_memory = spool_memory_bytes
+    spool_rate = spool_drain_rate
+    ring_seconds = None
+    store_bytes = None
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        opts, args = getopt.getopt(argv, "hn:d:c:f:s:r:m:t:i:b:",
+                                   ["name=", "device=", "count=", "format=", "scantime=", "recordtime=", "mqtt=",
+                                    "topic=", "influxdb=", "bluetooth=", "mqttformat=", "mqttwindow=",
+                                    "maxperadapter=", "simulate=", "gapfill=", "segment=", "segmentsize=", "compress=",
+                                    "devicecache=", "rescan=", "journal", "calibration=",
+                                    "mqttdecimate=", "influxdecimate=", "spool=", "spoolmemory=", "spoolrate=",
+                                    "ring=", "store="])
+    except getopt.GetoptError:
+        logging.error(help_line)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            logging.info(help_line)
+            sys.exit()
+        elif opt in ('-b', '--bluetooth'):
+            adapters = arg.split(',')
+        elif opt in ('-n', '--name'):
+            device_name = arg
+        elif opt in ('-d', '--device'):
+            device_addresses = arg.split(',')
+        elif opt in ('-c', '--count'):
+            device_count = int(arg)
+        elif opt in ('-f', '--format'):
+            file_format = arg
+        elif opt in ('-s', '--scantime'):
+            scan_time = float(arg)
+        elif opt in ('-r', '--recordtime'):
+            # 0 records until stopped
+            record_time = float(arg) or None
+        elif opt in ('-m', '--mqtt'):
+            mqtt_address = arg
+        elif opt == '--mqttformat':
+            mqtt_format = arg
+        elif opt == '--mqttwindow':
+            mqtt_window = float(arg)
+        elif opt in ('-i', '--influxdb'):
+            parts = arg.split('/')
+            if 'http://' in arg or 'https://' in arg:
+                influxdb_address = parts[0] + '//' + parts[2]
+                influxdb_database = parts[3]
+            else:
+                influxdb_address = parts[0]
+                influxdb_database = parts[1]
+        elif opt in ('-t', '--topic'):
+            topic = arg
+        elif opt == '--maxperadapter':
+            max_per_adapter = int(arg)
+        elif opt == '--simulate':
+            simulate = int(arg)
+        elif opt == '--gapfill':
+            gap_fill = arg
+        elif opt == '--segment':
+            segment_seconds = float(arg)
+        elif opt == '--segmentsize':
+            segment_bytes = int(arg)
+        elif opt == '--compress':
+            compression = arg
+        elif opt == '--devicecache':
+            device_cache = arg
+        elif opt == '--rescan':
+            rescan_interval = float(arg)
+        elif opt == '--journal':
+            journal = True
+        elif opt == '--calibration':
+            calibrations = CalibrationTable(arg)
+        elif opt == '--mqttdecimate':
+            mqtt_decimation = int(arg)
+        elif opt == '--influxdecimate':
+            influxdb_decimation = int(arg)
+        elif opt == '--spool':
+            spool_directory = arg
+        elif opt == '--spoolmemory':
+            spool_memory = int(arg)
+        elif opt == '--spoolrate':
+            # 0 replays the spool as fast as the remote takes it
+            spool_rate = float(arg) or None
+        elif opt == '--ring':
+            ring_seconds = float(arg)
+        elif opt == '--store':
+            store_bytes = int(arg)
+    if device_count is None:
+        device_count = len(device_addresses) or max_per_adapter * len(adapters)
+
+    client = None
+    influxdb_write_api = None
+    if mqtt_address is not None:
+        parts = mqtt_address.split(":")
+        client = mqtt.Client("py-ecg-receiver-gateway")
+        if spool_directory is not None:
+            # an unreachable broker is spooled for, so the recording starts without it
+            client.max_queued_messages_set(spool_mqtt_inflight)
+            client.connect_async(host=parts[0], port=int(parts[1]))
+        else:
+            client.connect(host=parts[0], port=int(parts[1]))
+        client.loop_start()
+        if spool_directory is not None:
+            client = SpoolingMqttClient(client, os.path.join(spool_directory, 'mqtt'), spool_memory, spool_rate)
+    if influxdb_address is not None:
+        # only synchronous writes raise the failures, which the spool needs to see
+        write_options = ASYNCHRONOUS if spool_directory is None else SYNCHRONOUS
+        influxdb_write_api = InfluxDBClient(url=influxdb_address, token=influxdb_database,
+                                            org=influxdb_database).write_api(write_options=write_options)
+        if spool_directory is not None:
+            influxdb_write_api = SpoolingInfluxWriteApi(influxdb_write_api, os.path.join(spool_directory, 'influxdb'),
+                                                        spool_memory, spool_rate)
+
+    scanner_class = BleakScanner
+    if simulate > 0:
+        # the worker processes simulate the vests they are assigned, these are only advertised
+        for i in range(simulate):
+            simulated_devices.append(SimulatedVest(name=device_name, address=f'00:00:00:00:00:{i + 1:02X}'))
+        scanner_class = SimulatedBleakScanner
+
+    options = dict(record_time=record_time, mqtt_topic=topic, influxdb_bucket=influxdb_database,
+                   file_format=file_format, mqtt_format=mqtt_format, mqtt_window=mqtt_window, gap_fill=gap_fill,
+                   segment_seconds=segment_seconds, segment_bytes=segment_bytes, compression=compression,
+                   journal=journal, calibrations=calibrations, mqtt_decimation=mqtt_decimation,
+                   influxdb_decimation=influxdb_decimation, ring_seconds=ring_seconds, store_bytes=store_bytes)
+    gateway = Gateway(adapters, options, max_per_adapter, client, influxdb_write_api, simulate > 0)
+    gateway.start()
+    rescan = None
+    try:
+        if len(device_addresses) > 0:
+            # known addresses are connected to directly
+            devices = [CachedDevice(address, device_name) for address in device_addresses]
+        else:
+            cache = DeviceCache(device_cache) if device_cache is not None else None
+            logging.info(f'staring scanner for up to {scan_time} seconds')
+            devices = await find_devices(device_name, None, device_count, scan_time, scanner_class, cache)
+            if rescan_interval is not None:
+                rescan = asyncio.ensure_future(rescan_devices(gateway.assign, gateway.active, device_name, None,
+                                                              rescan_interval, scan_time, scanner_class, cache))
+        for d in devices:
+            gateway.assign(d)
+        while rescan is not None or record_time is None or len(gateway.active) > 0 or len(gateway.pending) > 0:
+            await asyncio.sleep(1.0)
+            gateway.check_workers()
+    finally:
+        if rescan is not None:
+            rescan.cancel()
+        gateway.stop()
+        logging.info(f'gateway stats: {gateway.stats()}')
+        if spool_directory is not None:
+            for output in (client, influxdb_write_api):
+                if output is not None:
+                    output.close()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        logging.info('gateway stopped')
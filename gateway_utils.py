@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+
+from bleak import BleakClient
+
+from device_utils import connect
+from discovery_utils import CachedDevice
+from sim_utils import SimulatedVest, SimulatedBleakClient, simulated_devices
+
+# the workers are started from a running event loop, which a forked process would inherit
+gateway_context = multiprocessing.get_context('spawn')
+# the time in seconds before a device whose session ended early is assigned again
+reassign_delay = 10.0
+
+
+class QueueMqttClient:
+    """
+    Stand-in for the mqtt client of a worker process, hands the published messages to the gateway's shared client
+    """
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def publish(self, topic, payload):
+        self.outputs.put(('mqtt', topic, payload))
+
+
+class QueueInfluxWriteApi:
+    """
+    Stand-in for the influxdb write api of a worker process, hands the written records to the gateway's shared api
+    """
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def write(self, bucket, record):
+        self.outputs.put(('influx', bucket, record))
+
+
+async def run_adapter_sessions(adapter, commands, outputs, options, simulate=False):
+    """
+    Records the devices assigned to an adapter, one recording session per device, until told to stop
+    :param adapter: the bluetooth adapter of the worker, e.g. hci0
+    :param commands: the queue of ('start', address, name) and ('stop',) commands of the worker
+    :param outputs: the queue of the messages for the shared sinks and of the ended sessions
+    :param options: the keyword arguments of connect shared by all the sessions
+    :param simulate: whether to record from simulated vests instead of bluetooth devices
+    """
+    loop = asyncio.get_running_loop()
+    options = dict(options)
+    record_time = options.get('record_time')
+    mqtt_topic = options.pop('mqtt_topic', None)
+    mqtt_client = QueueMqttClient(outputs) if options.pop('mqtt', False) else None
+    influxdb_api = QueueInfluxWriteApi(outputs) if options.pop('influxdb', False) else None
+    client_class = SimulatedBleakClient if simulate else BleakClient
+    sessions = {}
+    while True:
+        command = await loop.run_in_executor(None, commands.get)
+        if command[0] == 'stop':
+            break
+        _, address, name = command
+        if address in sessions:
+            continue
+        if simulate:
+            simulated_devices.append(SimulatedVest(name=name, address=address))
+        logging.info(f'[{adapter}] recording {name}[{address}]')
+        task = asyncio.ensure_future(connect(CachedDevice(address, name), bluetooth_device=adapter,
+                                             mqtt_client=mqtt_client, mqtt_topic=f'{mqtt_topic}/{address}',
+                                             influxdb_api=influxdb_api,
+                                             file_prefix=f"{address.replace(':', '')}_", client_class=client_class,
+                                             **options))
+        sessions[address] = task
+
+        def session_ended(_, address=address, started=loop.time()):
+            sessions.pop(address, None)
+            # a session that failed to connect or gave up before its recording time is recorded again
+            completed = record_time is not None and loop.time() - started >= record_time
+            outputs.put(('ended', adapter, address, completed))
+
+        task.add_done_callback(session_ended)
+    for task in list(sessions.values()):
+        task.cancel()
+    await asyncio.gather(*sessions.values(), return_exceptions=True)
+
+
+def adapter_worker(adapter, commands, outputs, options, simulate=False):
+    """
+    Entry point of the worker process of an adapter
+    :param adapter: the bluetooth adapter of the worker, e.g. hci0
+    :param commands: the queue of the commands of the worker
+    :param outputs: the queue of the messages for the shared sinks and of the ended sessions
+    :param options: the keyword arguments of connect shared by all the sessions
+    :param simulate: whether to record from simulated vests instead of bluetooth devices
+    """
+    logging.basicConfig(level=logging.INFO, format=f'%(levelname)s:{adapter}:%(message)s')
+    # ctrl-c reaches the whole process group, the gateway stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_adapter_sessions(adapter, commands, outputs, options, simulate))
+
+
+class AdapterWorker:
+    """
+    The worker process of a bluetooth adapter and the devices assigned to it
+    """
+
+    def __init__(self, adapter, outputs, options, simulate=False):
+        self.adapter = adapter
+        self.outputs = outputs
+        self.options = options
+        self.simulate = simulate
+        self.devices = {}
+        self.restarts = 0
+        self.commands = None
+        self.process = None
+
+    def start(self):
+        self.commands = gateway_context.Queue()
+        self.process = gateway_context.Process(target=adapter_worker, name=f'gateway-{self.adapter}',
+                                               args=(self.adapter, self.commands, self.outputs, self.options,
+                                                     self.simulate), daemon=True)
+        self.process.start()
+        for address, name in self.devices.items():
+            self.commands.put(('start', address, name))
+
+    def stop(self, timeout=30.0):
+        self.commands.put(('stop',))
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logging.error(f'worker of {self.adapter} did not stop, terminating it')
+            self.process.terminate()
+            self.process.join()
+
+
+class Gateway:
+    """
+    Records many devices over several bluetooth adapters. Every adapter has a worker process of its own, so decoding
+    is spread across cores, devices are assigned to the least loaded adapter, and the mqtt and influxdb outputs of all
+    the workers are sent through the shared clients of the gateway.
+    """
+
+    def __init__(self, adapters, options, max_per_adapter=5, mqtt_client=None, influxdb_api=None, simulate=False):
+        """
+        :param adapters: the bluetooth adapters to use, e.g. ['hci0', 'hci1']
+        :param options: the keyword arguments of connect shared by all the recording sessions
+        :param max_per_adapter: the maximum number of devices recorded over an adapter
+        :param mqtt_client: the mqtt client to send the data of all the devices
+        :param influxdb_api: the influxdb write api to append the data of all the devices
+        :param simulate: whether to record from simulated vests instead of bluetooth devices
+        """
+        self.max_per_adapter = max_per_adapter
+        self.mqtt_client = mqtt_client
+        self.influxdb_api = influxdb_api
+        self.outputs = gateway_context.Queue()
+        options = dict(options, mqtt=mqtt_client is not None, influxdb=influxdb_api is not None)
+        self.workers = [AdapterWorker(adapter, self.outputs, options, simulate) for adapter in adapters]
+        self.active = {}
+        # the devices to assign again by their address, with their name and the time to assign them at
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.sink_thread = threading.Thread(target=self.run_sinks, name='gateway-sinks', daemon=True)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.sink_thread.start()
+
+    def assign(self, device):
+        """
+        Assigns a device to the least loaded adapter with capacity left and starts recording it
+        :param device: the device to record
+        :return: the adapter assigned, None if all adapters are full
+        """
+        with self.lock:
+            if device.address in self.active:
+                return self.active[device.address]
+            worker = min(self.workers, key=lambda candidate: len(candidate.devices))
+            if len(worker.devices) >= self.max_per_adapter:
+                if device.address not in self.pending:
+                    logging.warning(f'no adapter left for {device.address}, waiting for a session to end')
+                # assigned once another session ends
+                self.pending[device.address] = (device.name, time.monotonic())
+                return None
+            self.pending.pop(device.address, None)
+            worker.devices[device.address] = device.name
+            self.active[device.address] = worker.adapter
+        worker.commands.put(('start', device.address, device.name))
+        logging.info(f'assigned {device.name}[{device.address}] to {worker.adapter}')
+        return worker.adapter
+
+    def release(self, adapter, address, completed=False):
+        """
+        Frees the capacity of a device whose recording session ended, and schedules it to be assigned again unless it
+        recorded for the whole recording time
+        :param adapter: the adapter of the device
+        :param address: the address of the device
+        :param completed: whether the session recorded for the whole recording time
+        """
+        with self.lock:
+            name = None
+            for worker in self.workers:
+                if worker.adapter == adapter:
+                    name = worker.devices.pop(address, None)
+            if self.active.get(address) == adapter:
+                del self.active[address]
+            if not completed and not self.stopping:
+                self.pending[address] = (name, time.monotonic() + reassign_delay)
+        if completed:
+            logging.info(f'recording of {address} on {adapter} ended')
+        else:
+            logging.warning(f'recording of {address} on {adapter} ended early, assigning it again in {reassign_delay} '
+                            f'seconds')
+
+    def run_sinks(self):
+        while True:
+            try:
+                message = self.outputs.get()
+            except (EOFError, OSError):
+                break
+            if message is None:
+                break
+            try:
+                if message[0] == 'mqtt':
+                    self.mqtt_client.publish(message[1], message[2])
+                elif message[0] == 'influx':
+                    self.influxdb_api.write(bucket=message[1], record=message[2])
+                elif message[0] == 'ended':
+                    self.release(message[1], message[2], message[3])
+            except Exception as e:
+                logging.error(f'[gateway] {e}')
+
+    def check_workers(self):
+        """
+        Restarts the worker processes that died, along with the recording sessions of their devices, and assigns the
+        devices whose sessions ended early again
+        """
+        for worker in self.workers:
+            if not self.stopping and not worker.process.is_alive():
+                worker.restarts += 1
+                logging.error(f'worker of {worker.adapter} exited with {worker.process.exitcode}, restarting it')
+                worker.start()
+        now = time.monotonic()
+        with self.lock:
+            due = [CachedDevice(address, name) for address, (name, at) in self.pending.items() if at <= now]
+        for device in due:
+            if not self.stopping:
+                self.assign(device)
+
+    def stop(self):
+        """
+        Stops all the recording sessions and waits until their outputs are sent
+        """
+        self.stopping = True
+        for worker in self.workers:
+            worker.stop()
+        self.outputs.put(None)
+        self.sink_thread.join()
+
+    def stats(self):
+        with self.lock:
+            return {worker.adapter: {'devices': list(worker.devices), 'restarts': worker.restarts}
+                    for worker in self.workers}
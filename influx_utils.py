@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+influx_measurement = 'ecg'
+influx_channel_names = ('I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6')
+influx_constant_fields = 'STATE=0.0'
+
+
+def escape_tag(value):
+    """
+    Escapes a tag value for the line protocol and for the % formatting of the lines
+    :param value: the tag value
+    :return: the escaped tag value
+    """
+    for special in (',', '=', ' '):
+        value = value.replace(special, '\\' + special)
+    return value.replace('%', '%%')
+
+
+class InfluxLineWriter:
+    """
+    Renders blocks of voltage samples to influxdb line protocol and writes them in batches. A timer thread writes the
+    samples kept longer than flush_millis when no block arrives to trigger the write, e.g. while the stream stalls.
+    """
+
+    def __init__(self, influxdb_api, influxdb_bucket, batch_size=5000, flush_millis=1000, max_pending=100000,
+                 measurement=influx_measurement, field_names=influx_channel_names, address=None):
+        """
+        :param influxdb_api: the influxdb write api to append the data
+        :param influxdb_bucket: the influxdb bucket to append the data
+        :param batch_size: the number of samples that triggers a write
+        :param flush_millis: the maximum time in milliseconds that samples are kept before written
+        :param max_pending: the maximum number of samples kept, the oldest are dropped when exceeded
+        :param measurement: the influxdb measurement of the samples
+        :param field_names: the field names of the columns of the blocks
+        :param address: the address of the ECG device, written as the device tag that tells the devices sharing the
+        measurement apart
+        """
+        self.influxdb_api = influxdb_api
+        self.influxdb_bucket = influxdb_bucket
+        self.batch_size = batch_size
+        self.flush_millis = flush_millis
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.pending_samples = 0
+        self.pending_since = None
+        self.written = 0
+        self.dropped = 0
+        key = measurement if address is None else f'{measurement},device={escape_tag(address)}'
+        self.line_format = (f'{key} ' + ','.join(f'{name}=%.6f' for name in field_names)
+                            + f',HR=%.1f,RR=%.1f,{influx_constant_fields} %d')
+        # guards the pending samples, the writes are serialized by the write lock outside of it
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self.run_timer, name=f'influx-flush-{measurement}', daemon=True)
+        self.timer.start()
+
+    def add_block(self, start_time, sample_time, voltages, sample_interval, heart_rate=0.0, rr_millis=0.0):
+        """
+        Adds a block of samples, rendered to line protocol in a single step
+        :param start_time: the start of the recording in milliseconds
+        :param sample_time: the time of the first sample since the start of the recording in milliseconds
+        :param voltages: the (samples x fields) voltage block
+        :param sample_interval: the interval between the samples in milliseconds
+        :param heart_rate: the heart rate in bpm, per sample or for the whole block
+        :param rr_millis: the RR interval in milliseconds, per sample or for the whole block
+        """
+        count = len(voltages)
+        if count == 0:
+            return
+        timestamps = ((start_time + sample_time + np.arange(count) * sample_interval) * 1000000).astype(np.int64)
+        values = np.empty((count, voltages.shape[1] + 3), dtype=object)
+        values[:, :-3] = voltages
+        values[:, -3] = heart_rate
+        values[:, -2] = rr_millis
+        values[:, -1] = timestamps
+        block = '\n'.join([self.line_format] * count) % tuple(values.ravel())
+        with self.lock:
+            self.pending.append((block, count))
+            self.pending_samples += count
+            while self.pending_samples > self.max_pending:
+                _, dropped = self.pending.popleft()
+                self.pending_samples -= dropped
+                self.dropped += dropped
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            due = self.pending_samples >= self.batch_size or self.overdue()
+        if due:
+            self.flush()
+
+    def overdue(self):
+        """
+        :return: whether the oldest pending samples were kept for flush_millis, called holding the lock
+        """
+        return self.pending_since is not None and (time.monotonic() - self.pending_since) * 1000 >= self.flush_millis
+
+    def run_timer(self):
+        while not self.closed.wait(self.flush_millis / 1000):
+            with self.lock:
+                due = self.overdue()
+            if due:
+                self.flush()
+
+    def flush(self):
+        """
+        Writes all the pending samples in a single request
+        """
+        with self.write_lock:
+            with self.lock:
+                if self.pending_samples == 0:
+                    return
+                lines = '\n'.join(block for block, _ in self.pending)
+                count = self.pending_samples
+                self.pending.clear()
+                self.pending_samples = 0
+                self.pending_since = None
+            try:
+                self.influxdb_api.write(bucket=self.influxdb_bucket, record=lines)
+                self.written += count
+            except Exception as e:
+                logging.error(f'failed to write {count} samples to influxdb: {e}')
+                with self.lock:
+                    self.dropped += count
+
+    def close(self):
+        """
+        Stops the timer and writes the pending samples
+        """
+        self.closed.set()
+        self.timer.join()
+        self.flush()
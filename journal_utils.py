@@ -0,0 +1,344 @@
+import copy
+import functools
+import getopt
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import acc_utils
+import ecg_utils
+from calibration_utils import CalibrationTable
+from pipeline_utils import StreamResumer
+from qrs_utils import QrsDetector
+from sequence_utils import packet_duplicate, packet_late, packet_resumed
+from session_utils import RecordingSession, single_sample_length
+
+journal_magic = b'ECGJ'
+journal_version = 1
+journal_header_len = 64
+# magic, version, creation time, device address
+journal_header_format = '<4sHd32s'
+# stream, receive time, payload length
+journal_record_format = '<BdH'
+journal_record_len = struct.calcsize(journal_record_format)
+# level is the battery level read when the streams start, firmware the revision read when connected
+journal_streams = ('ecg', 'acc', 'battery', 'level', 'resume', 'firmware')
+journal_stream_ids = {name: index for index, name in enumerate(journal_streams)}
+journal_extension = 'ecgj'
+# ecg decoded before a chunk so the QRS detector has learned the signal when the chunk starts
+journal_warmup_seconds = 30.0
+
+help_line = 'journal_utils.py -j <workers> -c <chunk_seconds> --calibration <path> <journal> [<journal> ...]'
+
+
+class JournalWriter:
+    """
+    Appends the raw notifications of a device to a journal, each with its stream and receive time, without decoding
+    """
+
+    def __init__(self, path, address=None, buffer_size=-1):
+        """
+        :param path: the path of the journal
+        :param address: the address of the ECG device
+        :param buffer_size: the buffer size in bytes of the journal file, -1 for the default of the platform
+        """
+        self.path = path
+        self.record = struct.Struct(journal_record_format)
+        self.file = open(path, 'wb', buffering=buffer_size)
+        header = struct.pack(journal_header_format, journal_magic, journal_version, time.time(),
+                             (address or '').encode())
+        self.file.write(header.ljust(journal_header_len, b'\0'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, stream, data, received=None):
+        """
+        Appends a notification with a single buffered write
+        :param stream: the name of the stream (ecg, acc, battery, level, resume or firmware)
+        :param data: the bytes of the notification
+        :param received: the wall clock time the notification was received, now if not given
+        """
+        self.file.write(self.record.pack(journal_stream_ids[stream], received or time.time(), len(data)) + data)
+
+    def close(self):
+        self.file.close()
+
+
+class JournalReader:
+    """
+    Memory mapped view of a journal
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the path of the journal
+        """
+        self.path = path
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) > 0 else b''
+        if len(self.data) < journal_header_len:
+            raise ValueError(f'{path} is not a journal')
+        magic, version, created, address = struct.unpack_from(journal_header_format, self.data)
+        if magic != journal_magic:
+            raise ValueError(f'{path} is not a journal')
+        self.version = version
+        self.created = created
+        self.address = address.rstrip(b'\0').decode()
+
+    def records(self, start=journal_header_len, end=None):
+        """
+        Iterates over the notifications of the journal, a record cut short by a crash ends the journal
+        :param start: the offset of the first record
+        :param end: the offset to stop at, the end of the journal if not given
+        :return: (offset, stream, receive time, bytes) per notification
+        """
+        record = struct.Struct(journal_record_format)
+        end = len(self.data) if end is None else end
+        offset = start
+        while offset + journal_record_len <= end:
+            stream, received, length = record.unpack_from(self.data, offset)
+            payload_end = offset + journal_record_len + length
+            if payload_end > len(self.data):
+                logging.warning(f'{self.path} ends with an incomplete record at {offset}')
+                return
+            yield offset, journal_streams[stream], received, self.data[offset + journal_record_len:payload_end]
+            offset = payload_end
+
+
+class JournalDecoder:
+    """
+    Replays the notifications of a journal through the decoders of the live recording
+    """
+
+    def __init__(self, session=None, resumer=None, calibrations=None):
+        """
+        :param session: the recording session to continue, a new one if not given
+        :param resumer: the reconnect state to continue, a new one if not given
+        :param calibrations: the calibration table to choose the calibration of the device from
+        """
+        self.session = session or RecordingSession()
+        self.resumer = resumer or StreamResumer()
+        self.calibrations = calibrations
+        if calibrations is not None and session is None:
+            self.session.calibration = calibrations.lookup(self.session.address)
+        # ecg values of a sample split across packets, tracked without decoding by advance
+        self.pending_values = 0
+
+    def process(self, stream, received, data, ecg_sinks, acc_sinks):
+        """
+        Decodes a notification to the given sinks
+        :param stream: the name of the stream of the notification
+        :param received: the wall clock time the notification was received
+        :param data: the bytes of the notification
+        :param ecg_sinks: the keyword arguments of process_ecg_data with the sinks of the ecg data
+        :param acc_sinks: the keyword arguments of process_accelerometer_data with the sinks of the accelerometer data
+        """
+        if stream == 'ecg':
+            self.start_recording(received)
+            self.resumer.check(self.session, stream, received, data)
+            ecg_utils.process_ecg_data(self.session, data, **ecg_sinks)
+        elif stream == 'acc':
+            self.resumer.check(self.session, stream, received, data)
+            acc_utils.process_accelerometer_data(self.session, data, **acc_sinks)
+        elif stream == 'battery':
+            ecg_utils.process_battery_data(self.session, data)
+        elif stream == 'level':
+            ecg_utils.set_battery(self.session, int.from_bytes(data, 'big'))
+        elif stream == 'firmware':
+            if self.calibrations is not None:
+                self.session.calibration = self.calibrations.lookup(self.session.address, bytes(data).decode())
+        else:
+            self.resumer.resume(received)
+
+    def advance(self, stream, received, data):
+        """
+        Follows a notification through the sequence numbers and the timeline only, without decoding it
+        :param stream: the name of the stream of the notification
+        :param received: the wall clock time the notification was received
+        :param data: the bytes of the notification
+        """
+        if stream == 'ecg':
+            self.start_recording(received)
+            self.resumer.check(self.session, stream, received, data)
+            status, missing_samples = ecg_utils.update_sample_time(self.session, data[0],
+                                                                   ecg_utils.packet_sample_count(data))
+            if status in (packet_duplicate, packet_late):
+                return
+            if missing_samples > 0 or status == packet_resumed:
+                self.pending_values = 0
+            self.pending_values += (len(data) - ecg_utils.ecg_header_len) // 3 * 2
+            frames = self.pending_values // single_sample_length
+            self.pending_values -= frames * single_sample_length
+            self.session.ecg_recording_timestamp += frames * ecg_utils.sample_interval_millis
+        elif stream == 'acc':
+            self.resumer.check(self.session, stream, received, data)
+            status, _ = acc_utils.update_sample_time(self.session, data[0])
+            if status not in (packet_duplicate, packet_late):
+                self.session.acc_recording_timestamp += acc_utils.acc_data_frames * acc_utils.sample_interval_millis
+        else:
+            self.process(stream, received, data, {}, {})
+
+    def snapshot(self):
+        """
+        :return: a copy of the state of the decoding with a new QRS detector, which learns the signal again
+        """
+        qrs = self.session.qrs
+        self.session.qrs = None
+        try:
+            state = copy.deepcopy(self)
+        finally:
+            self.session.qrs = qrs
+        state.session.qrs = QrsDetector()
+        return state
+
+    def start_recording(self, received):
+        """
+        Starts the timeline of the recording at the receive time of its first ecg notification
+        :param received: the wall clock time the notification was received
+        """
+        if self.session.ecg_recording_timestamp == -1:
+            self.session.start_ecg_clock(int(received * 1000))
+
+
+def decode_chunk(path, ecg_path, acc_path, start=journal_header_len, end=None, warmup=None, decoder=None,
+                 calibrations=None):
+    """
+    Decodes a part of a journal to csv files
+    :param path: the path of the journal
+    :param ecg_path: the path of the ecg csv file
+    :param acc_path: the path of the accelerometer csv file
+    :param start: the offset of the first record written
+    :param end: the offset to stop at, the end of the journal if not given
+    :param warmup: the offset to start decoding from without writing, so the QRS detector has learned the signal
+    :param decoder: the state of the decoding at the warmup or start offset, a new recording if not given
+    :param calibrations: the calibration table of a new recording
+    :return: the number of notifications decoded
+    """
+    reader = JournalReader(path)
+    decoder = decoder or JournalDecoder(RecordingSession(reader.address), calibrations=calibrations)
+    count = 0
+    if warmup is not None:
+        for _, stream, received, data in reader.records(warmup, start):
+            decoder.process(stream, received, data, {}, {})
+    with open(ecg_path, 'w') as ecg_file, open(acc_path, 'w') as acc_file:
+        for _, stream, received, data in reader.records(start, end):
+            decoder.process(stream, received, data, {'file': ecg_file}, {'file': acc_file})
+            count += 1
+        if end is not None:
+            # the QRS detector confirms the beats of the last packets with the packets after the chunk
+            for _, stream, received, data in reader.records(end):
+                if ecg_utils.held_ecg_packets(decoder.session) == 0:
+                    break
+                decoder.process(stream, received, data, {}, {})
+        ecg_utils.flush_ecg_data(decoder.session)
+    return count
+
+
+def plan_chunks(path, chunk_seconds, warmup_seconds=journal_warmup_seconds, calibrations=None):
+    """
+    Splits a journal in chunks of receive time that can be decoded independently. The journal is followed through the
+    sequence numbers and the timeline only, and the state of the recording is kept where the warmup of a chunk starts.
+    :param path: the path of the journal
+    :param chunk_seconds: the receive time covered by a chunk in seconds
+    :param warmup_seconds: the receive time decoded before a chunk without writing, at most a chunk
+    :param calibrations: the calibration table to choose the calibration of the device from
+    :return: (warmup offset, start offset, end offset, decoder) per chunk
+    """
+    reader = JournalReader(path)
+    decoder = JournalDecoder(RecordingSession(reader.address), calibrations=calibrations)
+    plans = [[None, journal_header_len, None, None]]
+    warmup = None
+    first_received = None
+    # the gaps are reported when the chunks are decoded
+    logging.disable(logging.WARNING)
+    try:
+        for offset, stream, received, data in reader.records():
+            if first_received is None:
+                first_received = received
+            # chunks only start where no sample is split across packets
+            if decoder.pending_values == 0:
+                chunk_time = first_received + len(plans) * chunk_seconds
+                if warmup is None and received >= chunk_time - warmup_seconds:
+                    warmup = (offset, decoder.snapshot())
+                if received >= chunk_time:
+                    plans[-1][2] = offset
+                    plans.append([warmup[0], offset, None, warmup[1]])
+                    warmup = None
+            decoder.advance(stream, received, data)
+    finally:
+        logging.disable(logging.NOTSET)
+    return [tuple(plan) for plan in plans]
+
+
+def decode_journal(path, executor=None, chunk_seconds=None, calibrations=None):
+    """
+    Decodes a journal to the csv files of the live recording, next to the journal
+    :param path: the path of the journal
+    :param executor: the process pool decoding the chunks of the journal, None to decode it in this process
+    :param chunk_seconds: the receive time covered by a chunk in seconds, None to decode the journal as a whole
+    :param calibrations: the calibration table to choose the calibration of the device from
+    :return: the paths of the ecg and accelerometer csv files
+    """
+    base = path[:-len(journal_extension) - 1] if path.endswith(f'.{journal_extension}') else path
+    ecg_path, acc_path = f'{base}.ecg', f'{base}.acc'
+    if executor is None or chunk_seconds is None:
+        decode_chunk(path, ecg_path, acc_path, calibrations=calibrations)
+        return ecg_path, acc_path
+    plans = plan_chunks(path, chunk_seconds, calibrations=calibrations)
+    parts = [(f'{ecg_path}.part{index}', f'{acc_path}.part{index}') for index in range(len(plans))]
+    futures = [executor.submit(decode_chunk, path, ecg_part, acc_part, start, end, warmup, decoder)
+               for (warmup, start, end, decoder), (ecg_part, acc_part) in zip(plans, parts)]
+    for future in futures:
+        future.result()
+    for output, index in ((ecg_path, 0), (acc_path, 1)):
+        with open(output, 'wb') as file:
+            for part in parts:
+                with open(part[index], 'rb') as part_file:
+                    file.write(part_file.read())
+                os.remove(part[index])
+    return ecg_path, acc_path
+
+
+def main(argv):
+    workers = os.cpu_count()
+    chunk_seconds = None
+    calibrations = None
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        opts, paths = getopt.getopt(argv, "hj:c:", ["workers=", "chunk=", "calibration="])
+    except getopt.GetoptError:
+        logging.error(help_line)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            logging.info(help_line)
+            sys.exit()
+        elif opt in ('-j', '--workers'):
+            workers = int(arg)
+        elif opt in ('-c', '--chunk'):
+            chunk_seconds = float(arg)
+        elif opt == '--calibration':
+            calibrations = CalibrationTable(arg)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers) as executor:
+        if chunk_seconds is None:
+            # one journal per worker
+            outputs = list(executor.map(functools.partial(decode_journal, calibrations=calibrations), paths))
+        else:
+            outputs = [decode_journal(path, executor, chunk_seconds, calibrations) for path in paths]
+    for path, (ecg_path, acc_path) in zip(paths, outputs):
+        logging.info(f'decoded {path} to {ecg_path} and {acc_path}')
+    logging.info(f'decoded {len(paths)} journals in {time.perf_counter() - start:.2f} seconds')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
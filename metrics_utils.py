@@ -0,0 +1,238 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+gap_buckets = (1, 2, 5, 10, 20, 50, 100, 255)
+latency_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class Counter:
+    """
+    Monotonic counter, incremented on the hot path without locking
+    """
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """
+    Gauge that is either set or read from a function when the metrics are collected
+    """
+    __slots__ = ('value', 'function')
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Histogram:
+    """
+    Histogram with fixed cumulative buckets
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Holds the metrics of all the devices, each identified by its name and labels
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.descriptions = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind, name, description, labels, create):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, create())
+                self.descriptions[name] = (kind, description)
+        return metric
+
+    def counter(self, name, description, **labels):
+        """
+        Gets or creates a counter
+        :param name: the name of the metric
+        :param description: the description of the metric
+        :param labels: the labels of the series
+        :return: the counter
+        """
+        return self.get('counter', name, description, labels, Counter)
+
+    def gauge(self, name, description, function=None, **labels):
+        """
+        Gets or creates a gauge
+        :param name: the name of the metric
+        :param description: the description of the metric
+        :param function: the function to read the value of the gauge from
+        :param labels: the labels of the series
+        :return: the gauge
+        """
+        gauge = self.get('gauge', name, description, labels, Gauge)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, description, buckets=latency_buckets, **labels):
+        """
+        Gets or creates a histogram
+        :param name: the name of the metric
+        :param description: the description of the metric
+        :param buckets: the upper bounds of the buckets
+        :param labels: the labels of the series
+        :return: the histogram
+        """
+        return self.get('histogram', name, description, labels, lambda: Histogram(buckets))
+
+    def remove(self, **labels):
+        """
+        Removes all the series that have the given labels, e.g. when a device stops recording
+        :param labels: the labels of the series to remove
+        """
+        with self.lock:
+            for key in [key for key in self.metrics if set(labels.items()).issubset(key[1])]:
+                del self.metrics[key]
+
+    def prometheus_text(self):
+        """
+        Renders the metrics in the prometheus text exposition format
+        :return: the metrics text
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.items(), key=lambda item: item[0][0])
+        lines = []
+        last_name = None
+        for (name, labels), metric in metrics:
+            if name != last_name:
+                kind, description = self.descriptions[name]
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {kind}')
+                last_name = name
+            label_text = ','.join(f'{key}="{value}"' for key, value in labels)
+            series = f'{{{label_text}}}' if label_text else ''
+            if isinstance(metric, Histogram):
+                cumulative = 0
+                for bound, count in zip(list(metric.buckets) + ['+Inf'], metric.counts):
+                    cumulative += count
+                    bucket_labels = ','.join(filter(None, [label_text, f'le="{bound}"']))
+                    lines.append(f'{name}_bucket{{{bucket_labels}}} {cumulative}')
+                lines.append(f'{name}_sum{series} {metric.sum}')
+                lines.append(f'{name}_count{series} {metric.count}')
+            elif isinstance(metric, Gauge):
+                lines.append(f'{name}{series} {metric.get()}')
+            else:
+                lines.append(f'{name}{series} {metric.value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Collects the current values of the metrics
+        :return: a list with a dict per series
+        """
+        with self.lock:
+            metrics = list(self.metrics.items())
+        series = []
+        for (name, labels), metric in metrics:
+            entry = {'name': name, 'type': self.descriptions[name][0], 'labels': dict(labels)}
+            if isinstance(metric, Histogram):
+                entry.update({'buckets': list(metric.buckets), 'counts': list(metric.counts), 'sum': metric.sum,
+                              'count': metric.count})
+            elif isinstance(metric, Gauge):
+                entry['value'] = metric.get()
+            else:
+                entry['value'] = metric.value
+            series.append(entry)
+        return series
+
+
+registry = MetricsRegistry()
+
+
+def start_metrics_server(port, host='127.0.0.1', metrics=registry):
+    """
+    Serves the metrics in the prometheus text format on a background thread
+    :param port: the port to listen to
+    :param host: the address to listen to, localhost by default
+    :param metrics: the metrics registry to serve
+    :return: the http server
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info(f'serving metrics on http://{host}:{port}/metrics')
+    return server
+
+
+def start_stats_file_writer(path, interval=10.0, metrics=registry):
+    """
+    Writes the metrics to a json file periodically on a background thread, along with the rate of every counter
+    :param path: the path of the json file
+    :param interval: the time between writes in seconds
+    :param metrics: the metrics registry to write
+    :return: the writer thread
+    """
+
+    def write_stats():
+        previous = {}
+        previous_time = time.monotonic()
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            series = metrics.snapshot()
+            for entry in series:
+                if entry['type'] == 'counter':
+                    key = (entry['name'], tuple(sorted(entry['labels'].items())))
+                    if key in previous:
+                        entry['rate'] = (entry['value'] - previous[key]) / (now - previous_time)
+                    previous[key] = entry['value']
+            previous_time = now
+            try:
+                with open(f'{path}.tmp', 'w') as file:
+                    json.dump({'time': time.time(), 'series': series}, file)
+                os.replace(f'{path}.tmp', path)
+            except OSError as e:
+                logging.error(f'failed to write stats to {path}: {e}')
+
+    thread = threading.Thread(target=write_stats, name='stats-file', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,140 @@
+import struct
+import time
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+mqtt_payload_formats = ('csv', 'binary', 'msgpack', 'cbor')
+# version 1 blocks did not carry the sample interval, so a decimated stream could not be told from the full rate one
+mqtt_block_version = 2
+# block version, start epoch, time of the first sample since the start, interval between the samples, sample count,
+# channel count, value type
+mqtt_block_header_format = '<HqddIH2s'
+mqtt_block_header_len = struct.calcsize(mqtt_block_header_format)
+
+
+class MqttBatchPublisher:
+    """
+    Collects the samples of a stream and publishes them as a single mqtt message per packet or per time window
+    """
+
+    def __init__(self, mqtt_client, mqtt_topic, interval_millis, payload_format='csv', window_millis=0):
+        """
+        :param mqtt_client: the mqtt client to send the data
+        :param mqtt_topic: the mqtt topic to send the data
+        :param interval_millis: the interval between the samples of the stream in milliseconds
+        :param payload_format: the format of the messages (csv, binary, msgpack or cbor)
+        :param window_millis: the time to collect samples for before publishing, 0 publishes every packet
+        """
+        if payload_format not in mqtt_payload_formats:
+            raise ValueError(f'unknown mqtt payload format {payload_format}')
+        if payload_format == 'msgpack' and msgpack is None:
+            raise ValueError('msgpack payload format requires the msgpack package')
+        if payload_format == 'cbor' and cbor2 is None:
+            raise ValueError('cbor payload format requires the cbor2 package')
+        self.mqtt_client = mqtt_client
+        self.mqtt_topic = mqtt_topic
+        self.interval_millis = interval_millis
+        self.payload_format = payload_format
+        self.window_millis = window_millis
+        self.pending = []
+        self.pending_since = None
+        self.published = 0
+
+    @property
+    def is_text(self):
+        return self.payload_format == 'csv'
+
+    def add_text(self, text):
+        """
+        Adds the data lines of a packet rendered as a single text, used with the csv payload format
+        :param text: the data lines of the packet, each terminated by a newline
+        """
+        if len(text) > 0:
+            self.pending.append(text[:-1] if text.endswith('\n') else text)
+            self.flush_if_due()
+
+    def add_samples(self, start_epoch, sample_time, samples):
+        """
+        Adds the samples of a packet, used with the compact payload formats
+        :param start_epoch: the start of the recording in milliseconds
+        :param sample_time: the time of the first sample since the start of the recording in milliseconds
+        :param samples: the (samples x channels) block of the packet
+        """
+        if len(samples) > 0:
+            self.pending.append((start_epoch, sample_time, np.array(samples)))
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """
+        Publishes the pending samples if the time window has passed
+        """
+        now = time.monotonic()
+        if self.pending_since is None:
+            self.pending_since = now
+        if (now - self.pending_since) * 1000 >= self.window_millis:
+            self.flush()
+
+    def flush(self):
+        """
+        Publishes all the pending samples as a single message
+        """
+        if len(self.pending) == 0:
+            return
+        if self.payload_format == 'csv':
+            payload = '\n'.join(self.pending)
+        elif self.payload_format == 'binary':
+            payload = encode_binary_payload(self.pending, self.interval_millis)
+        else:
+            blocks = [{'start': start_epoch, 'time': sample_time, 'interval': self.interval_millis,
+                       'samples': samples.tolist()} for start_epoch, sample_time, samples in self.pending]
+            payload = msgpack.packb(blocks) if self.payload_format == 'msgpack' else cbor2.dumps(blocks)
+        self.pending = []
+        self.pending_since = None
+        self.mqtt_client.publish(self.mqtt_topic, payload)
+        self.published += 1
+
+
+def encode_binary_payload(blocks, interval_millis):
+    """
+    Packs sample blocks to a binary payload, each block is a fixed header followed by the little endian samples
+    :param blocks: the (start epoch, sample time, samples) blocks to pack
+    :param interval_millis: the interval between the samples in milliseconds
+    :return: the binary payload
+    """
+    parts = []
+    for start_epoch, sample_time, samples in blocks:
+        samples = samples.astype(samples.dtype.newbyteorder('<'), copy=False)
+        parts.append(struct.pack(mqtt_block_header_format, mqtt_block_version, start_epoch, sample_time,
+                                 interval_millis, samples.shape[0], samples.shape[1], samples.dtype.str[1:].encode()))
+        parts.append(samples.tobytes())
+    return b''.join(parts)
+
+
+def decode_binary_payload(payload):
+    """
+    Unpacks the sample blocks of a binary payload
+    :param payload: the binary payload
+    :return: the list of (start epoch, sample time, sample interval, samples) blocks
+    """
+    blocks = []
+    offset = 0
+    while offset < len(payload):
+        version, start_epoch, sample_time, interval_millis, sample_count, channel_count, dtype = \
+            struct.unpack_from(mqtt_block_header_format, payload, offset)
+        if version != mqtt_block_version:
+            raise ValueError(f'unsupported mqtt block version {version}')
+        offset += mqtt_block_header_len
+        samples = np.frombuffer(payload, dtype=f'<{dtype.decode()}', count=sample_count * channel_count,
+                                offset=offset).reshape(sample_count, channel_count)
+        offset += samples.nbytes
+        blocks.append((start_epoch, sample_time, interval_millis, samples))
+    return blocks
@@ -0,0 +1,362 @@
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+import acc_utils
+import ecg_utils
+from acc_utils import process_accelerometer_data
+from ecg_utils import flush_ecg_data, process_ecg_data, process_battery_data
+from metrics_utils import registry, gap_buckets
+
+queue_policies = ('drop_newest', 'drop_oldest', 'block')
+# sinks that only copy a block to memory are called on the decoding thread, a worker would cost more than the copy
+direct_sinks = ('ring', 'store')
+# a dropped call would leave a hole in a file that is not marked as a gap, so the file sinks block decoding instead and
+# the notifications then dropped from the received queue show up in the file as sequence gaps
+lossless_sinks = ('file', 'binary_file')
+
+
+def packet_seconds(kind, data):
+    """
+    :param kind: the name of the stream (ecg or acc)
+    :param data: the packet received
+    :return: the duration of the samples of the packet in seconds
+    """
+    if kind == 'ecg':
+        return ecg_utils.packet_sample_count(data) * ecg_utils.sample_interval_millis / 1000
+    return acc_utils.acc_data_frames * acc_utils.sample_interval_millis / 1000
+
+
+class StreamResumer:
+    """
+    Accounts for the packets missed while a device was disconnected, from the time between the last packet of a
+    stream received before a reconnect and the first one after it
+    """
+    __slots__ = ('resume_time', 'last_received')
+
+    def __init__(self):
+        self.resume_time = None
+        self.last_received = {'ecg': None, 'acc': None}
+
+    def resume(self, now):
+        """
+        Signals that the device reconnected
+        :param now: the time of the reconnect, on the clock of the receive times
+        """
+        self.resume_time = now
+
+    def check(self, session, kind, received, data):
+        """
+        Marks the stream as resumed on its first packet after a reconnect
+        :param session: the recording session of the ECG device
+        :param kind: the name of the stream (ecg or acc)
+        :param received: the time the packet was received
+        :param data: the packet received
+        """
+        last = self.last_received[kind]
+        self.last_received[kind] = received
+        if self.resume_time is None or last is None or last >= self.resume_time or received < self.resume_time:
+            return
+        missed = max(0, int(round((received - last) / packet_seconds(kind, data))) - 1)
+        logging.info(f'[{kind}] resumed after {received - last:.2f} seconds, about {missed} packets missed')
+        getattr(session, f'{kind}_sequence').resume(missed)
+
+
+class StageQueue:
+    """
+    Bounded queue between two stages of the pipeline with a policy for when it is full
+    """
+
+    def __init__(self, name, maxsize=1000, policy='drop_oldest'):
+        """
+        :param name: the name of the stage fed by the queue
+        :param maxsize: the maximum number of items kept in the queue
+        :param policy: what to do when the queue is full, drop the new item, drop the oldest item or block
+        """
+        if policy not in queue_policies:
+            raise ValueError(f'unknown queue policy {policy}')
+        self.name = name
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        self.enqueued = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def put(self, item):
+        """
+        Adds an item to the queue based on the queue's policy
+        :param item: the item to add
+        :return: whether the item was added
+        """
+        if self.policy == 'block':
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+                if self.policy == 'drop_newest':
+                    return False
+                try:
+                    self.queue.get_nowait()
+                    self.queue.put_nowait(item)
+                except (queue.Empty, queue.Full):
+                    return False
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def get(self):
+        return self.queue.get()
+
+    def close(self):
+        """
+        Signals the consumer of the queue to stop once all items are consumed
+        """
+        self.queue.put(None)
+
+    def stats(self):
+        return {'enqueued': self.enqueued, 'dropped': self.dropped, 'depth': self.queue.qsize(),
+                'max_depth': self.max_depth}
+
+
+class SinkWorker:
+    """
+    Runs the method calls made to a sink (file, mqtt publisher, influxdb writer) on a thread of its own
+    """
+
+    def __init__(self, name, sink, maxsize=1000, policy='drop_oldest', metrics=registry, **labels):
+        """
+        :param name: the name of the sink
+        :param sink: the sink to call
+        :param maxsize: the maximum number of calls waiting for the sink
+        :param policy: what to do when the sink falls behind
+        :param metrics: the metrics registry of the sink's series
+        :param labels: the labels of the sink's series
+        """
+        self.name = name
+        self.sink = sink
+        self.calls = StageQueue(name, maxsize, policy)
+        self.failed = 0
+        self.write_latency = metrics.histogram('ecg_receiver_sink_write_seconds', 'Time spent in sink calls', **labels)
+        metrics.gauge('ecg_receiver_queue_depth', 'Items waiting in a pipeline queue', self.calls.queue.qsize,
+                      **labels)
+        metrics.gauge('ecg_receiver_queue_dropped', 'Items dropped by a pipeline queue', lambda: self.calls.dropped,
+                      **labels)
+        self.thread = threading.Thread(target=self.run, name=f'sink-{name}', daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.sink, name)
+        if not callable(attribute):
+            return attribute
+
+        def enqueue(*args):
+            # views of buffers reused by the decoder must be copied before they are handed over
+            args = tuple(np.array(arg) if isinstance(arg, np.ndarray) and not arg.flags.owndata else arg
+                         for arg in args)
+            self.calls.put((attribute, args))
+
+        return enqueue
+
+    def run(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                break
+            method, args = call
+            start = time.perf_counter()
+            try:
+                method(*args)
+            except Exception as e:
+                self.failed += 1
+                logging.error(f'[{self.name}] {e}')
+            self.write_latency.observe(time.perf_counter() - start)
+
+    def close(self):
+        """
+        Stops the worker once all the pending calls are made
+        """
+        self.calls.close()
+        self.thread.join()
+
+    def stats(self):
+        stats = self.calls.stats()
+        stats['failed'] = self.failed
+        return stats
+
+
+class RecordingPipeline:
+    """
+    Decouples the notification callbacks of a device from decoding and sink I/O. The callbacks only timestamp and
+    enqueue the received data, decoding runs on its own thread and every sink has its own worker and queue.
+    """
+
+    def __init__(self, session, ecg_sinks, acc_sinks, maxsize=1000, policy='drop_oldest', metrics=registry,
+                 journal=None, decode=True):
+        """
+        :param session: the recording session of the ECG device
+        :param ecg_sinks: the keyword arguments of process_ecg_data with the sinks of the ecg data
+        :param acc_sinks: the keyword arguments of process_accelerometer_data with the sinks of the accelerometer data
+        :param maxsize: the maximum number of items kept in each queue
+        :param policy: what to do when a network sink falls behind, the file sinks always block
+        :param metrics: the metrics registry of the device's series
+        :param journal: the journal writer the raw notifications are appended to
+        :param decode: whether to decode the notifications live, False to only journal them
+        """
+        self.session = session
+        self.journal = journal
+        self.decode = decode
+        self.metrics = metrics
+        self.notifications = {}
+        self.samples = {}
+        self.missed = {}
+        self.gaps = {}
+        self.decode_time = {}
+        for stream in ('ecg', 'acc', 'battery'):
+            labels = dict(device=session.address, stream=stream)
+            self.notifications[stream] = metrics.counter('ecg_receiver_notifications_total',
+                                                         'Notifications received', **labels)
+            self.decode_time[stream] = metrics.histogram('ecg_receiver_decode_seconds', 'Time spent decoding a packet',
+                                                         **labels)
+            if stream != 'battery':
+                self.samples[stream] = metrics.counter('ecg_receiver_samples_total', 'Samples decoded', **labels)
+                self.missed[stream] = metrics.counter('ecg_receiver_missed_packets_total', 'Packets missed', **labels)
+                self.gaps[stream] = metrics.histogram('ecg_receiver_gap_packets', 'Packets missed per gap',
+                                                      gap_buckets, **labels)
+                sequence = getattr(session, f'{stream}_sequence')
+                metrics.gauge('ecg_receiver_duplicate_packets', 'Duplicate packets dropped',
+                              lambda sequence=sequence: sequence.duplicates, **labels)
+                metrics.gauge('ecg_receiver_late_packets', 'Late packets dropped',
+                              lambda sequence=sequence: sequence.late, **labels)
+                metrics.gauge('ecg_receiver_loss_ratio', 'Fraction of the packets sent that were missed',
+                              sequence.loss_ratio, **labels)
+        self.workers = {}
+        self.ecg_sinks = self.wrap_sinks('ecg', ecg_sinks, maxsize, policy)
+        self.acc_sinks = self.wrap_sinks('acc', acc_sinks, maxsize, policy)
+        # the notification callbacks never block, new data is dropped if decoding falls behind
+        self.received = StageQueue('decode', maxsize, 'drop_newest')
+        labels = dict(device=session.address, stage='decode')
+        metrics.gauge('ecg_receiver_queue_depth', 'Items waiting in a pipeline queue', self.received.queue.qsize,
+                      **labels)
+        metrics.gauge('ecg_receiver_queue_dropped', 'Items dropped by a pipeline queue', lambda: self.received.dropped,
+                      **labels)
+        self.decoded = 0
+        self.failed = 0
+        self.max_latency = 0.0
+        self.resumer = StreamResumer()
+        self.reconnects = metrics.counter('ecg_receiver_reconnects_total', 'Reconnects after the link dropped',
+                                          device=session.address)
+        self.thread = threading.Thread(target=self.run, name=f'decode-{session.address}', daemon=True)
+        self.thread.start()
+
+    def wrap_sinks(self, stream, sinks, maxsize, policy):
+        """
+        Wraps each sink of a stream in a worker of its own
+        :param stream: the name of the stream
+        :param sinks: the keyword arguments with the sinks of the stream
+        :param maxsize: the maximum number of calls waiting for each sink
+        :param policy: what to do when a network sink falls behind, the file sinks always block
+        :return: the keyword arguments with the wrapped sinks
+        """
+        wrapped = {}
+        for key, sink in sinks.items():
+            if sink is not None and key not in direct_sinks:
+                if id(sink) not in self.workers:
+                    self.workers[id(sink)] = SinkWorker(f'{self.session.address}-{stream}-{key}', sink, maxsize,
+                                                       'block' if key in lossless_sinks else policy, self.metrics,
+                                                       device=self.session.address, stage=f'{stream}-{key}')
+                sink = self.workers[id(sink)]
+            wrapped[key] = sink
+        return wrapped
+
+    def ecg_callback(self, sender, data):
+        self.notify('ecg', data)
+
+    def acc_callback(self, sender, data):
+        self.notify('acc', data)
+
+    def battery_callback(self, sender, data):
+        self.notify('battery', data)
+
+    def notify(self, kind, data):
+        """
+        Journals a notification and hands it to decoding
+        :param kind: the name of the stream
+        :param data: the notification received
+        """
+        self.notifications[kind].inc()
+        if self.journal is not None:
+            self.journal.append(kind, data)
+        if self.decode:
+            self.received.put((kind, time.monotonic(), data))
+
+    def resume(self):
+        """
+        Signals that the device reconnected, the notifications received from now on continue the recording
+        """
+        if self.journal is not None:
+            self.journal.append('resume', b'')
+        self.resumer.resume(time.monotonic())
+        self.reconnects.inc()
+
+    def run(self):
+        while True:
+            item = self.received.get()
+            if item is None:
+                # the packets held back for the QRS detection
+                try:
+                    flush_ecg_data(self.session)
+                except Exception as e:
+                    logging.error(f'[decode] {e}')
+                break
+            kind, received, data = item
+            start = time.perf_counter()
+            try:
+                if kind == 'ecg':
+                    self.resumer.check(self.session, kind, received, data)
+                    missed = self.session.ecg_sequence.missed
+                    self.samples[kind].inc(process_ecg_data(self.session, data, **self.ecg_sinks))
+                    missed = self.session.ecg_sequence.missed - missed
+                elif kind == 'acc':
+                    self.resumer.check(self.session, kind, received, data)
+                    missed = self.session.acc_sequence.missed
+                    self.samples[kind].inc(process_accelerometer_data(self.session, data, **self.acc_sinks))
+                    missed = self.session.acc_sequence.missed - missed
+                else:
+                    process_battery_data(self.session, data)
+                    missed = 0
+                if missed > 0:
+                    self.missed[kind].inc(missed)
+                    self.gaps[kind].observe(missed)
+                self.decoded += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f'[decode] {e}')
+            self.decode_time[kind].observe(time.perf_counter() - start)
+            self.max_latency = max(self.max_latency, time.monotonic() - received)
+
+    def close(self):
+        """
+        Stops the pipeline once all the received data are decoded and handed to the sinks
+        """
+        # notifications arriving until the device disconnects are not journaled
+        self.journal = None
+        self.received.close()
+        self.thread.join()
+        for worker in self.workers.values():
+            worker.close()
+        logging.info(f'pipeline stats: {self.stats()}')
+        self.metrics.remove(device=self.session.address)
+
+    def stats(self):
+        stats = {'decode': self.received.stats(), 'ecg': self.session.ecg_sequence.stats(),
+                 'acc': self.session.acc_sequence.stats()}
+        stats['decode'].update({'decoded': self.decoded, 'failed': self.failed, 'max_latency': self.max_latency,
+                                'reconnects': self.reconnects.value})
+        for worker in self.workers.values():
+            stats[worker.name] = worker.stats()
+        return stats
@@ -0,0 +1,330 @@
+from collections import deque
+
+import numpy as np
+
+qrs_band_hz = (5.0, 15.0)
+qrs_filter_seconds = 0.2
+qrs_window_seconds = 0.15
+qrs_refractory_seconds = 0.2
+qrs_t_wave_seconds = 0.36
+qrs_learning_seconds = 2.0
+qrs_history_seconds = 1.0
+qrs_rr_beats = 8
+
+
+def bandpass_taps(sample_rate, band=qrs_band_hz, seconds=qrs_filter_seconds):
+    """
+    Designs a linear phase FIR band pass filter with a hamming window
+    :param sample_rate: the sample rate in Hz
+    :param band: the low and high cutoff frequencies in Hz
+    :param seconds: the length of the filter in seconds
+    :return: the filter taps, an odd number of them
+    """
+    count = int(seconds * sample_rate) // 2 * 2 + 1
+    n = np.arange(count) - (count - 1) / 2
+    low, high = band[0] / sample_rate, band[1] / sample_rate
+    taps = (2 * high * np.sinc(2 * high * n) - 2 * low * np.sinc(2 * low * n)) * np.hamming(count)
+    # unity gain at the centre of the band
+    centre = np.exp(-2j * np.pi * (low + high) / 2 * np.arange(count))
+    return taps / abs(np.dot(taps, centre))
+
+
+class FirStream:
+    """
+    Applies a FIR filter to consecutive blocks of a signal, carrying the last inputs over to the next block
+    """
+    __slots__ = ('taps', 'state')
+
+    def __init__(self, taps):
+        self.taps = np.asarray(taps, dtype=np.float64)
+        self.state = None
+
+    @property
+    def delay(self):
+        return (len(self.taps) - 1) // 2
+
+    def process(self, block):
+        """
+        Filters the next block of the signal
+        :param block: the samples of the block
+        :return: the filtered samples, one per input sample
+        """
+        if self.state is None:
+            # start from a steady signal instead of a step from zero
+            self.state = np.full(len(self.taps) - 1, block[0] if len(block) > 0 else 0.0)
+        extended = np.concatenate((self.state, block))
+        self.state = extended[len(extended) - len(self.state):]
+        return np.convolve(extended, self.taps, 'valid')
+
+    def reset(self):
+        self.state = None
+
+
+class QrsDetector:
+    """
+    Streaming Pan-Tompkins QRS detector. Every block of samples is band passed, differentiated, squared and integrated
+    over a moving window with vectorized FIR filters, only the peaks of the integrated signal are classified one by one
+    against adaptive signal and noise thresholds. The state kept is bounded: the filter inputs, one second of filtered
+    history, the thresholds and the last R peaks.
+
+    A beat is confirmed up to delay samples after its R peak, so the blocks are held back until then and flagged on the
+    R peak sample. Only a beat found by the search back may be older, it is flagged on the oldest sample still held.
+    """
+    __slots__ = ('sample_rate', 'highpass', 'derivative', 'integrator', 'refractory', 't_wave', 'learning',
+                 'history_len', 'signal', 'squared', 'integrated', 'sample_count', 'learning_max', 'learning_sum',
+                 'spki', 'npki', 'last_qrs', 'last_slope', 'candidate', 'peaks', 'rr_intervals', 'qrs_widths', 'beats',
+                 'heart_rate', 'rr_millis', 'qrs_samples', 'gap', 'last_sample', 'bridged', 'delay', 'held')
+
+    def __init__(self, sample_rate=500.0):
+        """
+        :param sample_rate: the sample rate of the signal in Hz
+        """
+        self.sample_rate = sample_rate
+        # the signal less its moving average, for locating the R peaks without the baseline wander
+        window = int(qrs_filter_seconds * sample_rate) // 2 * 2 + 1
+        self.highpass = FirStream(np.eye(1, window, window // 2)[0] - 1.0 / window)
+        # band pass followed by the five point derivative
+        derivative = np.array([1, 2, 0, -2, -1]) * sample_rate / 8
+        self.derivative = FirStream(np.convolve(bandpass_taps(sample_rate), derivative))
+        window = int(qrs_window_seconds * sample_rate) // 2 * 2 + 1
+        self.integrator = FirStream(np.full(window, 1.0 / window))
+        self.refractory = int(qrs_refractory_seconds * sample_rate)
+        self.t_wave = int(qrs_t_wave_seconds * sample_rate)
+        self.learning = int(qrs_learning_seconds * sample_rate)
+        self.history_len = int(qrs_history_seconds * sample_rate)
+        self.signal = np.zeros(0)
+        self.squared = np.zeros(0)
+        self.integrated = np.zeros(0)
+        # index of the next sample of the signal
+        self.sample_count = 0
+        self.learning_max = 0.0
+        self.learning_sum = 0.0
+        self.spki = 0.0
+        self.npki = 0.0
+        self.last_qrs = None
+        self.last_slope = 0.0
+        # the highest peak since the last qrs that was not classified as one, kept for the search back
+        self.candidate = None
+        self.peaks = deque(maxlen=qrs_rr_beats + 1)
+        self.rr_intervals = deque(maxlen=qrs_rr_beats)
+        self.qrs_widths = deque(maxlen=qrs_rr_beats)
+        self.beats = 0
+        self.heart_rate = 0.0
+        self.rr_millis = 0.0
+        self.qrs_samples = 0
+        # missed samples to bridge before the next block
+        self.gap = 0
+        self.last_sample = None
+        self.bridged = False
+        # a peak of the integrated signal is confirmed a window after it, and lags the R peak by up to the filter
+        # delays and the half window the R peak is searched in
+        self.delay = len(self.integrator.taps) + 2 * self.integrator.delay + self.derivative.delay + 1
+        # (index of the first sample, payload, is_qrs, heart rate, RR interval, qrs duration) of the blocks held back
+        self.held = deque()
+
+    @property
+    def threshold(self):
+        return self.npki + 0.25 * (self.spki - self.npki)
+
+    def process(self, block, payload=None):
+        """
+        Detects the QRS complexes in the next block of the signal
+        :param block: the samples of the block
+        :param payload: the data the caller keeps with the block until it is released, e.g. its outputs
+        :return: the blocks released, those whose samples are all at least delay samples old, as (payload, is_qrs,
+        heart_rate, rr_millis, qrs_samples) with per sample arrays of the qrs flag set on the R peaks, the heart rate
+        in bpm, the RR interval in milliseconds and the average qrs duration in samples
+        """
+        block = np.asarray(block, dtype=np.float64)
+        count = len(block)
+        self.held.append((self.sample_count + self.gap, payload, np.zeros(count, dtype=np.int8),
+                          np.full(count, self.heart_rate), np.full(count, self.rr_millis),
+                          np.full(count, self.qrs_samples, dtype=np.int64)))
+        if self.gap == 0 or count == 0:
+            self.detect(block)
+        else:
+            # bridge the missed samples so the filters carry on
+            bridge = np.linspace(self.last_sample, block[0], self.gap + 2)[1:-1]
+            self.gap = 0
+            self.bridged = True
+            self.detect(np.concatenate((bridge, block)))
+        return self.release(self.sample_count - self.delay)
+
+    def release(self, before=None):
+        """
+        Releases the blocks held back
+        :param before: the index of the sample the released blocks end before, None to release all of them
+        :return: the released blocks as process returns them
+        """
+        released = []
+        while len(self.held) > 0 and (before is None or self.held[0][0] + len(self.held[0][2]) <= before):
+            released.append(self.held.popleft()[1:])
+        return released
+
+    def detect(self, block):
+        """
+        Detects the QRS complexes in a block of samples that directly follows the last one
+        :param block: the samples of the block
+        """
+        count = len(block)
+        if count == 0:
+            return
+        start = self.sample_count
+        self.last_sample = block[-1]
+        squared = self.derivative.process(block) ** 2
+        integrated = self.integrator.process(squared)
+        self.signal = np.concatenate((self.signal, self.highpass.process(block)))[-(self.history_len + count):]
+        self.squared = np.concatenate((self.squared, squared))[-(self.history_len + count):]
+        self.integrated = np.concatenate((self.integrated, integrated))[-(self.history_len + count):]
+        self.sample_count += count
+        if start < self.learning:
+            learned = integrated[:self.learning - start]
+            self.learning_max = max(self.learning_max, learned.max())
+            self.learning_sum += learned.sum()
+            if self.sample_count >= self.learning:
+                self.spki = self.learning_max / 3
+                self.npki = self.learning_sum / self.learning / 2
+        # peaks of the integrated signal are the maxima of the integration window around them, so they are confirmed
+        # once the window after them is received
+        window = len(self.integrator.taps)
+        offset = self.sample_count - len(self.integrated)
+        first = max(start - window, offset + window + 1, self.learning)
+        last = self.sample_count - window
+        if first < last:
+            values = self.integrated[first - offset - 1:last - offset + 1]
+            maxima = np.flatnonzero((values[1:-1] > values[:-2]) & (values[1:-1] >= values[2:])) + first
+            for index in maxima:
+                position = index - offset
+                if (self.integrated[position] >= self.integrated[position - window:position + window + 1].max()
+                        and self.classify(index)):
+                    self.mark(self.peaks[-1])
+        # search back for a beat missed with the lower threshold once 1.66 times the RR interval has passed
+        if (self.candidate is not None and self.last_qrs is not None and len(self.rr_intervals) > 0
+                and self.sample_count - 1 - self.last_qrs > 1.66 * np.mean(self.rr_intervals)
+                and self.candidate[1] > self.threshold / 2):
+            index, peak, r_peak, width = self.candidate
+            self.spki = 0.25 * peak + 0.75 * self.spki
+            self.accept(index, r_peak, width)
+            self.mark(r_peak)
+
+    def mark(self, r_peak):
+        """
+        Flags the R peak of a beat in the blocks held back and updates the values of the samples from it on. A peak in
+        missed samples is flagged on the first sample after them.
+        :param r_peak: the sample index of the R peak
+        """
+        flagged = False
+        for start, _, is_qrs, heart_rate, rr_millis, qrs_samples in self.held:
+            position = max(r_peak - start, 0)
+            if position >= len(is_qrs):
+                continue
+            if not flagged:
+                is_qrs[position] = 1
+                flagged = True
+            heart_rate[position:] = self.heart_rate
+            rr_millis[position:] = self.rr_millis
+            qrs_samples[position:] = self.qrs_samples
+
+    def history(self, signal, index):
+        """
+        :param signal: one of the signal histories
+        :param index: the sample index to look up
+        :return: the position of the sample in the history
+        """
+        return index - (self.sample_count - len(signal))
+
+    def measure(self, index, peak):
+        """
+        Locates the R peak and the duration of the complex behind a peak of the integrated signal
+        :param index: the sample index of the peak
+        :param peak: the value of the peak
+        :return: the sample index of the R peak and the qrs duration in samples
+        """
+        # the integration window is centred on the complex, the R peak is its largest deviation from the baseline
+        centre = self.history(self.signal,
+                              index - self.integrator.delay - self.derivative.delay + self.highpass.delay)
+        begin = min(max(0, centre - self.integrator.delay), len(self.signal) - 1)
+        end = max(begin + 1, min(len(self.signal), centre + self.integrator.delay + 1))
+        r_peak = begin + int(np.abs(self.signal[begin:end]).argmax())
+        r_peak += self.sample_count - len(self.signal) - self.highpass.delay
+        # the rising edge of the integrated signal spans the complex
+        position = self.history(self.integrated, index)
+        rising = self.integrated[max(0, position - len(self.integrator.taps)):position + 1]
+        onset = np.flatnonzero(rising < 0.1 * peak)
+        onset = onset[-1] if len(onset) > 0 else 0
+        width = int(np.argmax(rising[onset:] >= 0.9 * peak))
+        return r_peak, width
+
+    def classify(self, index):
+        """
+        Classifies a peak of the integrated signal as a qrs complex or noise and updates the thresholds
+        :param index: the sample index of the peak
+        :return: whether the peak is a new qrs complex
+        """
+        peak = self.integrated[self.history(self.integrated, index)]
+        if peak > self.threshold:
+            r_peak, width = self.measure(index, peak)
+            since = r_peak - self.peaks[-1] if len(self.peaks) > 0 else None
+            if since is not None and since < self.refractory:
+                # another peak of the last complex
+                return False
+            position = self.history(self.squared, index)
+            slope = self.squared[max(0, position - len(self.integrator.taps)):position + 1].max()
+            if since is not None and since < self.t_wave and slope < self.last_slope / 4:
+                # less than half the maximal slope of the last complex, a T wave
+                self.npki = 0.125 * peak + 0.875 * self.npki
+                return False
+            self.spki = 0.125 * peak + 0.875 * self.spki
+            self.last_slope = slope
+            self.accept(index, r_peak, width)
+            return True
+        self.npki = 0.125 * peak + 0.875 * self.npki
+        if self.candidate is None or peak > self.candidate[1]:
+            r_peak, width = self.measure(index, peak)
+            if len(self.peaks) == 0 or r_peak - self.peaks[-1] >= self.refractory:
+                self.candidate = (index, peak, r_peak, width)
+        return False
+
+    def accept(self, index, r_peak, width):
+        """
+        Records a qrs complex and updates the heart rate, RR interval and qrs duration
+        :param index: the sample index of the peak of the integrated signal
+        :param r_peak: the sample index of the R peak
+        :param width: the duration of the complex in samples
+        """
+        self.qrs_widths.append(width)
+        self.qrs_samples = int(round(np.mean(self.qrs_widths)))
+        rr = r_peak - self.peaks[-1] if len(self.peaks) > 0 else None
+        # a beat lost in a bridged gap would double the interval
+        if rr is not None and not (self.bridged and len(self.rr_intervals) > 0
+                                   and rr > 1.5 * np.mean(self.rr_intervals)):
+            self.rr_intervals.append(rr)
+            self.rr_millis = rr * 1000.0 / self.sample_rate
+            self.heart_rate = 60.0 * self.sample_rate / np.mean(self.rr_intervals)
+        self.bridged = False
+        self.peaks.append(r_peak)
+        self.last_qrs = index
+        self.candidate = None
+        self.beats += 1
+
+    def skip(self, sample_count):
+        """
+        Skips missed samples of the signal. Short gaps are bridged when the next block arrives, after longer ones the
+        filters restart and the next RR interval is not measured across the gap.
+        :param sample_count: the number of missed samples
+        """
+        if self.last_sample is not None and self.gap + sample_count <= self.history_len:
+            self.gap += sample_count
+            return
+        self.sample_count += self.gap + sample_count
+        self.gap = 0
+        self.last_sample = None
+        self.highpass.reset()
+        self.derivative.reset()
+        self.integrator.reset()
+        self.signal = np.zeros(0)
+        self.squared = np.zeros(0)
+        self.integrated = np.zeros(0)
+        self.peaks.clear()
+        self.last_qrs = None
+        self.candidate = None
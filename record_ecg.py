@@ -2,52 +2,114 @@
 import asyncio
 import getopt
 import logging
+import os
 import sys
 
 import paho.mqtt.client as mqtt
-from bleak import BleakScanner
+from bleak import BleakScanner, BleakClient
 from influxdb_client import InfluxDBClient
-from influxdb_client.client.write_api import ASYNCHRONOUS
+from influxdb_client.client.write_api import ASYNCHRONOUS, SYNCHRONOUS
 
+from calibration_utils import CalibrationTable
 from device_utils import connect
+from discovery_utils import DeviceCache, find_devices, rescan_devices, scan_replacement
+from metrics_utils import start_metrics_server, start_stats_file_writer
+from sim_utils import SimulatedVest, SimulatedBleakScanner, SimulatedBleakClient, simulated_devices
+from spool_utils import SpoolingMqttClient, SpoolingInfluxWriteApi, spool_drain_rate, spool_memory_bytes, \
+    spool_mqtt_inflight
 
-help_line = 'record_ecg.py -n <name> -d <device> -s <scantime> -r <recordtime> -m <mqtt_url> -t <mqtt_topic> -i <influxdb> -b <bluetooth>'
+help_line = 'record_ecg.py -n <name> -d <device> -c <count> -f <format> -s <scantime> -r <recordtime> -m <mqtt_url> -t <mqtt_topic> --mqttformat <format> --mqttwindow <millis> -i <influxdb> -b <bluetooth> --simulate <count> --metricsport <port> --statsfile <path> --gapfill <value> --filebuffer <bytes> --segment <seconds> --segmentsize <bytes> --compress <type> --devicecache <path> --rescan <seconds> --journal --calibration <path> --mqttdecimate <factor> --influxdecimate <factor> --spool <dir> --spoolmemory <bytes> --spoolrate <records> --ring <seconds> --store <bytes>'
 
 
-async def start_connection(d, record_time, bluetooth_device, mqtt_client, mqtt_topic, influxdb_api, influxdb_bucket):
+async def start_connection(d, record_time, bluetooth_device, mqtt_client, mqtt_topic, influxdb_api, influxdb_bucket,
+                           file_prefix='', file_format='csv', mqtt_format='csv', mqtt_window=0, gap_fill=None,
+                           file_buffer_size=-1, segment_seconds=None, segment_bytes=None, compression='none',
+                           journal=False, calibrations=None, mqtt_decimation=1, influxdb_decimation=1,
+                           ring_seconds=None, store_bytes=None, cache=None, client_class=BleakClient):
     """
     Start connection to ECG device
     :param d: the ECG device
-    :param record_time: the duration of the recording
+    :param record_time: the duration of the recording, None to record until cancelled
     :param bluetooth_device: the bluetooth device to use
     :param mqtt_client: the mqtt client to send the data
     :param mqtt_topic: the mqtt topic to send the data
     :param influxdb_api: the influxdb write api to append the data
     :param influxdb_bucket: the influxdb bucket to append the data
+    :param file_prefix: the prefix of the recording's file names
+    :param file_format: the format of the recording's files (csv, binary or raw to only keep the journal)
+    :param mqtt_format: the format of the mqtt messages (csv, binary, msgpack or cbor)
+    :param mqtt_window: the time in milliseconds to collect samples for before publishing
+    :param gap_fill: the value of the placeholder rows written for missed samples, None to only report the gaps
+    :param file_buffer_size: the buffer size in bytes of the csv files, -1 for the default of the platform
+    :param segment_seconds: the duration of a csv file segment in seconds, None to not rotate by duration
+    :param segment_bytes: the size of a csv file segment on disk in bytes, None to not rotate by size
+    :param compression: the compression of the csv file segments (none, gzip, zstd or lz4)
+    :param journal: whether to append the raw notifications to a journal, which can be decoded offline
+    :param calibrations: the calibration table to choose the calibration of the device from
+    :param mqtt_decimation: the decimation factor of the ecg samples sent to mqtt
+    :param influxdb_decimation: the decimation factor of the ecg samples written to influxdb
+    :param ring_seconds: the seconds of voltages kept in a shared memory ring for the local consumers, None for no ring
+    :param store_bytes: the budget in bytes of the recent samples kept in memory, None to not keep them
+    :param cache: the device cache the device is remembered in whenever it connects
+    :param client_class: the bluetooth client implementation, BleakClient or a stand-in
+    :return: whether the device was connected
     """
     services_detected = d.metadata['uuids']
     logging.info(
         f'starting connection for: {record_time} to: {d.name}[{d.address}], rssi:{d.rssi}, services:{services_detected}')
-    await connect(d, bluetooth_device=bluetooth_device, record_time=record_time, mqtt_client=mqtt_client,
-                  mqtt_topic=mqtt_topic, influxdb_api=influxdb_api, influxdb_bucket=influxdb_bucket)
+    return await connect(d, bluetooth_device=bluetooth_device, record_time=record_time, mqtt_client=mqtt_client,
+                         mqtt_topic=mqtt_topic, influxdb_api=influxdb_api, influxdb_bucket=influxdb_bucket,
+                         file_prefix=file_prefix, file_format=file_format, mqtt_format=mqtt_format,
+                         mqtt_window=mqtt_window, gap_fill=gap_fill, file_buffer_size=file_buffer_size,
+                         segment_seconds=segment_seconds, segment_bytes=segment_bytes, compression=compression,
+                         journal=journal, calibrations=calibrations, mqtt_decimation=mqtt_decimation,
+                         influxdb_decimation=influxdb_decimation, ring_seconds=ring_seconds, store_bytes=store_bytes,
+                         cache=cache, client_class=client_class)
 
 
 async def main(argv):
     bluetooth = None
     device_name = 'ECG2.0-n'
     device_address = None
+    device_count = 1
+    file_format = 'csv'
     scan_time = 5.0
     record_time = 120.0
     mqtt_address = None
+    mqtt_format = 'csv'
+    mqtt_window = 0
     influxdb_address = None
     influxdb_database = None
     topic = None
+    simulate = 0
+    metrics_port = None
+    stats_file = None
+    gap_fill = None
+    file_buffer_size = -1
+    segment_seconds = None
+    segment_bytes = None
+    compression = 'none'
+    device_cache = None
+    rescan_interval = None
+    journal = False
+    calibrations = None
+    mqtt_decimation = 1
+    influxdb_decimation = 1
+    spool_directory = None
+    spool_memory = spool_memory_bytes
+    spool_rate = spool_drain_rate
+    ring_seconds = None
+    store_bytes = None
 
     logging.basicConfig(level=logging.INFO)
     try:
-        opts, args = getopt.getopt(argv, "vhn:d:s:r:m:t:i:b:",
-                                   ["name=", "device=", "scantime=", "recordtime=", "mqtt=", "topic=", "influxdb=",
-                                    "bluetooth="])
+        opts, args = getopt.getopt(argv, "vhn:d:c:f:s:r:m:t:i:b:",
+                                   ["name=", "device=", "count=", "format=", "scantime=", "recordtime=", "mqtt=",
+                                    "topic=", "influxdb=", "bluetooth=", "mqttformat=", "mqttwindow=",
+                                    "simulate=", "metricsport=", "statsfile=", "gapfill=", "filebuffer=",
+                                    "segment=", "segmentsize=", "compress=", "devicecache=", "rescan=", "journal",
+                                    "calibration=", "mqttdecimate=", "influxdecimate=", "spool=", "spoolmemory=",
+                                    "spoolrate=", "ring=", "store="])
     except getopt.GetoptError:
         logging.error(help_line)
         sys.exit(2)
@@ -61,12 +123,21 @@ async def main(argv):
             device_name = arg
         elif opt in ('-d', '--device'):
             device_address = arg
+        elif opt in ('-c', '--count'):
+            device_count = int(arg)
+        elif opt in ('-f', '--format'):
+            file_format = arg
         elif opt in ('-s', '--scantime'):
             scan_time = float(arg)
         elif opt in ('-r', '--recordtime'):
-            record_time = float(arg)
+            # 0 records until stopped
+            record_time = float(arg) or None
         elif opt in ('-m', '--mqtt'):
             mqtt_address = arg
+        elif opt == '--mqttformat':
+            mqtt_format = arg
+        elif opt == '--mqttwindow':
+            mqtt_window = float(arg)
         elif opt in ('-i', '--influxdb'):
             parts = arg.split('/')
             if 'http://' in arg or 'https://' in arg:
@@ -77,6 +148,45 @@ async def main(argv):
                 influxdb_database = parts[1]
         elif opt in ('-t', '--topic'):
             topic = arg
+        elif opt == '--simulate':
+            simulate = int(arg)
+        elif opt == '--metricsport':
+            metrics_port = int(arg)
+        elif opt == '--statsfile':
+            stats_file = arg
+        elif opt == '--gapfill':
+            gap_fill = arg
+        elif opt == '--filebuffer':
+            file_buffer_size = int(arg)
+        elif opt == '--segment':
+            segment_seconds = float(arg)
+        elif opt == '--segmentsize':
+            segment_bytes = int(arg)
+        elif opt == '--compress':
+            compression = arg
+        elif opt == '--devicecache':
+            device_cache = arg
+        elif opt == '--rescan':
+            rescan_interval = float(arg)
+        elif opt == '--journal':
+            journal = True
+        elif opt == '--calibration':
+            calibrations = CalibrationTable(arg)
+        elif opt == '--mqttdecimate':
+            mqtt_decimation = int(arg)
+        elif opt == '--influxdecimate':
+            influxdb_decimation = int(arg)
+        elif opt == '--spool':
+            spool_directory = arg
+        elif opt == '--spoolmemory':
+            spool_memory = int(arg)
+        elif opt == '--spoolrate':
+            # 0 replays the spool as fast as the remote takes it
+            spool_rate = float(arg) or None
+        elif opt == '--ring':
+            ring_seconds = float(arg)
+        elif opt == '--store':
+            store_bytes = int(arg)
     if device_name is None:
         logging.info(help_line)
     else:
@@ -87,33 +197,99 @@ async def main(argv):
             host = parts[0]
             port = int(parts[1])
             client = mqtt.Client("py-ecg-receiver")
-            client.connect(host=host, port=port)
+            if spool_directory is not None:
+                # an unreachable broker is spooled for, so the recording starts without it
+                client.max_queued_messages_set(spool_mqtt_inflight)
+                client.connect_async(host=host, port=port)
+            else:
+                client.connect(host=host, port=port)
             client.loop_start()
+            if spool_directory is not None:
+                client = SpoolingMqttClient(client, os.path.join(spool_directory, 'mqtt'), spool_memory, spool_rate)
         if influxdb_address is not None:
+            # only synchronous writes raise the failures, which the spool needs to see
+            write_options = ASYNCHRONOUS if spool_directory is None else SYNCHRONOUS
             influxdb_write_api = InfluxDBClient(url=influxdb_address, token=influxdb_database,
-                                                org=influxdb_database).write_api(write_options=ASYNCHRONOUS)
-
-        logging.info(f'staring scanner for {scan_time} seconds')
-        scanner = BleakScanner()
-        await scanner.start()
-        await asyncio.sleep(scan_time)
-        await scanner.stop()
-        connected_device = None
-        for d in scanner.discovered_devices:
-            if device_address is None and d.name is not None and d.name == device_name:
-                connected_device = d
-                await start_connection(d, record_time, bluetooth_device=bluetooth, mqtt_client=client,
-                                       mqtt_topic=f'{topic}/{d.address}', influxdb_api=influxdb_write_api,
-                                       influxdb_bucket=influxdb_database)
-                break
-            elif device_address is not None and d.address is not None and d.address == device_address:
-                connected_device = d
-                await start_connection(d, record_time, bluetooth_device=bluetooth, mqtt_client=client,
-                                       mqtt_topic=f'{topic}/{d.address}', influxdb_api=influxdb_write_api,
-                                       influxdb_bucket=influxdb_database)
-                break
-        if connected_device is None:
+                                                org=influxdb_database).write_api(write_options=write_options)
+            if spool_directory is not None:
+                influxdb_write_api = SpoolingInfluxWriteApi(influxdb_write_api,
+                                                            os.path.join(spool_directory, 'influxdb'), spool_memory,
+                                                            spool_rate)
+
+        if metrics_port is not None:
+            start_metrics_server(metrics_port)
+        if stats_file is not None:
+            start_stats_file_writer(stats_file)
+
+        scanner_class = BleakScanner
+        client_class = BleakClient
+        if simulate > 0:
+            # record from simulated vests instead of bluetooth devices
+            for i in range(simulate):
+                simulated_devices.append(SimulatedVest(name=device_name, address=f'00:00:00:00:00:{i + 1:02X}'))
+            scanner_class = SimulatedBleakScanner
+            client_class = SimulatedBleakClient
+
+        cache = DeviceCache(device_cache) if device_cache is not None else None
+        logging.info(f'staring scanner for up to {scan_time} seconds')
+        found_devices = await find_devices(device_name, device_address, device_count, scan_time, scanner_class, cache)
+        if len(found_devices) == 0 and (rescan_interval is None or record_time is not None):
             logging.error(f'Failed to find any device to connect!')
+            return
+        # one recording session per device, all served by this event loop
+        sessions = {}
 
+        async def record_device(d, file_prefix):
+            connected = await start_connection(
+                d, record_time, bluetooth_device=bluetooth, mqtt_client=client, mqtt_topic=f'{topic}/{d.address}',
+                influxdb_api=influxdb_write_api, influxdb_bucket=influxdb_database, file_prefix=file_prefix,
+                file_format=file_format, mqtt_format=mqtt_format, mqtt_window=mqtt_window, gap_fill=gap_fill,
+                file_buffer_size=file_buffer_size, segment_seconds=segment_seconds, segment_bytes=segment_bytes,
+                compression=compression, journal=journal, calibrations=calibrations,
+                mqtt_decimation=mqtt_decimation, influxdb_decimation=influxdb_decimation, ring_seconds=ring_seconds,
+                store_bytes=store_bytes, cache=cache, client_class=client_class)
+            if not connected and cache is not None:
+                active = [address for address in sessions if address != d.address]
+                replacement = await scan_replacement(d, active, device_name, device_address, scan_time, scanner_class,
+                                                     cache)
+                if replacement is not None:
+                    start_session(replacement)
 
-asyncio.run(main(sys.argv[1:]))
+        def start_session(d):
+            file_prefix = '' if device_count == 1 and rescan_interval is None else f"{d.address.replace(':', '')}_"
+            sessions[d.address] = asyncio.ensure_future(record_device(d, file_prefix))
+            sessions[d.address].add_done_callback(
+                lambda task, address=d.address: sessions.pop(address) if sessions.get(address) is task else None)
+
+        for d in found_devices:
+            start_session(d)
+        rescan = None
+        if rescan_interval is not None:
+            rescan = asyncio.ensure_future(rescan_devices(start_session, sessions, device_name, device_address,
+                                                          rescan_interval, scan_time, scanner_class, cache))
+        try:
+            while len(sessions) > 0 or (rescan is not None and record_time is None):
+                if len(sessions) == 0:
+                    await asyncio.sleep(rescan_interval)
+                else:
+                    await asyncio.wait(list(sessions.values()))
+        finally:
+            if rescan is not None:
+                rescan.cancel()
+            if spool_directory is not None:
+                # the sessions flush their outputs on the way out, which have to be spooled before closing
+                tasks = list(sessions.values())
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                for output in (client, influxdb_write_api):
+                    if output is not None:
+                        output.close()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        # continuous recordings are stopped with ctrl-c, the open segments are finalized on the way out
+        logging.info('recording stopped')
@@ -0,0 +1,239 @@
+import struct
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+ring_magic = b'ECGR'
+ring_version = 1
+# magic, version, channel count, capacity in samples, sample rate, device address
+ring_header_format = '<4sHHId32s'
+# the counters start on their own cache line, the samples after them
+ring_counters_offset = 64
+ring_data_offset = 128
+# reserved: the end of the block being written, cursor: the end of the samples written, sequence: the blocks written,
+# closed: set once the writer is done
+ring_reserved, ring_cursor, ring_sequence, ring_closed = range(4)
+ring_channels = ('I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6')
+ring_poll_interval = 0.0005
+# the rings written by this process, whose resource tracker entries belong to the writer
+written_rings = set()
+
+
+def ring_name(address):
+    """
+    :param address: the address of the ECG device
+    :return: the name of the shared memory ring of the device
+    """
+    return f"ecg_ring_{address.replace(':', '').lower()}"
+
+
+def ring_size(capacity, channels):
+    """
+    :return: the size in bytes of a ring, every sample is stored twice
+    """
+    return ring_data_offset + 2 * capacity * (channels + 1) * 8
+
+
+class LiveRing:
+    """
+    Maps the samples of a shared memory ring. The ring holds the last capacity samples of a device, the timestamps in
+    epoch milliseconds and the channel voltages. Every sample is stored at its index modulo the capacity and again one
+    capacity further, so the last capacity samples can always be sliced as a single contiguous view.
+    """
+
+    def __init__(self, memory):
+        """
+        :param memory: the shared memory of the ring
+        """
+        self.memory = memory
+        magic, version, channels, capacity, sample_rate, address = struct.unpack_from(ring_header_format, memory.buf)
+        if magic != ring_magic or version != ring_version:
+            memory.close()
+            raise ValueError(f'{memory.name} is not a live ring')
+        self.channels = channels
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self.address = address.rstrip(b'\0').decode()
+        self.counters = np.ndarray(4, dtype=np.uint64, buffer=memory.buf, offset=ring_counters_offset)
+        self.timestamps = np.ndarray(2 * capacity, dtype=np.float64, buffer=memory.buf, offset=ring_data_offset)
+        self.values = np.ndarray((2 * capacity, channels), dtype=np.float64, buffer=memory.buf,
+                                 offset=ring_data_offset + 2 * capacity * 8)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    @property
+    def cursor(self):
+        """
+        :return: the number of samples written so far, the index of the next sample
+        """
+        return int(self.counters[ring_cursor])
+
+    @property
+    def sequence(self):
+        """
+        :return: the number of blocks written so far
+        """
+        return int(self.counters[ring_sequence])
+
+    @property
+    def closed(self):
+        return bool(self.counters[ring_closed])
+
+    @property
+    def oldest(self):
+        """
+        :return: the index of the oldest sample that is not being overwritten
+        """
+        return max(int(self.counters[ring_reserved]) - self.capacity, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Unmaps the ring, the views handed out must be released first
+        """
+        self.timestamps = self.values = self.counters = None
+        self.memory.close()
+
+
+class LiveRingWriter(LiveRing):
+    """
+    Writes the decoded samples of a device to a shared memory ring for the local consumers. There is a single writer,
+    which never waits on the readers.
+    """
+
+    def __init__(self, address, capacity, channels=len(ring_channels), sample_rate=500.0):
+        """
+        :param address: the address of the ECG device
+        :param capacity: the number of samples kept
+        :param channels: the number of values per sample
+        :param sample_rate: the sample rate in Hz
+        """
+        name = ring_name(address)
+        try:
+            # left behind by a writer that did not exit cleanly
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        memory = shared_memory.SharedMemory(name, create=True, size=ring_size(capacity, channels))
+        written_rings.add(name)
+        struct.pack_into(ring_header_format, memory.buf, 0, ring_magic, ring_version, channels, capacity, sample_rate,
+                         address.encode())
+        super().__init__(memory)
+        self.counters[:] = 0
+
+    def write(self, timestamps, values):
+        """
+        Appends a block of samples
+        :param timestamps: the timestamps of the samples in epoch milliseconds
+        :param values: the (samples x channels) values of the samples
+        """
+        count = len(timestamps)
+        if count == 0:
+            return
+        cursor = int(self.counters[ring_cursor])
+        if count > self.capacity:
+            cursor += count - self.capacity
+            timestamps, values = timestamps[-self.capacity:], values[-self.capacity:]
+            count = self.capacity
+        # the readers see the samples about to be overwritten before they are
+        self.counters[ring_reserved] = cursor + count
+        start = cursor % self.capacity
+        first = min(count, self.capacity - start)
+        for offset in (start, start + self.capacity):
+            self.timestamps[offset:offset + first] = timestamps[:first]
+            self.values[offset:offset + first] = values[:first]
+        if first < count:
+            rest = count - first
+            for offset in (0, self.capacity):
+                self.timestamps[offset:offset + rest] = timestamps[first:]
+                self.values[offset:offset + rest] = values[first:]
+        self.counters[ring_cursor] = cursor + count
+        self.counters[ring_sequence] += 1
+
+    def close(self):
+        self.counters[ring_closed] = 1
+        memory = self.memory
+        super().close()
+        memory.unlink()
+        written_rings.discard(memory.name)
+
+
+class LiveRingReader(LiveRing):
+    """
+    Reads the samples of a device from its shared memory ring, written by the receiver in another process. The views
+    returned are not copies, so the writer overwrites their samples once it is a whole capacity further. Check
+    intact(start) after a view has been consumed, and discard what was computed from it if the check fails.
+    """
+
+    def __init__(self, address=None, name=None):
+        """
+        :param address: the address of the ECG device
+        :param name: the name of the ring, instead of the address
+        """
+        name = name or ring_name(address)
+        if sys.version_info >= (3, 13):
+            memory = shared_memory.SharedMemory(name, track=False)
+        else:
+            memory = shared_memory.SharedMemory(name)
+            if name not in written_rings:
+                # the resource tracker would unlink the ring when the reader exits
+                resource_tracker.unregister(memory._name, 'shared_memory')
+        super().__init__(memory)
+        self.timestamps.flags.writeable = False
+        self.values.flags.writeable = False
+
+    def wait(self, cursor, timeout=None, interval=ring_poll_interval):
+        """
+        Waits until samples past a cursor are written
+        :param cursor: the number of samples already read
+        :param timeout: the maximum seconds to wait, None to wait until the writer closes the ring
+        :param interval: the seconds between the checks of the cursor
+        :return: the cursor of the ring, equal to the given one on timeout or if the ring is closed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            current = int(self.counters[ring_cursor])
+            if current > cursor or self.counters[ring_closed]:
+                return current
+            if deadline is not None and time.monotonic() >= deadline:
+                return current
+            time.sleep(interval)
+
+    def view(self, start, end):
+        """
+        :param start: the index of the first sample
+        :param end: the index after the last sample
+        :return: read-only views of the timestamps and the (samples x channels) values of the samples
+        """
+        if start < self.oldest or end > self.cursor or start > end:
+            raise ValueError(f'samples {start}-{end} are not in the ring, which holds {self.oldest}-{self.cursor}')
+        offset = start % self.capacity
+        return self.timestamps[offset:offset + end - start], self.values[offset:offset + end - start]
+
+    def latest(self, count):
+        """
+        :param count: the maximum number of samples
+        :return: the index of the first sample, and views of the last samples as view returns them
+        """
+        end = self.cursor
+        start = max(end - count, self.oldest)
+        offset = start % self.capacity
+        return start, self.timestamps[offset:offset + end - start], self.values[offset:offset + end - start]
+
+    def intact(self, start):
+        """
+        :param start: the index of the first sample of a view
+        :return: whether the samples of the view were not overwritten since it was taken
+        """
+        return start >= self.oldest
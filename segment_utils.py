@@ -0,0 +1,240 @@
+import gzip
+import io
+import json
+import logging
+import os
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+segment_compressions = ('none', 'gzip', 'zstd', 'lz4')
+segment_extensions = {'none': '', 'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+segment_part_extension = '.part'
+segment_index_extension = '.idx.json'
+# gzip level 6 costs about a third of level 9 for a slightly larger file
+segment_compression_levels = {'gzip': 6, 'zstd': 3, 'lz4': 0}
+
+
+def check_compression(compression):
+    """
+    Checks that a compression is known and its package is installed
+    :param compression: the compression of the segments (none, gzip, zstd or lz4)
+    """
+    if compression not in segment_compressions:
+        raise ValueError(f'unknown compression {compression}')
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression requires the zstandard package')
+    if compression == 'lz4' and lz4 is None:
+        raise ValueError('lz4 compression requires the lz4 package')
+
+
+def open_compressed_stream(raw, compression):
+    """
+    Wraps a binary file in a compressing stream, the file is left open when the stream is closed
+    :param raw: the binary file to write the compressed data to
+    :param compression: the compression of the stream (none, gzip, zstd or lz4)
+    :return: the stream to write the uncompressed data to
+    """
+    level = segment_compression_levels.get(compression)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=level).stream_writer(raw, closefd=False)
+    if compression == 'lz4':
+        return lz4.frame.LZ4FrameFile(raw, mode='wb', compression_level=level)
+    return None
+
+
+def open_segment(path):
+    """
+    Opens a finalized segment for reading, decompressing it based on its extension
+    :param path: the path of the segment
+    :return: the text stream of the segment
+    """
+    if path.endswith(segment_extensions['gzip']):
+        return gzip.open(path, 'rt')
+    if path.endswith(segment_extensions['zstd']):
+        check_compression('zstd')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    if path.endswith(segment_extensions['lz4']):
+        check_compression('lz4')
+        return lz4.frame.open(path, 'rt')
+    return open(path, 'r')
+
+
+def read_segment_index(path):
+    """
+    Reads the index of a segment
+    :param path: the path of the segment or of its index
+    :return: the index of the segment
+    """
+    if not path.endswith(segment_index_extension):
+        path = f'{path}{segment_index_extension}'
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def first_column(line):
+    """
+    :param line: a data line
+    :return: the value of the first column of the line
+    """
+    return float(line[:line.index(',')])
+
+
+class SegmentWriter:
+    """
+    Text sink of a long-running recording. The data are split in segments rotated by duration or size, each segment is
+    compressed as a stream, written as a .part file and renamed to its final name along with its index once complete.
+    """
+
+    def __init__(self, filename, extension, segment_seconds=None, segment_bytes=None, compression='none',
+                 buffer_size=-1):
+        """
+        :param filename: the name of the recording without extension, segments are numbered after it
+        :param extension: the extension of the data (ecg or acc)
+        :param segment_seconds: the duration of a segment in seconds, None to not rotate by duration
+        :param segment_bytes: the size of a segment on disk in bytes, None to not rotate by size
+        :param compression: the compression of the segments (none, gzip, zstd or lz4)
+        :param buffer_size: the buffer size in bytes of the segment files, -1 for the default of the platform
+        """
+        check_compression(compression)
+        self.filename = filename
+        self.extension = extension
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.segment = -1
+        self.segments = []
+        self.path = None
+        self.raw = None
+        self.stream = None
+        self.opened = 0.0
+        self.opened_monotonic = 0.0
+        self.samples = 0
+        self.bytes = 0
+        self.first_line = None
+        self.last_text = None
+        self.gaps = []
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def segment_path(self, segment):
+        """
+        :param segment: the number of the segment
+        :return: the final path of the segment
+        """
+        return f'{self.filename}_{segment:05d}.{self.extension}{segment_extensions[self.compression]}'
+
+    def open_segment(self):
+        """
+        Starts the next segment
+        """
+        self.segment += 1
+        self.path = self.segment_path(self.segment)
+        self.raw = open(f'{self.path}{segment_part_extension}', 'wb', buffering=self.buffer_size)
+        self.stream = open_compressed_stream(self.raw, self.compression) or self.raw
+        self.opened = time.time()
+        self.opened_monotonic = time.monotonic()
+        self.samples = 0
+        self.bytes = 0
+        self.first_line = None
+        self.last_text = None
+        self.gaps = []
+
+    def rotation_due(self):
+        """
+        :return: whether the current segment has reached its duration or size
+        """
+        if self.segment_seconds is not None and time.monotonic() - self.opened_monotonic >= self.segment_seconds:
+            return True
+        return self.segment_bytes is not None and self.raw.tell() >= self.segment_bytes
+
+    def write(self, text):
+        """
+        Writes data lines or comments to the current segment, rotating it first if it is due. Each call is expected to
+        hold whole lines, so segments always start on a line.
+        :param text: the text to write
+        """
+        if self.closed:
+            raise ValueError(f'write to closed segment writer {self.filename}.{self.extension}')
+        if self.stream is None:
+            self.open_segment()
+        elif self.samples > 0 and self.rotation_due():
+            self.finalize_segment()
+            self.open_segment()
+        data = text.encode()
+        self.stream.write(data)
+        self.bytes += len(data)
+        if not text.startswith('#'):
+            self.samples += text.count('\n')
+            if self.first_line is None:
+                self.first_line = text
+            self.last_text = text
+
+    def write_gap(self, current, last, missed, samples):
+        """
+        Records missing packets before the next sample in the index of the current segment
+        :param current: the current packet sequence number
+        :param last: the last received packet sequence number
+        :param missed: the missed packets
+        :param samples: the samples carried by the missed packets
+        """
+        if self.stream is None:
+            self.open_segment()
+        self.gaps.append((self.samples, last, current, missed, samples))
+
+    def index(self):
+        """
+        :return: the index of the current segment
+        """
+        first_time = last_time = None
+        if self.first_line is not None:
+            first_time = first_column(self.first_line)
+            last_time = first_column(self.last_text[self.last_text.rfind('\n', 0, len(self.last_text) - 1) + 1:])
+        return {'segment': self.segment, 'path': os.path.basename(self.path), 'compression': self.compression,
+                'opened': self.opened, 'closed': time.time(), 'first_time': first_time, 'last_time': last_time,
+                'samples': self.samples, 'bytes': self.bytes, 'gaps': self.gaps}
+
+    def finalize_segment(self):
+        """
+        Completes the current segment, the segment only appears under its final name once fully written
+        """
+        if self.stream is not self.raw:
+            self.stream.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        index = self.index()
+        index['compressed_bytes'] = self.raw.tell()
+        self.raw.close()
+        with open(f'{self.path}{segment_index_extension}.tmp', 'w') as file:
+            json.dump(index, file)
+        os.replace(f'{self.path}{segment_index_extension}.tmp', f'{self.path}{segment_index_extension}')
+        os.replace(f'{self.path}{segment_part_extension}', self.path)
+        self.segments.append(self.path)
+        logging.info(f'finalized segment {self.path} with {self.samples} samples, {self.bytes} bytes compressed to '
+                     f'{index["compressed_bytes"]}')
+        self.stream = self.raw = None
+
+    def close(self):
+        """
+        Finalizes the current segment
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.stream is not None:
+            self.finalize_segment()
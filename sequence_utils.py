@@ -0,0 +1,97 @@
+from collections import deque
+
+packet_in_order = 'in_order'
+packet_gap = 'gap'
+packet_duplicate = 'duplicate'
+packet_late = 'late'
+packet_resumed = 'resumed'
+
+
+class SequenceTracker:
+    """
+    Tracks the 8bit sequence numbers of a notification stream, classifies every packet and keeps loss statistics
+    """
+    __slots__ = ('modulus', 'late_window', 'last', 'received', 'missed', 'duplicates', 'late', 'gaps', 'resumed')
+
+    def __init__(self, modulus=256, late_window=16, max_gaps=1000):
+        """
+        :param modulus: the number of distinct sequence numbers
+        :param late_window: how far behind the last sequence number a packet is considered late instead of a gap
+        :param max_gaps: the number of most recent gaps kept in the gap index
+        """
+        self.modulus = modulus
+        self.late_window = late_window
+        self.last = -1
+        self.received = 0
+        self.missed = 0
+        self.duplicates = 0
+        self.late = 0
+        # (packets received before the gap, missed packets)
+        self.gaps = deque(maxlen=max_gaps)
+        # the packets missed while the stream was interrupted, set until the stream resumes
+        self.resumed = None
+
+    def update(self, sequence_no):
+        """
+        Classifies a packet based on its sequence number
+        :param sequence_no: the sequence number of the packet
+        :return: the classification of the packet and the number of packets missed before it
+        """
+        if self.resumed is not None:
+            return self.resume_with(sequence_no)
+        if self.last == -1:
+            # the stream is expected to start from 0
+            delta = sequence_no + 1
+        elif self.last == self.modulus - 2 and sequence_no == 0:
+            # some firmware wraps after modulus - 2
+            delta = 1
+        else:
+            delta = (sequence_no - self.last) % self.modulus
+        if delta == 0:
+            self.duplicates += 1
+            return packet_duplicate, 0
+        if self.last != -1 and delta > self.modulus - self.late_window:
+            self.late += 1
+            return packet_late, 0
+        self.last = sequence_no
+        self.received += 1
+        if delta == 1:
+            return packet_in_order, 0
+        missing = delta - 1
+        self.missed += missing
+        self.gaps.append((self.received - 1, missing))
+        return packet_gap, missing
+
+    def resume(self, missed):
+        """
+        Marks the stream as interrupted, e.g. by a reconnect. The sequence numbers do not carry over an interruption, so
+        the next packet is accepted whatever its sequence number and the missed packets are the ones given.
+        :param missed: the packets missed while the stream was interrupted
+        """
+        self.resumed = missed
+
+    def resume_with(self, sequence_no):
+        """
+        Accepts the first packet after an interruption
+        :param sequence_no: the sequence number of the packet
+        :return: the classification of the packet and the number of packets missed before it
+        """
+        missing = self.resumed
+        self.resumed = None
+        self.last = sequence_no
+        self.received += 1
+        if missing > 0:
+            self.missed += missing
+            self.gaps.append((self.received - 1, missing))
+        return packet_resumed, missing
+
+    def loss_ratio(self):
+        """
+        :return: the fraction of the packets sent that were missed
+        """
+        total = self.received + self.missed
+        return self.missed / total if total > 0 else 0.0
+
+    def stats(self):
+        return {'received': self.received, 'missed': self.missed, 'duplicates': self.duplicates, 'late': self.late,
+                'loss_ratio': self.loss_ratio()}
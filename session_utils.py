@@ -0,0 +1,44 @@
+from buffer_utils import LeadRingBuffer
+from calibration_utils import default_calibration
+from qrs_utils import QrsDetector
+from sequence_utils import SequenceTracker
+
+single_sample_length = 8
+
+
+class RecordingSession:
+    """
+    Holds the decoding, calibration, sequence, QRS detection and battery state of a single ECG device recording
+    """
+    __slots__ = ('address', 'battery', 'gap_fill', 'int_values', 'qrs', 'calibration', 'ecg_sequence',
+                 'ecg_recording_start', 'ecg_recording_timestamp', 'acc_sequence', 'acc_recording_timestamp',
+                 'acc_recording_offset')
+
+    def __init__(self, address=None, gap_fill=None, calibration=default_calibration):
+        """
+        :param address: the address of the ECG device
+        :param gap_fill: the value of the placeholder rows written for missed samples, None to only report the gaps
+        :param calibration: the derivation of the channels and their conversion to volts
+        """
+        self.address = address
+        self.battery = 0
+        self.gap_fill = gap_fill
+        self.int_values = LeadRingBuffer(single_sample_length)
+        self.qrs = QrsDetector()
+        self.calibration = calibration
+        self.ecg_sequence = SequenceTracker()
+        self.ecg_recording_start = -1
+        self.ecg_recording_timestamp = -1
+        self.acc_sequence = SequenceTracker()
+        self.acc_recording_timestamp = -1
+        # the accelerometer timestamp at the start of the ecg clock, which aligns the accelerometer stream to it
+        self.acc_recording_offset = 0.0
+
+    def start_ecg_clock(self, start):
+        """
+        Starts the ecg timeline of the recording, noting how far the accelerometer stream already advanced
+        :param start: the epoch milliseconds of the first ecg sample
+        """
+        self.ecg_recording_timestamp = 0.0
+        self.ecg_recording_start = start
+        self.acc_recording_offset = max(self.acc_recording_timestamp, 0.0)
@@ -0,0 +1,314 @@
+import asyncio
+import random
+
+import numpy as np
+
+import acc_utils
+import ecg_utils
+from device_utils import battery_c_uuid, cardio_command_c_uuid, cardio_datastream_c_uuid, \
+    cardio_accelerometer_ch_uuid, data_service_uuid, firmware_revision_c_uuid
+
+ecg_packet_samples = 20
+ecg_sample_rate = 1000.0 / ecg_utils.sample_interval_millis
+acc_sample_rate = 1000.0 / acc_utils.sample_interval_millis
+ecg_baseline = 2048
+
+simulated_devices = []
+
+
+def pack_lead_values(values):
+    """
+    Packs 12bit measurements to bytes, the inverse of ecg_utils.unpack_lead_values
+    :param values: the measurements to pack, an even number of values
+    :return: the packed bytes
+    """
+    values = np.asarray(values, dtype=np.uint16).reshape(-1, 2)
+    packed = np.empty((len(values), 3), dtype=np.uint8)
+    packed[:, 0] = values[:, 0] & 0xFF
+    packed[:, 1] = (values[:, 0] >> 8) | ((values[:, 1] & 0x0F) << 4)
+    packed[:, 2] = values[:, 1] >> 4
+    return packed.tobytes()
+
+
+def synthetic_ecg(sample_count, heart_rate=60.0, sample_rate=ecg_sample_rate, amplitude=600.0, noise=0.0, start=0,
+                  rng=None):
+    """
+    Generates a synthetic ECG waveform with P, QRS and T waves at a fixed heart rate
+    :param sample_count: the number of samples to generate
+    :param heart_rate: the heart rate in beats per minute
+    :param sample_rate: the sample rate in Hz
+    :param amplitude: the amplitude of the R wave in adc units
+    :param noise: the standard deviation of the added noise in adc units
+    :param start: the index of the first sample, used to continue a waveform
+    :param rng: the numpy random generator of the noise
+    :return: the waveform in adc units around zero and the indices of the R peaks
+    """
+    t = (np.arange(sample_count) + start) / sample_rate
+    beat = 60.0 / heart_rate
+    phase = np.mod(t, beat)
+    wave = (0.15 * np.exp(-((phase - 0.20) / 0.025) ** 2)
+            - 0.10 * np.exp(-((phase - 0.29) / 0.008) ** 2)
+            + 1.00 * np.exp(-((phase - 0.31) / 0.010) ** 2)
+            - 0.20 * np.exp(-((phase - 0.33) / 0.008) ** 2)
+            + 0.30 * np.exp(-((phase - 0.55) / 0.050) ** 2))
+    wave = wave * amplitude
+    if noise > 0:
+        wave = wave + (rng or np.random.default_rng()).normal(0, noise, sample_count)
+    peaks = []
+    k = max(0, int(np.ceil((start / sample_rate - 0.31) / beat)))
+    while int(round((k * beat + 0.31) * sample_rate)) < start + sample_count:
+        peaks.append(int(round((k * beat + 0.31) * sample_rate)) - start)
+        k += 1
+    return wave, [p for p in peaks if p >= 0]
+
+
+class SimulatedVest:
+    """
+    Generates the notifications of an ECG vest: ecg datastream, accelerometer and battery
+    """
+
+    def __init__(self, name='ECG2.0-n', address='00:00:00:00:00:01', heart_rate=60.0, battery=95, loss=0.0,
+                 reorder=0.0, noise=0.0, seed=None, dropout_interval=None, dropout_seconds=1.0, firmware='2.0'):
+        """
+        :param name: the advertised name of the vest
+        :param address: the address of the vest
+        :param heart_rate: the heart rate of the generated waveform in beats per minute
+        :param battery: the battery level reported
+        :param loss: the probability of a packet being lost
+        :param reorder: the probability of a packet being swapped with the next one
+        :param noise: the standard deviation of the noise added to the waveform in adc units
+        :param seed: the seed of the random generator for repeatable streams
+        :param dropout_interval: the time in seconds a connection lasts before the link drops, None to never drop
+        :param dropout_seconds: the time in seconds the vest is unreachable after the link drops
+        :param firmware: the firmware revision reported
+        """
+        self.name = name
+        self.address = address
+        self.heart_rate = heart_rate
+        self.battery = battery
+        self.loss = loss
+        self.reorder = reorder
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.rng = np.random.default_rng(seed)
+        self.ecg_sequence = 0
+        self.acc_sequence = 0
+        self.ecg_samples = 0
+        self.acc_samples = 0
+        self.held = {}
+        self.dropout_interval = dropout_interval
+        self.dropout_seconds = dropout_seconds
+        self.firmware = firmware
+        self.disconnected_at = None
+        self.unreachable_until = 0.0
+
+    def ecg_leads(self, sample_count):
+        """
+        Generates the raw values of the 8 leads for the next samples
+        :param sample_count: the number of samples
+        :return: the (samples x 8) lead values
+        """
+        wave, _ = synthetic_ecg(sample_count, self.heart_rate, noise=self.noise, start=self.ecg_samples, rng=self.rng)
+        self.ecg_samples += sample_count
+        scale = np.array([1.0, -0.5, 0.3, 0.6, 0.9, 1.0, 0.8, 0.5])
+        leads = ecg_baseline + wave[:, None] * scale[None, :]
+        return np.clip(np.round(leads), 0, 4095).astype(np.uint16)
+
+    def ecg_packet(self):
+        """
+        Generates the next ecg datastream notification
+        :return: the notification bytes
+        """
+        sequence = self.ecg_sequence
+        self.ecg_sequence = (self.ecg_sequence + 1) % 256
+        leads = self.ecg_leads(ecg_packet_samples)
+        return bytearray(bytes((sequence, 0, 0, 0, 0)) + pack_lead_values(leads.reshape(-1)))
+
+    def acc_packet(self):
+        """
+        Generates the next accelerometer notification
+        :return: the notification bytes
+        """
+        sequence = self.acc_sequence
+        self.acc_sequence = (self.acc_sequence + 1) % 256
+        t = (np.arange(acc_utils.acc_data_frames) + self.acc_samples) / acc_sample_rate
+        self.acc_samples += acc_utils.acc_data_frames
+        frames = np.empty((acc_utils.acc_data_frames, 6))
+        frames[:, 0] = 0.1 * np.sin(2 * np.pi * 0.5 * t)
+        frames[:, 1] = 0.05 * np.cos(2 * np.pi * 0.5 * t)
+        frames[:, 2] = -1.0 + 0.02 * np.sin(2 * np.pi * 1.0 * t)
+        frames[:, 3:] = 5.0 * np.sin(2 * np.pi * 0.25 * t)[:, None]
+        raw = np.empty_like(frames)
+        raw[:, :3] = frames[:, :3] * 1000 / 0.061
+        raw[:, 3:] = frames[:, 3:] * 1000 / 8.75
+        payload = np.round(raw).astype('<i2').tobytes()
+        return bytearray(bytes((sequence, 0, 0, 0, 0)) + payload)
+
+    def stream(self, name, packet, count):
+        """
+        Generates notifications applying the configured loss and reordering
+        :param name: the name of the stream
+        :param packet: the function generating the next notification
+        :param count: the number of notifications generated before loss
+        :return: the notifications
+        """
+        for _ in range(count):
+            data = packet()
+            if self.random.random() < self.loss:
+                continue
+            held = self.held.pop(name, None)
+            if held is not None:
+                yield data
+                yield held
+            elif self.random.random() < self.reorder:
+                self.held[name] = data
+            else:
+                yield data
+
+    def skip(self, seconds):
+        """
+        Advances the streams as if the given time passed while nothing was received
+        :param seconds: the time passed
+        """
+        for _ in range(int(round(seconds * ecg_sample_rate / ecg_packet_samples))):
+            self.ecg_packet()
+        for _ in range(int(round(seconds * acc_sample_rate / acc_utils.acc_data_frames))):
+            self.acc_packet()
+
+    def ecg_packets(self, count):
+        return self.stream('ecg', self.ecg_packet, count)
+
+    def acc_packets(self, count):
+        return self.stream('acc', self.acc_packet, count)
+
+
+class SimulatedDevice:
+    """
+    The advertisement of a simulated vest, as reported by the scanner
+    """
+
+    def __init__(self, vest):
+        self.name = vest.name
+        self.address = vest.address
+        self.rssi = -60
+        self.metadata = {'uuids': [data_service_uuid]}
+
+
+class SimulatedBleakScanner:
+    """
+    Stand-in for bleak.BleakScanner that discovers the vests in simulated_devices
+    """
+
+    def __init__(self, detection_callback=None, **kwargs):
+        self.detection_callback = detection_callback
+        self.discovered_devices = []
+
+    async def start(self):
+        self.discovered_devices = [SimulatedDevice(vest) for vest in simulated_devices]
+        if self.detection_callback is not None:
+            for device in self.discovered_devices:
+                self.detection_callback(device, None)
+
+    async def stop(self):
+        pass
+
+
+class SimulatedBleakClient:
+    """
+    Stand-in for bleak.BleakClient that streams the notifications of a vest in simulated_devices in real time
+    """
+
+    def __init__(self, address, device=None, disconnected_callback=None, speed=1.0, **kwargs):
+        """
+        :param address: the address of the vest
+        :param device: the bluetooth device to use, ignored
+        :param disconnected_callback: called when the vest disconnects
+        :param speed: how many times faster than real time the notifications are sent
+        """
+        self.address = address
+        self.disconnected_callback = disconnected_callback
+        self.speed = speed
+        self.vest = None
+        self.is_connected = False
+        self.streaming = {}
+        self.tasks = []
+
+    async def connect(self):
+        matching = [vest for vest in simulated_devices if vest.address == self.address]
+        if len(matching) == 0:
+            raise ConnectionError(f'device {self.address} not found')
+        vest = matching[0]
+        now = asyncio.get_running_loop().time()
+        if now < vest.unreachable_until:
+            raise ConnectionError(f'device {self.address} not reachable')
+        if vest.disconnected_at is not None:
+            # the vest kept sampling while disconnected
+            vest.skip((now - vest.disconnected_at) * self.speed)
+            vest.disconnected_at = None
+        self.vest = vest
+        self.is_connected = True
+        if vest.dropout_interval is not None:
+            self.tasks.append(asyncio.ensure_future(self.dropout()))
+
+    async def dropout(self):
+        """
+        Drops the link after the dropout interval of the vest
+        """
+        await asyncio.sleep(self.vest.dropout_interval / self.speed)
+        loop = asyncio.get_running_loop()
+        self.vest.disconnected_at = loop.time()
+        self.vest.unreachable_until = loop.time() + self.vest.dropout_seconds / self.speed
+        self.tasks.remove(asyncio.current_task())
+        await self.disconnect()
+
+    async def disconnect(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        was_connected = self.is_connected
+        self.is_connected = False
+        if was_connected and self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    async def read_gatt_char(self, uuid):
+        if uuid == battery_c_uuid:
+            return bytearray((self.vest.battery,))
+        if uuid == firmware_revision_c_uuid:
+            return bytearray(self.vest.firmware.encode())
+        return bytearray()
+
+    async def write_gatt_char(self, uuid, data, response=None):
+        if uuid == cardio_command_c_uuid:
+            command = data[0]
+            if command in (2, 3):
+                self.streaming['ecg'] = command == 2
+            elif command in (6, 7):
+                self.streaming['acc'] = command == 6
+
+    async def start_notify(self, uuid, callback):
+        if uuid == cardio_datastream_c_uuid:
+            self.tasks.append(asyncio.ensure_future(self.notify('ecg', self.vest.ecg_packets, callback,
+                                                                ecg_packet_samples / ecg_sample_rate)))
+        elif uuid == cardio_accelerometer_ch_uuid:
+            self.tasks.append(asyncio.ensure_future(self.notify('acc', self.vest.acc_packets, callback,
+                                                                acc_utils.acc_data_frames / acc_sample_rate)))
+
+    async def stop_notify(self, uuid):
+        pass
+
+    async def notify(self, stream, packets, callback, interval):
+        """
+        Sends the notifications of a stream while it is enabled
+        :param stream: the name of the stream
+        :param packets: the generator of the stream's notifications
+        :param callback: the notification callback
+        :param interval: the time between notifications in seconds
+        """
+        loop = asyncio.get_running_loop()
+        next_time = loop.time()
+        while True:
+            next_time += interval / self.speed
+            await asyncio.sleep(max(0.0, next_time - loop.time()))
+            if self.streaming.get(stream):
+                for data in packets(1):
+                    callback(self, data)
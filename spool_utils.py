@@ -0,0 +1,407 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+# payload length, crc32 of the key and the payload, key length, payload is text
+spool_record_header = struct.Struct('<IIH?')
+spool_segment_bytes = 16 * 1024 * 1024
+spool_segment_prefix = 'spool_'
+spool_segment_extension = '.log'
+spool_cursor_file = 'cursor.json'
+spool_memory_bytes = 8 * 1024 * 1024
+spool_batch_records = 500
+spool_batch_bytes = 1024 * 1024
+# records per second replayed from the spool, the live records always go first
+spool_drain_rate = 200.0
+spool_retry_delay = 1.0
+spool_max_retry_delay = 30.0
+# unacknowledged qos 1 messages in the mqtt client before the broker counts as too slow
+spool_mqtt_inflight = 1000
+
+
+class Spool:
+    """
+    Append-only log of the records a remote could not take, split in segments and replayed in order. The position of
+    the next record to replay is kept in a cursor file, and the segments are deleted once fully replayed, so the
+    backlog survives a restart.
+    """
+
+    def __init__(self, directory, segment_bytes=spool_segment_bytes):
+        """
+        :param directory: the directory of the segments, created if missing
+        :param segment_bytes: the size of a segment in bytes before the next one is started
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.appended = 0
+        self.replayed = 0
+        segments = sorted(int(name[len(spool_segment_prefix):-len(spool_segment_extension)])
+                          for name in os.listdir(directory)
+                          if name.startswith(spool_segment_prefix) and name.endswith(spool_segment_extension))
+        self.read_segment, self.read_offset = segments[0] if segments else 0, 0
+        try:
+            with open(os.path.join(directory, spool_cursor_file), 'r') as file:
+                cursor = json.load(file)
+            if cursor['segment'] in segments:
+                self.read_segment, self.read_offset = cursor['segment'], cursor['offset']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f'ignoring the spool cursor in {directory}: {e}')
+        for segment in segments:
+            if segment < self.read_segment:
+                os.remove(self.segment_path(segment))
+        segments = [segment for segment in segments if segment >= self.read_segment]
+        self.backlog = sum(os.path.getsize(self.segment_path(segment)) for segment in segments) - self.read_offset
+        if self.backlog > 0:
+            logging.info(f'spool {directory} has {self.backlog} bytes left to replay')
+            # appends go to a new segment, the last one may end in a record cut short by a crash
+            self.write_segment = segments[-1] + 1
+        else:
+            for segment in segments:
+                os.remove(self.segment_path(segment))
+            self.read_segment, self.read_offset = 0, 0
+            self.backlog = 0
+            self.write_segment = 0
+        self.file = open(self.segment_path(self.write_segment), 'ab')
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f'{spool_segment_prefix}{segment:08d}{spool_segment_extension}')
+
+    def __len__(self):
+        """
+        :return: the bytes left to replay
+        """
+        return self.backlog
+
+    def append(self, records):
+        """
+        Appends records to the end of the spool in a single write
+        :param records: the (key, data) records, the data as bytes or text
+        """
+        parts = []
+        for key, data in records:
+            is_text = isinstance(data, str)
+            key_bytes = key.encode()
+            data_bytes = data.encode() if is_text else bytes(data)
+            parts.append(spool_record_header.pack(len(data_bytes), zlib.crc32(data_bytes, zlib.crc32(key_bytes)),
+                                                  len(key_bytes), is_text))
+            parts.append(key_bytes)
+            parts.append(data_bytes)
+        chunk = b''.join(parts)
+        with self.lock:
+            if 0 < self.file.tell() and self.file.tell() + len(chunk) > self.segment_bytes:
+                self.file.close()
+                self.write_segment += 1
+                self.file = open(self.segment_path(self.write_segment), 'ab')
+            self.file.write(chunk)
+            self.file.flush()
+            self.backlog += len(chunk)
+            self.appended += len(records)
+
+    def read(self, max_records=spool_batch_records, max_bytes=spool_batch_bytes):
+        """
+        Reads the next records to replay without removing them, at least one if the spool is not empty
+        :param max_records: the maximum number of records to read
+        :param max_bytes: the maximum size of the records to read
+        :return: the (key, data) records and the position after each of them, to commit once they are sent
+        """
+        records = []
+        positions = []
+        size = 0
+        with self.lock:
+            segment, offset = self.read_segment, self.read_offset
+            while True:
+                path = self.segment_path(segment)
+                end_offset = os.path.getsize(path)
+                if end_offset > offset:
+                    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        while offset < end_offset and len(records) < max_records and (size < max_bytes or not records):
+                            start = offset + spool_record_header.size
+                            end = end_offset + 1
+                            if start <= end_offset:
+                                length, crc, key_length, is_text = spool_record_header.unpack_from(data, offset)
+                                end = start + key_length + length
+                            if end > end_offset or zlib.crc32(data[start + key_length:end],
+                                                              zlib.crc32(data[start:start + key_length])) != crc:
+                                # a record cut short by a crash, the end of the segment is dropped
+                                logging.warning(f'dropping {end_offset - offset} corrupt bytes at the end of {path}')
+                                self.backlog -= end_offset - offset
+                                end_offset = offset
+                                break
+                            key, payload = data[start:start + key_length], data[start + key_length:end]
+                            records.append((key.decode(), payload.decode() if is_text else payload))
+                            positions.append((segment, end))
+                            size += end - offset
+                            offset = end
+                    if end_offset < os.path.getsize(path):
+                        os.truncate(path, end_offset)
+                if offset < end_offset or segment >= self.write_segment:
+                    break
+                segment, offset = segment + 1, 0
+                if len(positions) > 0 and positions[-1][0] == segment - 1:
+                    # committing the last record of a segment drops the segment
+                    positions[-1] = (segment, 0)
+        return records, positions
+
+    def commit(self, position, count):
+        """
+        Removes the records before a position once they are sent
+        :param position: a position returned by read
+        :param count: the number of records removed
+        """
+        with self.lock:
+            segment, offset = position
+            removed = 0
+            while self.read_segment < segment:
+                removed += os.path.getsize(self.segment_path(self.read_segment)) - self.read_offset
+                os.remove(self.segment_path(self.read_segment))
+                self.read_segment, self.read_offset = self.read_segment + 1, 0
+            removed += offset - self.read_offset
+            self.read_offset = offset
+            self.backlog -= removed
+            self.replayed += count
+            if self.backlog == 0 and self.read_segment == self.write_segment:
+                # the last segment is started over once fully replayed
+                self.file.truncate(0)
+                self.file.seek(0)
+                self.read_offset = 0
+            cursor_path = os.path.join(self.directory, spool_cursor_file)
+            with open(f'{cursor_path}.tmp', 'w') as file:
+                json.dump({'segment': self.read_segment, 'offset': self.read_offset}, file)
+            os.replace(f'{cursor_path}.tmp', cursor_path)
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+class SpooledSender:
+    """
+    Sends records to a remote from a thread of its own, so a slow or unreachable remote never blocks the recording.
+    The live records are kept in memory up to a limit and the oldest ones beyond it are spilled to the spool, and
+    whatever the remote does not take is spooled as well. The spool is only written by the sender thread. Once the remote
+    takes records again the spool is replayed in large batches at a limited rate, after the live records, so catching up
+    does not starve the live data.
+    """
+
+    def __init__(self, name, send, spool, memory_bytes=spool_memory_bytes, batch_records=spool_batch_records,
+                 batch_bytes=spool_batch_bytes, drain_rate=spool_drain_rate, retry_delay=spool_retry_delay,
+                 max_retry_delay=spool_max_retry_delay):
+        """
+        :param name: the name of the remote for the logs
+        :param send: sends a list of (key, data) records in order and returns how many were taken, raising counts as 0
+        :param spool: the spool of the records the remote did not take
+        :param memory_bytes: the maximum size of the live records kept in memory
+        :param batch_records: the maximum number of records sent at once
+        :param batch_bytes: the maximum size of the records sent at once
+        :param drain_rate: the spooled records replayed per second, None to replay as fast as the remote takes them
+        :param retry_delay: the seconds to wait before the first retry of an unreachable remote
+        :param max_retry_delay: the maximum seconds between the retries, the delay doubles after every failure
+        """
+        self.name = name
+        self.send = send
+        self.spool = spool
+        self.memory_bytes = memory_bytes
+        self.batch_records = batch_records
+        self.batch_bytes = batch_bytes
+        self.drain_rate = drain_rate
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.queue = deque()
+        self.queued_bytes = 0
+        # the oldest records beyond the memory limit, handed to the sender thread to spool
+        self.spilled = []
+        self.condition = threading.Condition()
+        self.online = True
+        self.closed = False
+        self.sent = 0
+        self.replayed = 0
+        self.thread = threading.Thread(target=self.run, name=f'{name}-sender', daemon=True)
+        self.thread.start()
+
+    def put(self, key, data):
+        """
+        Queues a record to send, the oldest queued records beyond the memory limit are spooled by the sender thread
+        :param key: the topic or bucket of the record
+        :param data: the payload of the record, bytes or text
+        """
+        with self.condition:
+            self.queue.append((key, data))
+            self.queued_bytes += len(data)
+            while self.queued_bytes > self.memory_bytes and len(self.queue) > 1:
+                record = self.queue.popleft()
+                self.queued_bytes -= len(record[1])
+                self.spilled.append(record)
+            self.condition.notify()
+
+    def take_batch(self):
+        batch = []
+        size = 0
+        while self.queue and len(batch) < self.batch_records and (size < self.batch_bytes or not batch):
+            record = self.queue.popleft()
+            batch.append(record)
+            size += len(record[1])
+        self.queued_bytes -= size
+        return batch
+
+    def try_send(self, records):
+        try:
+            return self.send(records)
+        except Exception as e:
+            logging.debug(f'failed to send {len(records)} records to {self.name}: {e}')
+            return 0
+
+    def run(self):
+        delay = self.retry_delay
+        next_attempt = 0.0
+        next_drain = 0.0
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if self.closed and not self.spilled and (not self.queue or not self.online):
+                        return
+                    due = next_attempt if not self.online else 0.0 if self.queue else next_drain
+                    ready = (self.queue or len(self.spool) > 0) and now >= due
+                    if ready or self.spilled:
+                        break
+                    self.condition.wait(due - now if self.queue or len(self.spool) > 0 else None)
+                spilled, self.spilled = self.spilled, []
+                batch = self.take_batch() if ready else []
+            if len(spilled) > 0:
+                # older than the batch, so spooled first
+                self.spool.append(spilled)
+            if not ready:
+                continue
+            if len(batch) > 0:
+                sent = self.try_send(batch)
+                self.sent += sent
+                if sent < len(batch):
+                    self.spool.append(batch[sent:])
+            else:
+                records, positions = self.spool.read(self.batch_records, self.batch_bytes)
+                sent = self.try_send(records) if len(records) > 0 else 0
+                if sent > 0:
+                    self.spool.commit(positions[sent - 1], sent)
+                    self.replayed += sent
+                    if self.drain_rate:
+                        next_drain = time.monotonic() + sent / self.drain_rate
+                batch = records
+            if sent < len(batch):
+                if self.online:
+                    logging.warning(f'{self.name} is not taking records, spooling them to {self.spool.directory}')
+                self.online = False
+                next_attempt = time.monotonic() + delay
+                delay = min(delay * 2, self.max_retry_delay)
+            elif not self.online:
+                logging.info(f'{self.name} is taking records again, replaying {len(self.spool)} spooled bytes')
+                self.online = True
+                delay = self.retry_delay
+
+    def close(self, timeout=10.0):
+        """
+        Sends the queued records if the remote takes them, and spools the rest for the next run
+        :param timeout: the maximum seconds to wait for the queued records to be sent
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join(timeout)
+        with self.condition:
+            remaining = self.spilled + list(self.queue)
+            self.spilled = []
+            self.queue.clear()
+            self.queued_bytes = 0
+        if len(remaining) > 0:
+            self.spool.append(remaining)
+        if len(self.spool) > 0:
+            logging.info(f'{len(self.spool)} bytes for {self.name} left in {self.spool.directory}')
+        self.spool.close()
+
+    def stats(self):
+        return {'online': self.online, 'sent': self.sent, 'replayed': self.replayed, 'queued': len(self.queue),
+                'spooled': self.spool.appended, 'backlog_bytes': len(self.spool)}
+
+
+class SpoolingMqttClient:
+    """
+    Wraps an mqtt client so the published messages are spooled to disk while the broker is unreachable or too slow, and
+    replayed once it catches up. The messages are published with qos 1, and a broker that leaves more of them
+    unacknowledged than the client's max_queued_messages_set limit, e.g. spool_mqtt_inflight, counts as too slow.
+    """
+
+    def __init__(self, mqtt_client, spool_directory, memory_bytes=spool_memory_bytes, drain_rate=spool_drain_rate):
+        """
+        :param mqtt_client: the paho mqtt client, with its network loop started
+        :param spool_directory: the directory of the spooled messages
+        :param memory_bytes: the maximum size of the messages kept in memory
+        :param drain_rate: the spooled messages replayed per second
+        """
+        self.mqtt_client = mqtt_client
+        self.sender = SpooledSender('mqtt', self.send, Spool(spool_directory), memory_bytes, drain_rate=drain_rate)
+
+    def publish(self, topic, payload):
+        self.sender.put(topic, payload)
+
+    def send(self, records):
+        if not self.mqtt_client.is_connected():
+            return 0
+        for i, (topic, payload) in enumerate(records):
+            if self.mqtt_client.publish(topic, payload, qos=1).rc != 0:
+                return i
+        return len(records)
+
+    def close(self):
+        self.sender.close()
+        logging.info(f'mqtt spool stats: {self.sender.stats()}')
+
+
+class SpoolingInfluxWriteApi:
+    """
+    Wraps a synchronous influxdb write api so the written lines are spooled to disk while influxdb is unreachable or
+    failing, and replayed once it takes writes again. The lines of a batch are written in one request per bucket.
+    """
+
+    def __init__(self, write_api, spool_directory, memory_bytes=spool_memory_bytes, drain_rate=spool_drain_rate):
+        """
+        :param write_api: the influxdb write api, with synchronous writes so the failures are raised
+        :param spool_directory: the directory of the spooled lines
+        :param memory_bytes: the maximum size of the lines kept in memory
+        :param drain_rate: the spooled writes replayed per second
+        """
+        self.write_api = write_api
+        self.sender = SpooledSender('influxdb', self.send, Spool(spool_directory), memory_bytes,
+                                    drain_rate=drain_rate)
+
+    def write(self, bucket, record):
+        self.sender.put(bucket, record)
+
+    def send(self, records):
+        sent = 0
+        while sent < len(records):
+            bucket = records[sent][0]
+            end = sent
+            while end < len(records) and records[end][0] == bucket:
+                end += 1
+            try:
+                self.write_api.write(bucket=bucket, record='\n'.join(record for _, record in records[sent:end]))
+            except Exception as e:
+                logging.debug(f'failed to write {end - sent} records to influxdb: {e}')
+                return sent
+            sent = end
+        return sent
+
+    def close(self):
+        self.sender.close()
+        logging.info(f'influxdb spool stats: {self.sender.stats()}')
@@ -0,0 +1,205 @@
+import bisect
+import threading
+
+import numpy as np
+
+from calibration_utils import channel_names
+
+store_budget_bytes = 32 * 1024 * 1024
+store_chunk_seconds = 5.0
+store_stream_channels = {'ecg': channel_names, 'acc': ('AX', 'AY', 'AZ', 'GX', 'GY', 'GZ')}
+store_stream_rates = {'ecg': 500.0, 'acc': 100.0}
+# the stores of the devices recording in this process by address, for the live consumers of the same process
+recording_stores = {}
+
+
+class StoreChunk:
+    """
+    A block of consecutive samples of a stream, as a timestamp column and a (samples x channels) value block. The
+    samples already stored are never changed, only appended to until the chunk is full.
+    """
+    __slots__ = ('timestamps', 'values', 'count')
+
+    def __init__(self, samples, channels):
+        self.timestamps = np.empty(samples)
+        self.values = np.empty((samples, channels))
+        self.count = 0
+
+    @property
+    def nbytes(self):
+        return self.timestamps.nbytes + self.values.nbytes
+
+    def append(self, timestamps, values):
+        """
+        :return: the number of samples that fit in the chunk
+        """
+        count = min(len(timestamps), len(self.timestamps) - self.count)
+        self.timestamps[self.count:self.count + count] = timestamps[:count]
+        self.values[self.count:self.count + count] = values[:count]
+        self.count += count
+        return count
+
+
+class StreamStore:
+    """
+    The recent samples of a stream in chunks, indexed by the timestamp of the first sample of each chunk, so a time
+    range is found with a binary search over the chunks and one within each chunk
+    """
+
+    def __init__(self, name, channels, chunk_samples):
+        """
+        :param name: the name of the stream
+        :param channels: the names of the channels of the stream
+        :param chunk_samples: the number of samples of a chunk
+        """
+        self.name = name
+        self.channels = tuple(channels)
+        self.columns = {channel: i for i, channel in enumerate(self.channels)}
+        self.chunk_samples = chunk_samples
+        self.chunks = []
+        self.starts = []
+        self.nbytes = 0
+
+    def append(self, timestamps, values):
+        """
+        :param timestamps: the timestamps of the samples in milliseconds, never earlier than the samples stored
+        :param values: the (samples x channels) values of the samples
+        """
+        while len(timestamps) > 0:
+            if len(self.chunks) == 0 or self.chunks[-1].count == self.chunk_samples:
+                chunk = StoreChunk(self.chunk_samples, len(self.channels))
+                self.chunks.append(chunk)
+                self.starts.append(timestamps[0])
+                self.nbytes += chunk.nbytes
+            count = self.chunks[-1].append(timestamps, values)
+            timestamps, values = timestamps[count:], values[count:]
+
+    def evict(self):
+        """
+        Drops the oldest chunk
+        """
+        chunk = self.chunks.pop(0)
+        self.starts.pop(0)
+        self.nbytes -= chunk.nbytes
+
+    def column(self, channels):
+        """
+        :param channels: None for all the channels, a channel name or index, or a list of them
+        :return: the index of the value block's columns
+        """
+        if channels is None:
+            return slice(None)
+        if isinstance(channels, (list, tuple)):
+            return [self.columns[channel] if isinstance(channel, str) else channel for channel in channels]
+        return self.columns[channels] if isinstance(channels, str) else channels
+
+    def query(self, start, end, channels=None):
+        """
+        :param start: the first timestamp in milliseconds
+        :param end: the timestamp in milliseconds after the last
+        :param channels: None for all the channels, a channel name or index for a single one, or a list of them
+        :return: the timestamps and the values of the samples in the range, views of the stored samples if they are in
+        a single chunk
+        """
+        column = self.column(channels)
+        first = max(bisect.bisect_right(self.starts, start) - 1, 0)
+        last = bisect.bisect_left(self.starts, end)
+        parts = []
+        for chunk in self.chunks[first:last]:
+            timestamps = chunk.timestamps[:chunk.count]
+            begin, stop = np.searchsorted(timestamps, (start, end))
+            if stop > begin:
+                parts.append((timestamps[begin:stop], chunk.values[begin:stop, column]))
+        if len(parts) == 1:
+            return parts[0]
+        if len(parts) == 0:
+            return np.empty(0), np.empty((0, len(self.channels)))[:, column]
+        return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])
+
+    def span(self):
+        """
+        :return: the timestamps of the first and the last samples stored, None if there are none
+        """
+        if len(self.chunks) == 0:
+            return None
+        chunk = self.chunks[-1]
+        return self.starts[0], chunk.timestamps[chunk.count - 1]
+
+
+class RecordingStore:
+    """
+    Keeps the recent voltages and accelerometer values of a device in memory for the live consumers, such as alerting,
+    within a budget of bytes. The oldest chunks of either stream are dropped first once the budget is exceeded.
+    """
+
+    def __init__(self, address=None, budget_bytes=store_budget_bytes, chunk_seconds=store_chunk_seconds):
+        """
+        :param address: the address of the ECG device
+        :param budget_bytes: the maximum size of the stored samples in bytes
+        :param chunk_seconds: the duration of the samples of a chunk in seconds
+        """
+        self.address = address
+        self.budget_bytes = budget_bytes
+        self.streams = {name: StreamStore(name, channels, int(chunk_seconds * store_stream_rates[name]))
+                        for name, channels in store_stream_channels.items()}
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(stream.nbytes for stream in self.streams.values())
+
+    def add(self, stream, timestamps, values):
+        """
+        Stores a block of samples
+        :param stream: the name of the stream (ecg or acc)
+        :param timestamps: the timestamps of the samples in epoch milliseconds
+        :param values: the (samples x channels) values of the samples
+        """
+        with self.lock:
+            self.streams[stream].append(timestamps, values)
+            while self.nbytes > self.budget_bytes:
+                # the chunk being filled is never dropped
+                candidates = [s for s in self.streams.values() if len(s.chunks) > 1]
+                if len(candidates) == 0:
+                    break
+                min(candidates, key=lambda s: s.starts[0]).evict()
+                self.evicted += 1
+
+    def query(self, stream, start, end, channels=None):
+        """
+        :param stream: the name of the stream (ecg or acc)
+        :param start: the first timestamp in epoch milliseconds
+        :param end: the timestamp in epoch milliseconds after the last
+        :param channels: None for all the channels, a channel name (e.g. II) or index for a single one, or a list
+        :return: the timestamps and the values of the samples in the range, as StreamStore.query
+        """
+        with self.lock:
+            return self.streams[stream].query(start, end, channels)
+
+    def last(self, stream, seconds, channels=None):
+        """
+        :param stream: the name of the stream (ecg or acc)
+        :param seconds: the duration before the last sample stored
+        :param channels: None for all the channels, a channel name (e.g. II) or index for a single one, or a list
+        :return: the timestamps and the values of the samples after the last sample less the duration, as
+        StreamStore.query
+        """
+        with self.lock:
+            span = self.streams[stream].span()
+            start = np.nextafter(span[1] - seconds * 1000, np.inf) if span is not None else 0
+            return self.streams[stream].query(start, np.inf, channels)
+
+    def span(self, stream):
+        """
+        :param stream: the name of the stream (ecg or acc)
+        :return: the epoch milliseconds of the first and the last samples stored, None if there are none
+        """
+        with self.lock:
+            return self.streams[stream].span()
+
+    def stats(self):
+        with self.lock:
+            return {'bytes': self.nbytes, 'evicted': self.evicted,
+                    **{name: {'chunks': len(stream.chunks), 'span': stream.span()}
+                       for name, stream in self.streams.items()}}
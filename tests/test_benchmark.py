@@ -0,0 +1,42 @@
+import benchmark
+import ecg_utils
+from session_utils import RecordingSession
+from sim_utils import SimulatedVest, ecg_packet_samples
+
+
+def test_every_pass_starts_from_a_new_session():
+    packets = [bytes(data) for data in SimulatedVest(seed=2).ecg_packets(300)]
+    sessions = []
+
+    def new_process():
+        session = RecordingSession()
+        sessions.append(session)
+        return lambda data: ecg_utils.process_ecg_data(session, data)
+
+    benchmark.run_path('ecg decode', packets, new_process)
+    assert len(sessions) == 2 and sessions[0] is not sessions[1]
+    # the allocation pass decodes its 200 packets as a new recording, not as duplicates of the timed pass
+    reference = RecordingSession()
+    for data in packets[:200]:
+        ecg_utils.process_ecg_data(reference, bytearray(data))
+    assert sessions[0].ecg_sequence.last == packets[-1][0]
+    assert sessions[1].ecg_sequence.last == reference.ecg_sequence.last == packets[199][0]
+    assert sessions[1].ecg_recording_timestamp == reference.ecg_recording_timestamp == \
+        200 * ecg_packet_samples * ecg_utils.sample_interval_millis
+
+
+def test_benchmark_paths_do_not_share_sessions(monkeypatch):
+    sessions = []
+
+    class CountedSession(RecordingSession):
+        __slots__ = ()
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            sessions.append(self)
+
+    monkeypatch.setattr(benchmark, 'RecordingSession', CountedSession)
+    results = benchmark.run_benchmarks(packet_count=20)
+    # every path but the unpacking decodes on a session of its own for each of its 2 passes
+    assert len(sessions) == 2 * (len(results) - 1)
+    assert len({id(session) for session in sessions}) == len(sessions)
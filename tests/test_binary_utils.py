@@ -0,0 +1,116 @@
+import io
+import struct
+
+import numpy as np
+import pytest
+
+import binary_utils
+import ecg_utils
+from binary_utils import BinaryRecording, binary_gap_dtype, binary_header_format, binary_header_len_v2, \
+    convert_to_csv, ecg_binary_channels, open_ecg_binary_file
+from calibration_utils import Calibration, default_calibration, default_derivation
+from session_utils import RecordingSession
+from sim_utils import SimulatedVest
+
+# LA and RA swapped
+swapped = Calibration('swapped', default_derivation[[1, 0, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]], offset=np.zeros(12))
+# the channels weighted by a fraction, which no integral column renders
+weighted = Calibration('weighted', default_derivation * np.linspace(0.9, 1.1, 12)[:, None])
+
+
+def record(path, packets, calibration=default_calibration, firmware=None, gap_fill=None):
+    """
+    Records the packets to a csv file and to a binary recording at once
+    :return: the csv text
+    """
+    session = RecordingSession('00:00:00:00:00:01', gap_fill, calibration)
+    file = io.StringIO()
+    with open_ecg_binary_file(path, session.address, calibration, firmware) as binary_file:
+        for data in packets:
+            ecg_utils.process_ecg_data(session, data, file=file, binary_file=binary_file)
+        ecg_utils.flush_ecg_data(session)
+    return file.getvalue()
+
+
+def test_calibration_round_trip(tmp_path):
+    record(tmp_path / 'rec', SimulatedVest(seed=1).ecg_packets(10), swapped, '2.0')
+    recording = BinaryRecording(tmp_path / 'rec.ecgb')
+    assert recording.version == 3
+    assert recording.firmware == '2.0'
+    assert recording.calibration.name == 'swapped'
+    assert np.array_equal(recording.calibration.derivation, swapped.derivation)
+    assert np.array_equal(recording.calibration.gain, swapped.gain)
+    assert np.array_equal(recording.calibration.offset, swapped.offset)
+    assert len(recording) == 200
+
+
+def test_converts_with_the_stored_calibration(tmp_path):
+    text = record(tmp_path / 'rec', SimulatedVest(heart_rate=80.0, seed=3).ecg_packets(200), swapped)
+    converted = io.StringIO()
+    convert_to_csv(BinaryRecording(tmp_path / 'rec.ecgb'), converted)
+    rows = [line.split(',')[2:] for line in text.splitlines()]
+    assert any(row[0] != row[1] for row in rows)
+    assert [line.split(',')[2:] for line in converted.getvalue().splitlines()] == rows
+
+
+def test_renders_the_calibrated_channels_in_full(tmp_path):
+    packets = list(SimulatedVest(heart_rate=80.0, seed=7).ecg_packets(50))
+    text = record(tmp_path / 'rec', packets, weighted)
+    recording = BinaryRecording(tmp_path / 'rec.ecgb')
+    rows = np.array([line.split(',')[2:14] for line in text.splitlines()], dtype=np.float64)
+    assert np.array_equal(rows, weighted.channels(recording.samples[:, :8].astype(np.float64)))
+    assert np.any(rows != np.round(rows))
+    converted = io.StringIO()
+    convert_to_csv(recording, converted)
+    assert converted.getvalue() == text
+    # the default calibration keeps its integral columns
+    default_row = record(tmp_path / 'default', packets).splitlines()[0].split(',')
+    assert '.' not in default_row[2] and '.' not in default_row[3]
+
+
+def test_reads_version_2_recordings(tmp_path):
+    samples = np.arange(36, dtype='<u2').reshape(4, 9)
+    header = struct.pack(binary_header_format, b'ECGB', 2, b'ecg', b'<u2', 9, 500.0, 1000, 4,
+                         binary_header_len_v2 + samples.nbytes, 0, b'', ','.join(ecg_binary_channels).encode())
+    (tmp_path / 'old.ecgb').write_bytes(header.ljust(binary_header_len_v2, b'\0') + samples.tobytes())
+    recording = BinaryRecording(tmp_path / 'old.ecgb')
+    assert recording.calibration is default_calibration
+    assert recording.firmware is None
+    assert np.array_equal(recording.samples, samples)
+
+
+@pytest.mark.parametrize('gap_fill', [None, 'nan'])
+def test_converts_to_the_live_csv(tmp_path, gap_fill):
+    vest = SimulatedVest(heart_rate=72.0, loss=0.05, seed=4)
+    text = record(tmp_path / 'rec', vest.ecg_packets(500), gap_fill=gap_fill)
+    recording = BinaryRecording(tmp_path / 'rec.ecgb')
+    assert len(recording.gaps) > 0
+    converted = io.StringIO()
+    convert_to_csv(recording, converted, gap_fill)
+    assert converted.getvalue() == text
+
+
+def test_converts_the_gaps_after_the_last_sample(tmp_path):
+    record(tmp_path / 'rec', SimulatedVest(seed=5).ecg_packets(10))
+    with open(tmp_path / 'rec.ecgb', 'r+b') as file:
+        # a gap reported by a last packet that carried no complete sample
+        file.seek(0, 2)
+        file.write(np.array([(200, 9, 12, 2, 40)], dtype=binary_gap_dtype).data)
+        file.seek(struct.calcsize('<4sH8s4sHdqQQ'))
+        file.write(struct.pack('<Q', 1))
+    converted = io.StringIO()
+    convert_to_csv(BinaryRecording(tmp_path / 'rec.ecgb'), converted)
+    assert converted.getvalue().splitlines()[-1] == '# [ecg] missed 2 packets - last was 9 but received 12'
+    converted = io.StringIO()
+    convert_to_csv(BinaryRecording(tmp_path / 'rec.ecgb'), converted, 'nan')
+    lines = converted.getvalue().splitlines()
+    assert len(lines) == 240
+    assert lines[-1].startswith(f'{BinaryRecording(tmp_path / "rec.ecgb").start_epoch + 478}.0,478.0,nan,')
+
+
+def test_command_line_fills_the_gaps(tmp_path):
+    vest = SimulatedVest(heart_rate=72.0, loss=0.05, seed=6)
+    text = record(tmp_path / 'rec', vest.ecg_packets(200), gap_fill='nan')
+    binary_utils.main(['--gapfill', 'nan', str(tmp_path / 'rec.ecgb')])
+    assert (tmp_path / 'rec.ecg').read_text() == text
+    assert ',nan,' in text
@@ -0,0 +1,59 @@
+import io
+
+import numpy as np
+
+import acc_utils
+import ecg_utils
+from session_utils import RecordingSession
+from sim_utils import SimulatedVest
+
+
+def baseline_ecg_line(start_time, sample_time, leads, battery):
+    """
+    The line the original receiver wrote for a sample, with the channels derived by its scalar formula
+    """
+    l1, l2 = leads[0], leads[1]
+    l3 = l2 - l1
+    channels = [l1, l2, l3, -(l1 + l2) / 2, l1 - l2 / 2, l3 + l1 / 2] + list(leads[2:8])
+    return ','.join(str(value) for value in [start_time + sample_time, sample_time] + channels + [0, 0, 0, battery])
+
+
+def baseline_acc_line(sample_time, raw):
+    """
+    The line the original receiver wrote for an accelerometer frame of non negative values
+    """
+    values = [round((value * 0.061) / 1000, 2) for value in raw[:3]]
+    values += [round((value * 8.75) / 1000, 2) for value in raw[3:]]
+    return ','.join(str(value) for value in [sample_time] + values)
+
+
+def test_first_ecg_lines_match_the_baseline():
+    vest = SimulatedVest(seed=1)
+    data = vest.ecg_packet()
+    leads = ecg_utils.unpack_lead_values(bytes(data[ecg_utils.ecg_header_len:])).reshape(-1, 8).tolist()
+    session = RecordingSession()
+    session.battery = 95
+    file = io.StringIO()
+    ecg_utils.process_ecg_data(session, data, file=file)
+    ecg_utils.flush_ecg_data(session)
+    lines = file.getvalue().splitlines()
+    assert lines[0] == baseline_ecg_line(session.ecg_recording_start, 0.0, leads[0], 95)
+    assert lines[0].split(',')[1] == '0.0'
+    assert lines[1] == baseline_ecg_line(session.ecg_recording_start, 2.0, leads[1], 95)
+
+
+def test_first_acc_lines_match_the_baseline():
+    raw = np.arange(acc_utils.acc_data_frames * 6).reshape(-1, 6) * 97
+    data = bytearray(bytes((0, 0, 0, 0, 0)) + raw.astype('<i2').tobytes())
+    file = io.StringIO()
+    acc_utils.process_accelerometer_data(RecordingSession(), data, file=file)
+    lines = file.getvalue().splitlines()
+    assert lines[0] == baseline_acc_line(0.0, raw[0].tolist())
+    assert lines[0].startswith('0.0,')
+    assert lines[1] == baseline_acc_line(10.0, raw[1].tolist())
+
+
+def test_acc_gap_rows_are_rendered_as_a_block():
+    text = acc_utils.convert_gap_to_text(20.0, 3, 'nan')
+    assert text == ''.join(f'{20.0 + i * 10.0},nan,nan,nan,nan,nan,nan\n' for i in range(3))
+    assert acc_utils.convert_gap_to_text(20.0, 0, 'nan') == ''
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import pytest
+
+import sim_utils
+from device_utils import connect
+from discovery_utils import CachedDevice, DeviceCache, find_devices, scan_replacement
+from sim_utils import SimulatedBleakClient, SimulatedBleakScanner, SimulatedVest
+
+
+@pytest.fixture
+def vest():
+    vest = SimulatedVest(address='00:00:00:00:00:01')
+    sim_utils.simulated_devices.append(vest)
+    yield vest
+    sim_utils.simulated_devices.remove(vest)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = DeviceCache(str(tmp_path / 'devices.json'))
+    now = time.time()
+    # a vest seen recently that is not around, and the one advertising seen an hour ago
+    cache.devices = {'00:00:00:00:00:99': {'name': 'ECG2.0-n', 'last_seen': now - 60},
+                     '00:00:00:00:00:01': {'name': 'ECG2.0-n', 'last_seen': now - 3600}}
+    cache.save()
+    return cache
+
+
+def test_find_most_recently_seen_first(cache):
+    assert [device.address for device in cache.find('ECG2.0-n', count=2)] == ['00:00:00:00:00:99',
+                                                                               '00:00:00:00:00:01']
+    assert [device.address for device in cache.find(device_address='00:00:00:00:00:01')] == ['00:00:00:00:00:01']
+
+
+def test_remember_keeps_the_cached_name(cache):
+    cache.remember(CachedDevice('00:00:00:00:00:01'))
+    assert cache.devices['00:00:00:00:00:01']['name'] == 'ECG2.0-n'
+    assert cache.find('ECG2.0-n')[0].address == '00:00:00:00:00:01'
+
+
+def test_failed_cached_device_replaced_by_advertising_one(vest, cache):
+    async def run():
+        devices = await find_devices('ECG2.0-n', scanner_class=SimulatedBleakScanner, cache=cache)
+        assert [device.address for device in devices] == ['00:00:00:00:00:99']
+        return await scan_replacement(devices[0], [], 'ECG2.0-n', scan_time=1.0,
+                                      scanner_class=SimulatedBleakScanner, cache=cache)
+
+    replacement = asyncio.run(run())
+    assert replacement.address == '00:00:00:00:00:01'
+    # only cached devices are replaced, a scanned one is not looked for again
+    assert asyncio.run(scan_replacement(replacement, [], 'ECG2.0-n', scanner_class=SimulatedBleakScanner)) is None
+
+
+def test_connect_refreshes_the_cache(vest, cache, tmp_path):
+    seen = cache.devices['00:00:00:00:00:01']['last_seen']
+    connected = asyncio.run(connect(CachedDevice('00:00:00:00:00:01'), record_time=0.2,
+                                    file_prefix=f'{tmp_path}/', cache=cache, client_class=SimulatedBleakClient))
+    assert connected
+    assert cache.devices['00:00:00:00:00:01']['last_seen'] > seen
+    assert DeviceCache(cache.path).find('ECG2.0-n')[0].address == '00:00:00:00:00:01'
+    missing = cache.devices['00:00:00:00:00:99']['last_seen']
+    connected = asyncio.run(connect(CachedDevice('00:00:00:00:00:99'), record_time=0.2,
+                                    file_prefix=f'{tmp_path}/', cache=cache, client_class=SimulatedBleakClient))
+    assert not connected
+    assert cache.devices['00:00:00:00:00:99']['last_seen'] == missing
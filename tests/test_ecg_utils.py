@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+import ecg_utils
+import sim_utils
+from session_utils import single_sample_length
+
+
+def hex_lead_values(payload):
+    """
+    The original decoder, which reorders the hex digits of every 3 bytes into 2 measurements
+    """
+    hex_string = np.frombuffer(payload, dtype=np.uint8).data.hex()
+    measurements = []
+    for item in [hex_string[i:i + 6] for i in range(0, len(hex_string), 6)]:
+        measurements.append(item[3] + item[0] + item[1])
+        measurements.append(item[4] + item[5] + item[2])
+    return [int(m, base=16) for m in measurements]
+
+
+def pack_by_hand(values):
+    """
+    Packs pairs of 12bit measurements independently of sim_utils: a = 0xA1A2A3 and b = 0xB1B2B3 go to the bytes
+    A2A3, B3A1, B1B2
+    """
+    packed = bytearray()
+    for a, b in zip(values[0::2], values[1::2]):
+        packed += bytes([a & 0xFF, (b & 0x0F) << 4 | a >> 8, b >> 4])
+    return bytes(packed)
+
+
+known_samples = [
+    [0x000] * single_sample_length,
+    [0xFFF] * single_sample_length,
+    [0x123, 0x456, 0x789, 0xABC, 0xDEF, 0xF0F, 0x0F0, 0x800],
+    [0x00F, 0xF00, 0x0F0, 0xFF0, 0x0FF, 0xF0F, 0x001, 0xFFE],
+    [0x800, 0x7FF, 0x801, 0x7FE, 0xA5A, 0x5A5, 0x3C3, 0xC3C],
+]
+
+
+@pytest.mark.parametrize('sample', known_samples)
+def test_unpack_matches_known_values(sample):
+    payload = pack_by_hand(sample)
+    assert payload == sim_utils.pack_lead_values(sample)
+    assert hex_lead_values(payload) == sample
+    unpacked = ecg_utils.unpack_lead_values(payload)
+    assert unpacked.dtype == np.uint16
+    assert unpacked.tolist() == sample
+
+
+def test_unpack_nibble_order():
+    # every nibble differs, so a swapped nibble of either measurement changes the value
+    payload = bytes([0x12, 0x34, 0x56])
+    assert hex_lead_values(payload) == [0x412, 0x563]
+    assert ecg_utils.unpack_lead_values(payload).tolist() == [0x412, 0x563]
+
+
+def test_unpack_matches_hex_decoder_for_every_lead():
+    rng = np.random.default_rng(7)
+    values = rng.integers(0, 0x1000, size=(sim_utils.ecg_packet_samples, single_sample_length))
+    values[0] = 0x000
+    values[1] = 0xFFF
+    payload = sim_utils.pack_lead_values(values)
+    expected = np.array(hex_lead_values(payload)).reshape(-1, single_sample_length)
+    unpacked = ecg_utils.unpack_lead_values(payload).reshape(-1, single_sample_length)
+    assert np.array_equal(unpacked, expected)
+    assert np.array_equal(unpacked, values)
+
+
+def test_unpack_matches_hex_decoder_for_every_byte_triple():
+    # all the values of the middle byte with edge and mixed outer bytes, which covers every nibble of both measurements
+    triples = [(outer, middle, last) for middle in range(256) for outer, last in ((0x00, 0xFF), (0xFF, 0x00),
+                                                                                   (0x5A, 0xC3))]
+    payload = bytes(byte for triple in triples for byte in triple)
+    assert ecg_utils.unpack_lead_values(payload).tolist() == hex_lead_values(payload)
+
+
+def test_unpack_ignores_trailing_partial_triple():
+    payload = pack_by_hand([0xABC, 0x123]) + b'\x01\x02'
+    assert ecg_utils.unpack_lead_values(payload).tolist() == [0xABC, 0x123]
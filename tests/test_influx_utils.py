@@ -0,0 +1,127 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+from influx_utils import InfluxLineWriter, escape_tag, influx_channel_names
+
+
+class WriteHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the influxdb write endpoint that keeps the request bodies
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.requests.append((self.path, body))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def influxdb():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), WriteHandler)
+    server.requests = []
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = InfluxDBClient(url=f'http://127.0.0.1:{server.server_port}', token='token', org='org')
+    yield server, client.write_api(write_options=SYNCHRONOUS)
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def expected_lines(start_time, sample_time, voltages, sample_interval, key='ecg'):
+    lines = []
+    for i, sample in enumerate(voltages):
+        fields = ','.join(f'{name}={value:.6f}' for name, value in zip(influx_channel_names, sample))
+        timestamp = int((start_time + sample_time + i * sample_interval) * 1000000)
+        lines.append(f'{key} {fields},HR=0.0,RR=0.0,STATE=0.0 {timestamp}')
+    return lines
+
+
+def wait_for_requests(server, count, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with server.lock:
+            if len(server.requests) >= count:
+                return list(server.requests)
+        time.sleep(0.01)
+    with server.lock:
+        return list(server.requests)
+
+
+def test_batch_written_in_one_request(influxdb):
+    server, write_api = influxdb
+    writer = InfluxLineWriter(write_api, 'ecg', batch_size=100, flush_millis=60000)
+    start_time = 1700000000000
+    rng = np.random.default_rng(3)
+    lines = []
+    for block in range(5):
+        voltages = rng.uniform(-2, 2, size=(20, len(influx_channel_names)))
+        writer.add_block(start_time, block * 40.0, voltages, 2.0)
+        lines.extend(expected_lines(start_time, block * 40.0, voltages, 2.0))
+    requests = wait_for_requests(server, 1)
+    assert len(requests) == 1
+    path, body = requests[0]
+    assert path.startswith('/api/v2/write') and 'bucket=ecg' in path
+    assert len(body) == len('\n'.join(lines).encode())
+    assert body.decode().split('\n') == lines
+    assert writer.written == 100 and writer.pending_samples == 0
+    writer.close()
+    assert len(server.requests) == 1
+
+
+def test_close_writes_pending(influxdb):
+    server, write_api = influxdb
+    writer = InfluxLineWriter(write_api, 'ecg', batch_size=1000, flush_millis=60000)
+    voltages = np.zeros((30, len(influx_channel_names)))
+    writer.add_block(1700000000000, 0.0, voltages, 2.0)
+    time.sleep(0.1)
+    assert len(server.requests) == 0
+    writer.close()
+    assert len(server.requests) == 1
+    assert server.requests[0][1].decode().split('\n') == expected_lines(1700000000000, 0.0, voltages, 2.0)
+    assert not writer.timer.is_alive()
+
+
+def test_timer_writes_stalled_samples(influxdb):
+    server, write_api = influxdb
+    writer = InfluxLineWriter(write_api, 'ecg', batch_size=1000, flush_millis=100)
+    writer.add_block(1700000000000, 0.0, np.zeros((20, len(influx_channel_names))), 2.0)
+    # no further block arrives to trigger the write
+    requests = wait_for_requests(server, 1, timeout=2.0)
+    assert len(requests) == 1
+    assert len(requests[0][1].decode().split('\n')) == 20
+    assert writer.written == 20
+    writer.close()
+    assert len(server.requests) == 1
+
+
+def test_devices_sharing_the_measurement_are_tagged(influxdb):
+    server, write_api = influxdb
+    voltages = np.zeros((10, len(influx_channel_names)))
+    lines = []
+    for address in ('00:00:00:00:00:01', '00:00:00:00:00:02'):
+        writer = InfluxLineWriter(write_api, 'ecg', batch_size=1000, flush_millis=60000, address=address)
+        writer.add_block(1700000000000, 0.0, voltages, 2.0)
+        writer.close()
+        lines.extend(expected_lines(1700000000000, 0.0, voltages, 2.0, f'ecg,device={address}'))
+    requests = wait_for_requests(server, 2)
+    assert [line for _, body in requests for line in body.decode().split('\n')] == lines
+
+
+def test_escapes_the_device_tag():
+    assert escape_tag('vest 1,a=b%') == 'vest\\ 1\\,a\\=b%%'
+    writer = InfluxLineWriter(None, 'ecg', address='vest 1,%')
+    assert writer.line_format.startswith('ecg,device=vest\\ 1\\,%% ')
+    assert (writer.line_format % tuple(range(15))).startswith('ecg,device=vest\\ 1\\,% I=0.000000,')
+    writer.close()
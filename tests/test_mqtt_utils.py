@@ -0,0 +1,45 @@
+import struct
+
+import numpy as np
+import pytest
+
+from calibration_utils import default_calibration
+from decimation_utils import DecimationStages
+from mqtt_utils import MqttBatchPublisher, decode_binary_payload, encode_binary_payload
+
+
+class RecordingMqttClient:
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload):
+        self.messages.append((topic, payload))
+
+
+def test_binary_blocks_carry_the_sample_interval():
+    samples = np.arange(24, dtype=np.uint16).reshape(3, 8)
+    payload = encode_binary_payload([(1000, 0, samples), (1000, 6.0, samples + 1)], 2.0)
+    blocks = decode_binary_payload(payload)
+    assert [block[:3] for block in blocks] == [(1000, 0.0, 2.0), (1000, 6.0, 2.0)]
+    assert np.array_equal(blocks[1][3], samples + 1)
+
+
+def test_rejects_unknown_block_versions():
+    payload = bytearray(encode_binary_payload([(1000, 0, np.zeros((1, 8), dtype=np.uint16))], 2.0))
+    payload[:2] = struct.pack('<H', 1)
+    with pytest.raises(ValueError):
+        decode_binary_payload(bytes(payload))
+
+
+def test_decimated_blocks_carry_the_decimated_interval():
+    client = RecordingMqttClient()
+    stages = DecimationStages()
+    stages.add_mqtt(10, client, 'ecg', 'binary')
+    full_rate = MqttBatchPublisher(client, 'full', 2.0, 'binary')
+    frames = np.full((200, 8), 2048, dtype=np.uint16)
+    stages.add_block(0, 0, frames, np.zeros(200), np.zeros(200, dtype=np.int8), np.zeros(200), np.zeros(200), 95,
+                     default_calibration)
+    full_rate.add_samples(0, 0, frames)
+    intervals = {topic: {block[2] for block in decode_binary_payload(payload)} for topic, payload in client.messages}
+    assert intervals == {'ecg': {20.0}, 'ecg/envelope': {20.0}, 'full': {2.0}}
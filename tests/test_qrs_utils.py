@@ -0,0 +1,102 @@
+import io
+
+import numpy as np
+import pytest
+
+import ecg_utils
+from qrs_utils import QrsDetector
+from session_utils import RecordingSession
+from sim_utils import SimulatedVest, ecg_packet_samples, synthetic_ecg
+
+
+def detect(signal, block_size=ecg_packet_samples, detector=None):
+    """
+    Streams a signal through a detector in blocks
+    :return: the released (payload, is_qrs, heart_rate, rr_millis, qrs_samples) with the index of the first sample of
+    the block as payload
+    """
+    detector = detector or QrsDetector()
+    released = []
+    for start in range(0, len(signal), block_size):
+        released.extend(detector.process(signal[start:start + block_size], start))
+    released.extend(detector.release())
+    return released
+
+
+def flagged(released):
+    return [start + int(i) for start, is_qrs, *_ in released for i in np.flatnonzero(is_qrs)]
+
+
+def assert_on_peaks(found, peaks, after, end, tolerance=2):
+    # the beats of the last delay samples are not confirmed
+    expected = [peak for peak in peaks if after <= peak < end - QrsDetector().delay]
+    found = [index for index in found if index >= after - tolerance]
+    assert len(found) == len(expected)
+    assert np.abs(np.array(found) - np.array(expected)).max() <= tolerance
+
+
+@pytest.mark.parametrize('heart_rate', [50.0, 72.0, 120.0, 160.0])
+def test_flags_the_r_peaks(heart_rate):
+    signal, peaks = synthetic_ecg(30000, heart_rate, noise=10.0, rng=np.random.default_rng(1))
+    released = detect(signal)
+    # the first beats are only used to learn the thresholds
+    assert_on_peaks(flagged(released), peaks, 1500, len(signal))
+    rr = 60000.0 / heart_rate
+    assert released[-1][2][-1] == pytest.approx(heart_rate, rel=0.02)
+    assert released[-1][3][-1] == pytest.approx(rr, abs=4.0)
+
+
+def test_values_change_on_the_r_peak():
+    signal, peaks = synthetic_ecg(10000, 75.0)
+    released = detect(signal)
+    heart_rate = np.concatenate([block[2] for block in released])
+    is_qrs = np.concatenate([block[1] for block in released])
+    for peak in np.flatnonzero(is_qrs)[1:]:
+        assert heart_rate[peak] > 0
+        assert heart_rate[peak - 1] == heart_rate[peak - 2]
+
+
+def test_blocks_released_in_order_after_the_delay():
+    signal, _ = synthetic_ecg(5000, 60.0)
+    detector = QrsDetector()
+    for start in range(0, len(signal), ecg_packet_samples):
+        for payload, is_qrs, *_ in detector.process(signal[start:start + ecg_packet_samples], start):
+            # every block released is at least the delay behind the received samples, and at most a block further
+            assert start + ecg_packet_samples - detector.delay - ecg_packet_samples <= payload + len(is_qrs)
+            assert payload + len(is_qrs) <= start + ecg_packet_samples - detector.delay
+    remaining = detector.release()
+    assert len(detector.held) == 0
+    assert [payload for payload, *_ in remaining] == list(range(len(signal) - len(remaining) * ecg_packet_samples,
+                                                                len(signal), ecg_packet_samples))
+
+
+def test_flags_after_bridged_gap():
+    signal, peaks = synthetic_ecg(20000, 72.0)
+    detector = QrsDetector()
+    released = []
+    # 100 samples are missed after 5 seconds
+    for start in range(0, len(signal), ecg_packet_samples):
+        if 2500 <= start < 2600:
+            if start == 2500:
+                detector.skip(100)
+            continue
+        released.extend(detector.process(signal[start:start + ecg_packet_samples], start))
+    released.extend(detector.release())
+    found = flagged(released)
+    assert_on_peaks([index for index in found if index >= 2600], peaks, 3000, len(signal))
+    assert all(index < 2500 or index >= 2600 for index in found)
+
+
+def test_recording_flags_the_r_peaks():
+    vest = SimulatedVest(heart_rate=80.0, seed=2)
+    session = RecordingSession()
+    file = io.StringIO()
+    for data in vest.ecg_packets(1000):
+        ecg_utils.process_ecg_data(session, data, file=file)
+    # the last packets are held until the recording ends
+    assert ecg_utils.held_ecg_packets(session) > 0
+    ecg_utils.flush_ecg_data(session)
+    rows = [line.split(',') for line in file.getvalue().splitlines()]
+    assert len(rows) == 1000 * ecg_packet_samples
+    _, peaks = synthetic_ecg(len(rows), 80.0)
+    assert_on_peaks([i for i, row in enumerate(rows) if row[16] == '1'], peaks, 1500, len(rows))
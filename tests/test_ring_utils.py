@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from ring_utils import LiveRingReader, LiveRingWriter
+
+
+@pytest.fixture
+def ring():
+    writer = LiveRingWriter('00:00:00:00:00:09', 100, channels=2)
+    reader = LiveRingReader('00:00:00:00:00:09')
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+
+def write(writer, first, count):
+    timestamps = np.arange(first, first + count, dtype=np.float64) * 2.0
+    writer.write(timestamps, np.column_stack([timestamps, -timestamps]))
+
+
+def test_view_intact_until_the_writer_wraps_past_it(ring):
+    writer, reader = ring
+    write(writer, 0, 50)
+    start, timestamps, values = reader.latest(50)
+    assert start == 0 and np.array_equal(timestamps, np.arange(50) * 2.0)
+    write(writer, 50, 40)
+    assert reader.intact(start)
+    assert np.array_equal(timestamps, np.arange(50) * 2.0)
+    for first in range(90, 90 + 2 * writer.capacity, 30):
+        write(writer, first, 30)
+    # the samples of the view were overwritten by the later ones
+    assert not reader.intact(start)
+    assert not np.array_equal(timestamps, np.arange(50) * 2.0)
+    with pytest.raises(ValueError):
+        reader.view(start, start + 50)
@@ -0,0 +1,299 @@
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import paho.mqtt.client as mqtt
+import pytest
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+from spool_utils import Spool, SpooledSender, SpoolingInfluxWriteApi, SpoolingMqttClient
+
+
+def wait_until(condition, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+class StandInBroker:
+    """
+    Minimal mqtt 3.1.1 broker that keeps the published messages, and can be paused (stops reading and acknowledging)
+    or taken down (drops the connections and refuses new ones)
+    """
+
+    def __init__(self):
+        self.port = 0
+        self.received = []
+        self.paused = threading.Event()
+        self.connections = []
+        self.server = None
+        self.up()
+
+    def up(self):
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', self.port))
+        self.port = self.server.getsockname()[1]
+        self.server.listen()
+        threading.Thread(target=self.accept, args=(self.server,), daemon=True).start()
+
+    def down(self):
+        self.server.close()
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+                connection.close()
+            except OSError:
+                pass
+        self.connections = []
+
+    def accept(self, server):
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            self.connections.append(connection)
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    @staticmethod
+    def read(connection, count):
+        data = b''
+        while len(data) < count:
+            chunk = connection.recv(count - len(data))
+            if not chunk:
+                raise OSError('closed')
+            data += chunk
+        return data
+
+    def serve(self, connection):
+        try:
+            while True:
+                while self.paused.is_set():
+                    time.sleep(0.01)
+                header = self.read(connection, 1)[0]
+                length, multiplier = 0, 1
+                while True:
+                    digit = self.read(connection, 1)[0]
+                    length += (digit & 127) * multiplier
+                    multiplier *= 128
+                    if not digit & 128:
+                        break
+                body = self.read(connection, length)
+                kind = header >> 4
+                if kind == 1:
+                    connection.sendall(b'\x20\x02\x00\x00')
+                elif kind == 3:
+                    topic_length = struct.unpack('>H', body[:2])[0]
+                    position = 2 + topic_length
+                    if (header >> 1) & 3:
+                        connection.sendall(b'\x40\x02' + body[position:position + 2])
+                        position += 2
+                    self.received.append((body[2:2 + topic_length].decode(), body[position:]))
+                elif kind == 12:
+                    connection.sendall(b'\xd0\x00')
+                elif kind == 14:
+                    return
+        except OSError:
+            pass
+
+
+class WriteHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the influxdb write endpoint, which fails with 503 or holds the requests while paused
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        while self.server.paused.is_set():
+            time.sleep(0.01)
+        if self.server.failing:
+            self.send_response(503)
+            self.end_headers()
+            return
+        with self.server.lock:
+            self.server.lines.extend(body.decode().split('\n'))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_writes(port=0, lines=None):
+    server = ThreadingHTTPServer(('127.0.0.1', port), WriteHandler)
+    server.lines = [] if lines is None else lines
+    server.lock = threading.Lock()
+    server.paused = threading.Event()
+    server.failing = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_spool_replays_in_order_across_restarts(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=1000)
+    spool.append([('ecg', f'{i:04d}' * 20) for i in range(30)])
+    spool.append([('acc', bytes([i]) * 50) for i in range(5)])
+    records, positions = spool.read(max_records=10)
+    assert [data for _, data in records] == [f'{i:04d}' * 20 for i in range(10)]
+    spool.commit(positions[-1], len(records))
+    spool.close()
+    # the records not committed are replayed after a restart, the new ones after them
+    spool = Spool(str(tmp_path), segment_bytes=1000)
+    spool.append([('ecg', 'new')])
+    records, positions = spool.read(max_records=100, max_bytes=1 << 20)
+    assert [key for key, _ in records] == ['ecg'] * 20 + ['acc'] * 5 + ['ecg']
+    assert records[20][1] == b'\x00' * 50 and records[-1][1] == 'new'
+    spool.commit(positions[-1], len(records))
+    assert len(spool) == 0
+    spool.close()
+
+
+def test_spool_drops_torn_tail(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([('ecg', f'{i}') for i in range(3)])
+    spool.close()
+    with open(spool.segment_path(0), 'ab') as file:
+        file.write(b'\x10\x00\x00')
+    spool = Spool(str(tmp_path))
+    records, _ = spool.read()
+    assert [data for _, data in records] == ['0', '1', '2']
+    spool.close()
+
+
+def test_put_spills_only_the_oldest_records_on_the_sender_thread(tmp_path):
+    spool = Spool(str(tmp_path))
+    threads = []
+    append = spool.append
+
+    def recording_append(records):
+        threads.append(threading.current_thread())
+        append(records)
+
+    spool.append = recording_append
+    sending = threading.Event()
+    resume = threading.Event()
+    sent = []
+
+    def send(records):
+        # a remote that takes the first record only once resumed
+        sending.set()
+        resume.wait()
+        sent.extend(records)
+        return len(records)
+
+    sender = SpooledSender('test', send, spool, memory_bytes=1000, drain_rate=None)
+    records = [('ecg', f'{i:04d}'.encode() * 25) for i in range(40)]
+    sender.put(*records[0])
+    assert sending.wait(5.0)
+    for record in records[1:]:
+        sender.put(*record)
+    # the newest records that fit the memory limit stay queued, only the older ones are handed over to be spooled
+    assert list(sender.queue) == records[-10:]
+    assert sender.spilled == records[1:30]
+    assert len(threads) == 0
+    resume.set()
+    assert wait_until(lambda: len(sent) == 40)
+    sender.close()
+    assert all(thread is sender.thread for thread in threads)
+    # the live records first, the spooled ones after them in order
+    assert sent == records[:1] + records[30:] + records[1:30]
+    assert spool.appended == 29
+
+
+def mqtt_client(client_id):
+    if hasattr(mqtt, 'CallbackAPIVersion'):
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id)
+    return mqtt.Client(client_id)
+
+
+def test_mqtt_messages_delivered_through_stall_and_outage(tmp_path):
+    broker = StandInBroker()
+    client = mqtt_client('spool-test')
+    client.reconnect_delay_set(0.1, 0.5)
+    client.max_queued_messages_set(50)
+    client.connect('127.0.0.1', broker.port)
+    client.loop_start()
+    assert wait_until(client.is_connected, 5.0)
+    spooling = SpoolingMqttClient(client, str(tmp_path), memory_bytes=20000, drain_rate=2000)
+    spooling.sender.retry_delay = spooling.sender.max_retry_delay = 0.2
+    published = []
+
+    def burst(count):
+        for _ in range(count):
+            payload = f'{len(published):06d}'.encode() + b'x' * 200
+            published.append(payload)
+            spooling.publish('ecg/test', payload)
+            time.sleep(0.001)
+
+    try:
+        burst(200)
+        broker.paused.set()
+        burst(400)
+        assert wait_until(lambda: spooling.sender.stats()['spooled'] > 0, 5.0)
+        broker.paused.clear()
+        burst(100)
+        broker.down()
+        burst(400)
+        broker.up()
+        burst(200)
+        assert wait_until(lambda: len(spooling.sender.spool) == 0 and
+                          len({payload for _, payload in broker.received}) == len(published))
+    finally:
+        spooling.close()
+        client.loop_stop()
+        broker.down()
+    assert {payload for _, payload in broker.received} == set(published)
+    assert all(topic == 'ecg/test' for topic, _ in broker.received)
+
+
+@pytest.mark.parametrize('outage', ['failing', 'paused', 'down'])
+def test_influxdb_lines_delivered_through_outage(tmp_path, outage):
+    server = serve_writes()
+    port, lines = server.server_port, server.lines
+    api = InfluxDBClient(url=f'http://127.0.0.1:{port}', token='token', org='org', timeout=500)
+    spooling = SpoolingInfluxWriteApi(api.write_api(write_options=SYNCHRONOUS), str(tmp_path), memory_bytes=5000,
+                                      drain_rate=None)
+    spooling.sender.retry_delay = spooling.sender.max_retry_delay = 0.2
+    written = []
+
+    def burst(count):
+        for _ in range(count):
+            block = '\n'.join(f'ecg I={j} {len(written) * 10 + j}' for j in range(10))
+            written.append(block)
+            spooling.write('ecg', block)
+            time.sleep(0.002)
+
+    try:
+        burst(50)
+        if outage == 'failing':
+            server.failing = True
+        elif outage == 'paused':
+            server.paused.set()
+        else:
+            server.shutdown()
+            server.server_close()
+        burst(150)
+        assert wait_until(lambda: spooling.sender.stats()['spooled'] > 0, 5.0)
+        if outage == 'failing':
+            server.failing = False
+        elif outage == 'paused':
+            server.paused.clear()
+        else:
+            server = serve_writes(port, lines)
+        burst(50)
+        expected = {int(line.split()[-1]) for block in written for line in block.split('\n')}
+        assert wait_until(lambda: len(spooling.sender.spool) == 0 and
+                          {int(line.split()[-1]) for line in list(lines) if line} >= expected)
+    finally:
+        spooling.close()
+        api.close()
+        server.shutdown()
+        server.server_close()
+    assert {int(line.split()[-1]) for line in lines if line} == expected
@@ -0,0 +1,28 @@
+import numpy as np
+
+import acc_utils
+import ecg_utils
+from session_utils import RecordingSession
+from sim_utils import SimulatedVest
+from store_utils import RecordingStore
+
+
+def test_aligns_the_accelerometer_packets_received_before_the_ecg_clock():
+    vest = SimulatedVest(seed=8)
+    session = RecordingSession(vest.address)
+    store = RecordingStore(vest.address)
+    # the accelerometer starts 5 packets (950ms) before the first ecg packet
+    for data in vest.acc_packets(5):
+        acc_utils.process_accelerometer_data(session, data, store=store)
+    for data in vest.ecg_packets(100):
+        ecg_utils.process_ecg_data(session, data, store=store)
+    for data in vest.acc_packets(10):
+        acc_utils.process_accelerometer_data(session, data, store=store)
+    ecg_utils.flush_ecg_data(session)
+    assert session.acc_recording_offset == 5 * acc_utils.acc_data_frames * acc_utils.sample_interval_millis
+    acc_timestamps, _ = store.query('acc', -np.inf, np.inf)
+    ecg_timestamps, _ = store.query('ecg', -np.inf, np.inf)
+    assert len(acc_timestamps) == 10 * acc_utils.acc_data_frames
+    # the first accelerometer sample after the ecg clock started is stored at the first ecg sample
+    assert acc_timestamps[0] == ecg_timestamps[0] == session.ecg_recording_start
+    assert np.array_equal(np.diff(acc_timestamps), np.full(len(acc_timestamps) - 1, acc_utils.sample_interval_millis))